@@ -5,6 +5,8 @@ from bars_core.models.bar import Bar, BarSettings
 from bars_core.models.role import Role
 from bars_core.models.account import Account
 from bars_core.models.loginattempt import LoginAttempt
+from bars_core.models.outbox import OutboxMail
+from bars_core.models.tombstone import Tombstone
 
 
 admin.site.unregister(Group)
@@ -14,3 +16,5 @@ admin.site.register(BarSettings)
 admin.site.register(Role)
 admin.site.register(Account)
 admin.site.register(LoginAttempt)
+admin.site.register(OutboxMail)
+admin.site.register(Tombstone)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import F, Func
+import bars_django.utils
+
+
+def round_money(apps, schema_editor):
+    # Some databases do not round the existing values when changing the column type
+    Account = apps.get_model('bars_core', 'Account')
+    Account.objects.update(money=Func(F('money'), 2, function='ROUND', output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_core', '0022_tombstone_last_modified_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='account',
+            name='money',
+            field=bars_django.utils.MoneyField(default=0, max_digits=12, decimal_places=2),
+        ),
+        migrations.RunPython(round_money, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,19 @@
 from datetime import datetime, timedelta
 
 from django.db import models
+from django.db.models.signals import post_delete
 from django.http import HttpResponseBadRequest
 
 from rest_framework import viewsets
 from rest_framework import serializers, decorators
 from rest_framework.response import Response
 
-from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault
+from bars_django.utils import VirtualField, MoneyField, permission_logic, CurrentBarCreateOnlyDefault, ConditionalGetMixin
 from bars_core.models.bar import Bar
 from bars_core.models.user import User, get_default_user
 from bars_core.models.role import Role
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
+from bars_core.models.tombstone import record_deletion
 
 
 @permission_logic(BarRolePermissionLogic())
@@ -22,11 +24,11 @@ class Account(models.Model):
         app_label = 'bars_core'
     bar = models.ForeignKey(Bar)
     owner = models.ForeignKey(User)
-    money = models.FloatField(default=0)
+    money = MoneyField(default=0)
 
     overdrawn_since = models.DateField(null=True)
     deleted = models.BooleanField(default=False)
-    last_modified = models.DateTimeField(auto_now=True)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return self.owner.username + " (" + self.bar.id + ")"
@@ -37,6 +39,9 @@ class Account(models.Model):
         super(Account, self).save(*args, **kwargs)
 
 
+post_delete.connect(record_deletion, sender=Account)
+
+
 class AccountSerializer(serializers.ModelSerializer):
     class Meta:
         model = Account
@@ -46,7 +51,7 @@ class AccountSerializer(serializers.ModelSerializer):
     bar = serializers.PrimaryKeyRelatedField(read_only=True, default=CurrentBarCreateOnlyDefault())
 
 
-class AccountViewSet(viewsets.ModelViewSet):
+class AccountViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Account.objects.all()
     serializer_class = AccountSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
@@ -67,12 +72,24 @@ class AccountViewSet(viewsets.ModelViewSet):
     @decorators.detail_route()
     def stats(self, request, pk):
         from bars_stats.utils import compute_transaction_stats
+        from bars_stats.models import AccountDailyStat
         f = lambda qs: qs.filter(accountoperation__target=pk)
         aggregate = models.Sum('accountoperation__delta')
+        rollup = (AccountDailyStat.objects.filter(account=pk), models.Sum('total'))
 
-        stats = compute_transaction_stats(request, f, aggregate)
+        stats = compute_transaction_stats(request, f, aggregate, rollup)
         return Response(stats, 200)
 
+    @decorators.detail_route()
+    def balance_at(self, request, pk):
+        from bars_core.sync import parse_since
+        from bars_transactions.models import balance_at
+        account = self.get_object()
+        timestamp = parse_since(request.query_params.get('ts'), 'ts')
+        if timestamp is None:
+            return HttpResponseBadRequest("Give me a timestamp")
+        return Response({'account': account.id, 'ts': timestamp, 'balance': balance_at(account.id, timestamp)}, 200)
+
     @decorators.detail_route()
     def total_spent(self, request, pk):
         from bars_stats.utils import compute_total_spent
@@ -131,7 +148,7 @@ class AccountViewSet(viewsets.ModelViewSet):
         if ranking is None:
             return HttpResponseBadRequest("I can only give a ranking within a bar")
         else:
-            ranking = ranking.annotate(total=models.Sum(models.F('stockitems__itemoperation__delta') * models.F('stockitems__itemoperation__target__unit_factor') * models.F('stockitems__itemoperation__transaction__accountoperation__delta') / models.F('stockitems__itemoperation__transaction__moneyflow')))
+            ranking = ranking.annotate(total=models.Sum(models.F('stockitems__itemoperation__delta') * models.F('stockitems__itemoperation__target__unit_factor') * models.F('stockitems__itemoperation__transaction__accountoperation__delta') / models.F('stockitems__itemoperation__transaction__moneyflow'), output_field=models.FloatField()))
             return Response(ranking, 200)
 
     @decorators.detail_route(methods=['get'])
@@ -1,11 +1,13 @@
-from datetime import date, timedelta
-from mock import Mock
+import time
+from django.conf import settings
 from django.db import models
 from django.db.models import Count, F, Sum, Prefetch
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from rest_framework import viewsets, serializers, decorators
 from rest_framework.response import Response
 
-from bars_django.utils import VirtualField, permission_logic
+from bars_django.utils import VirtualField, permission_logic, ConditionalGetMixin
 from bars_core.perms import RootBarRolePermissionLogic
 
 
@@ -25,40 +27,10 @@ class Bar(models.Model):
         BarSettings.objects.get_or_create(bar=self)
 
 
-    def apply_agios(self, account):
-        if account.money >= 0 and account.overdrawn_since is not None:
-            account.overdrawn_since = None
-            account.save()
-
-        elif account.money < 0:
-            if account.overdrawn_since is None:
-                account.overdrawn_since = date.today()
-                account.save()
-
-            if self.settings.agios_enabled and date.today() - account.overdrawn_since >= timedelta(self.settings.agios_threshold):
-                delta = abs(account.money) * self.settings.agios_factor
-                makeAgiosTransaction(self, account, delta)
-                return delta
-
-        return 0
-
     def count_accounts(self):
         return self.account_set.filter(deleted=False).count()
 
 
-def makeAgiosTransaction(bar, account, amount):
-    from bars_transactions.serializers import AgiosTransactionSerializer
-    from bars_core.models.user import get_default_user
-    user = get_default_user()
-    user.has_perm = Mock(return_value=True)
-    data = {'type': 'agios', 'account': account.id, 'amount': amount}
-    context = {'request': Mock(bar=bar, user=user)}
-
-    s = AgiosTransactionSerializer(data=data, context=context)
-    s.is_valid(raise_exception=True)
-    s.save()
-
-
 class BarSerializer(serializers.ModelSerializer):
     class Meta:
         model = Bar
@@ -134,12 +106,43 @@ class BarSettings(models.Model):
     agios_threshold = models.FloatField(default=2)  # In days
     agios_factor = models.FloatField(default=0.05)
 
-    last_modified = models.DateTimeField(auto_now=True)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return self.bar.id
 
 
+## Process-local cache of bars and their settings
+_bar_cache = {}
+
+def get_bar(pk):
+    """Returns the bar with the given id, with its settings already loaded.
+
+    Bars are cached for settings.BAR_CACHE_TTL seconds, and dropped from the cache
+    as soon as the bar or its settings are saved.
+    """
+    entry = _bar_cache.get(pk)
+    if entry is None or entry[0] < time.time():
+        bar = Bar.objects.select_related('settings').get(pk=pk)
+        entry = (time.time() + settings.BAR_CACHE_TTL, bar)
+        _bar_cache[pk] = entry
+    return entry[1]
+
+def get_bar_settings(pk):
+    return get_bar(pk).settings
+
+
+@receiver(post_save, sender=Bar)
+@receiver(post_delete, sender=Bar)
+def invalidate_bar(sender, instance, **kwargs):
+    _bar_cache.pop(instance.pk, None)
+
+@receiver(post_save, sender=BarSettings)
+@receiver(post_delete, sender=BarSettings)
+def invalidate_bar_settings(sender, instance, **kwargs):
+    _bar_cache.pop(instance.bar_id, None)
+
+
 class BarSettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = BarSettings
@@ -148,7 +151,7 @@ class BarSettingsSerializer(serializers.ModelSerializer):
     bar = serializers.PrimaryKeyRelatedField(read_only=True)
 
 
-class BarSettingsViewSet(viewsets.ModelViewSet):
+class BarSettingsViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = BarSettings.objects.all()
     serializer_class = BarSettingsSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import models
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+
+class OutboxMail(models.Model):
+    """A mail waiting to be sent by scripts/send_mails.py."""
+    class Meta:
+        app_label = 'bars_core'
+        index_together = [('sent_at', 'next_attempt')]
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()  # Comma-separated
+
+    timestamp = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    MAX_ATTEMPTS = 8
+    RETRY_DELAY = 60  # In seconds, doubled after each failure
+
+    def __unicode__(self):
+        return "%s to %s" % (self.subject, self.recipients)
+
+    def as_message(self):
+        return EmailMessage(subject=self.subject, body=self.message,
+                            from_email=self.from_email, to=self.recipients.split(','))
+
+    def failed(self, error):
+        self.attempts += 1
+        self.last_error = force_text(error)
+        self.next_attempt = timezone.now() + timedelta(seconds=self.RETRY_DELAY * 2 ** (self.attempts - 1))
+        self.save()
+
+
+def queue_mail(subject, message, from_email, recipient_list):
+    """Same arguments as send_mail, but only stores the mail in the outbox.
+
+    The mail is thus part of the current transaction, and sent once it is committed.
+    """
+    return OutboxMail.objects.create(subject=subject, message=message, from_email=from_email,
+                                     recipients=','.join(recipient_list))
+
+
+def send_queued_mails(batch_size=100):
+    """Sends one batch of due mails over a single connection.
+
+    Returns (sent, failed) counts. Mails that fail are retried later with an
+    exponential backoff, and given up after OutboxMail.MAX_ATTEMPTS attempts.
+    """
+    mails = list(OutboxMail.objects
+                 .filter(sent_at__isnull=True, next_attempt__lte=timezone.now(), attempts__lt=OutboxMail.MAX_ATTEMPTS)
+                 .order_by('next_attempt')[:batch_size])
+    if not mails:
+        return 0, 0
+
+    sent, failed = [], 0
+    connection = get_connection()
+    try:
+        for mail in mails:
+            try:
+                connection.open()
+                connection.send_messages([mail.as_message()])
+                sent.append(mail.pk)
+            except Exception as e:
+                mail.failed(e)
+                failed += 1
+                connection.close()
+    finally:
+        connection.close()
+
+    OutboxMail.objects.filter(pk__in=sent).update(sent_at=timezone.now())
+    return len(sent), failed
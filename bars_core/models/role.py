@@ -1,14 +1,16 @@
 from django.db import models
+from django.db.models.signals import post_delete
 from rest_framework import viewsets
 from rest_framework import serializers, decorators
 from rest_framework.response import Response
 
-from bars_django.utils import VirtualField, permission_logic, get_root_bar, CurrentBarCreateOnlyDefault
+from bars_django.utils import VirtualField, permission_logic, get_root_bar, CurrentBarCreateOnlyDefault, ConditionalGetMixin
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
+from bars_core.models.tombstone import record_deletion
 
-from bars_core.roles import roles_map, root_roles_map, roles_list
+from bars_core.roles import roles_perms, root_roles_perms, roles_list
 
 class RoleManager(models.Manager):
     def get_queryset(self):
@@ -22,21 +24,27 @@ class Role(models.Model):
     name = models.CharField(max_length=127, choices=zip(roles_list, roles_list))
     bar = models.ForeignKey(Bar)
     user = models.ForeignKey(User)
-    last_modified = models.DateTimeField(auto_now=True)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     objects = RoleManager()
 
-    def get_permissions(self):
-        if self.bar == get_root_bar():
-            rmap = root_roles_map
+    def get_permission_set(self):
+        if self.bar_id == get_root_bar().id:
+            pmap = root_roles_perms
         else:
-            rmap = roles_map
-        return sorted(set(rmap[self.name])) if self.name in rmap else []
+            pmap = roles_perms
+        return pmap.get(self.name, frozenset())
+
+    def get_permissions(self):
+        return sorted(self.get_permission_set())
 
     def __unicode__(self):
         return self.user.username + " : " + self.name + " (" + self.bar.id + ")"
 
 
+post_delete.connect(record_deletion, sender=Role)
+
+
 class RoleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Role
@@ -45,7 +53,7 @@ class RoleSerializer(serializers.ModelSerializer):
     perms = serializers.ListField(child=serializers.CharField(max_length=127), read_only=True, source='get_permissions')
 
 
-class RoleViewSet(viewsets.ModelViewSet):
+class RoleViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Role.objects.all()
     serializer_class = RoleSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
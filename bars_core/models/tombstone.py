@@ -0,0 +1,21 @@
+from django.db import models
+
+
+class Tombstone(models.Model):
+    """Records the deletion of an object, so that /sync/ can tell clients about it."""
+    class Meta:
+        app_label = 'bars_core'
+        index_together = [('bar', 'timestamp')]
+    model = models.CharField(max_length=50)
+    object_id = models.IntegerField()
+    bar = models.CharField(max_length=50, blank=True)  # Not a foreign key: the bar may be deleted too
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return "%s %d" % (self.model, self.object_id)
+
+
+def record_deletion(sender, instance, **kwargs):
+    """post_delete receiver for the models served by /sync/."""
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.pk,
+                             bar=getattr(instance, 'bar_id', None) or '')
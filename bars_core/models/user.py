@@ -3,17 +3,19 @@
 import random
 import string
 from django.db import models
+from django.db.models.signals import post_delete
 from django.db.models import Prefetch
-from django.core.mail import send_mail
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser, _user_has_module_perms, _user_has_perm
 from rest_framework import viewsets, serializers, decorators, exceptions, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from permission.logics import OneselfPermissionLogic
-from bars_django.utils import VirtualField, permission_logic
+from bars_django.utils import VirtualField, permission_logic, ConditionalGetMixin
 from bars_core.perms import RootBarRolePermissionLogic
 from bars_core.models.loginattempt import LoginAttempt
+from bars_core.models.outbox import queue_mail
+from bars_core.models.tombstone import record_deletion
 
 
 class UserManager(BaseUserManager):
@@ -48,7 +50,7 @@ class User(AbstractBaseUser):
     email = models.EmailField(max_length=254, blank=True)
 
     is_active = models.BooleanField(default=True)
-    last_modified = models.DateTimeField(auto_now=True)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     is_superuser = models.BooleanField(default=False)
     is_staff = models.BooleanField(default=False)
@@ -86,6 +88,9 @@ class User(AbstractBaseUser):
         return "%s %s" % (self.firstname, self.lastname)
 
 
+post_delete.connect(record_deletion, sender=User)
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -111,7 +116,7 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 from bars_core.perms import RootBarPermissionsOrObjectPermissions
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (RootBarPermissionsOrObjectPermissions,)
@@ -139,10 +144,12 @@ class UserViewSet(viewsets.ModelViewSet):
     @decorators.detail_route()
     def stats(self, request, pk):
         from bars_stats.utils import compute_transaction_stats
+        from bars_stats.models import AccountDailyStat
         f = lambda qs: qs.filter(accountoperation__target__owner=pk)
         aggregate = models.Sum('accountoperation__delta')
+        rollup = (AccountDailyStat.objects.filter(account__owner=pk), models.Sum('total'))
 
-        stats = compute_transaction_stats(request, f, aggregate)
+        stats = compute_transaction_stats(request, f, aggregate, rollup)
         return Response(stats, 200)
 
 
@@ -174,7 +181,7 @@ class ResetPasswordView(APIView):
         mail = reset_mail.copy()
         mail['recipient_list'] = [user.email]
         mail['message'] = mail['message'].format(email=user.email, password=password, name=user.get_full_name(), login=user.username)
-        send_mail(**mail)
+        queue_mail(**mail)
 
         user.set_password(password)
         user.save()
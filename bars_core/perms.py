@@ -139,11 +139,23 @@ class RootBarRolePermissionLogic(PermissionLogic):
 from permission.backends import PermissionBackend as PermissionBackend_
 from bars_core.models.bar import Bar
 
+def get_bar_perms(user, bar_id):
+    """Returns the frozenset of the permissions of the user in the bar.
+
+    The sets for all the bars of the user are built at the first call and kept
+    on the user object, like Django does for its own permission caches.
+    """
+    try:
+        index = user._bar_perms_cache
+    except AttributeError:
+        index = {}
+        for r in user.role_set.all():
+            index[r.bar_id] = index.get(r.bar_id, frozenset()) | r.get_permission_set()
+        user._bar_perms_cache = index
+    return index.get(bar_id, frozenset())
+
 def _has_perm_in_bar(user, perm, bar):
-    for r in user.role_set.all():
-        if r.bar_id == bar.id and perm in r.get_permissions():
-            return True
-    return False
+    return perm in get_bar_perms(user, bar.id)
 
 class PermissionBackend(PermissionBackend_):
     def authenticate(self, *args, **kwargs):
@@ -120,3 +120,8 @@ root_roles_map['admin'] = \
 
 
 roles_list = list(set(roles_map.keys()) | set(root_roles_map.keys()))
+
+
+# Compiled permission sets, built once per process
+roles_perms = {name: frozenset(perms) for name, perms in roles_map.items()}
+root_roles_perms = {name: frozenset(perms) for name, perms in root_roles_map.items()}
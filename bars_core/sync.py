@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q, Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import permissions, exceptions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from bars_core.models.bar import BarSettings, BarSettingsSerializer
+from bars_core.models.user import User, UserSerializer
+from bars_core.models.role import Role, RoleSerializer
+from bars_core.models.account import Account, AccountSerializer
+from bars_core.models.tombstone import Tombstone
+from bars_items.models.buyitem import BuyItem, BuyItemPrice, BuyItemSerializer
+from bars_items.models.itemdetails import ItemDetails, ItemDetailsSerializer
+from bars_items.models.sellitem import SellItem, SellItemSerializer
+from bars_items.models.stockitem import StockItem, StockItemSerializer
+from bars_news.models import News, NewsSerializer
+
+
+def parse_since(value, name='since'):
+    if value is None:
+        return None
+    since = parse_datetime(value)
+    if since is None:
+        raise exceptions.ParseError("'%s' must be an ISO 8601 timestamp" % name)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.utc)
+    return since
+
+
+def changed(qs, since):
+    return qs.filter(last_modified__gt=since) if since is not None else qs
+
+
+class SyncView(APIView):
+    """Returns the objects of a bar changed since a given time, and the ids of the deleted ones.
+
+    Clients pass the returned 'timestamp' as 'since' for the next call. It lags
+    behind the current time by SYNC_MARGIN seconds, so that objects saved by
+    transactions still running are sent again next time. Deletions are only kept
+    for TOMBSTONE_TTL seconds: clients that did not sync for longer must start over.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, format=None):
+        bar = request.bar
+        if bar is None:
+            return Response("I can only sync a bar", 400)
+        since = parse_since(request.query_params.get('since'))
+        if since is not None and since < timezone.now() - timedelta(seconds=settings.TOMBSTONE_TTL):
+            return Response("'since' is too old, sync from scratch", 400)
+        timestamp = timezone.now() - timedelta(seconds=settings.SYNC_MARGIN)
+
+        stockitems = changed(StockItem.objects.filter(bar=bar), since)
+        if since is None:
+            sellitems = SellItem.objects.filter(bar=bar)
+            itemdetails = ItemDetails.objects.all()
+        else:
+            # Their representation depends on the stockitems of the bar
+            sellitems = SellItem.objects.filter(Q(last_modified__gt=since) | Q(pk__in=stockitems.values('sellitem')), bar=bar)
+            itemdetails = ItemDetails.objects.filter(Q(last_modified__gt=since) | Q(pk__in=stockitems.values('details')))
+
+        querysets = [
+            ('account', changed(Account.objects.filter(bar=bar), since), AccountSerializer),
+            ('barsettings', changed(BarSettings.objects.filter(bar=bar), since), BarSettingsSerializer),
+            ('buyitem', changed(BuyItem.objects.prefetch_related(Prefetch('buyitemprice_set', queryset=BuyItemPrice.objects.filter(bar=bar), to_attr='buyitemprice')), since), BuyItemSerializer),
+            ('itemdetails', itemdetails.prefetch_related(Prefetch('stockitem_set', queryset=StockItem.objects.filter(bar=bar), to_attr='stockitem')), ItemDetailsSerializer),
+            ('news', changed(News.objects.filter(bar=bar), since), NewsSerializer),
+            ('role', changed(Role.objects.filter(bar=bar), since), RoleSerializer),
+            ('sellitem', sellitems, SellItemSerializer),
+            ('stockitem', stockitems, StockItemSerializer),
+            ('user', changed(User.objects.all(), since), UserSerializer),
+        ]
+
+        data = {'timestamp': timestamp, 'deleted': {}}
+        for name, qs, serializer_class in querysets:
+            data[name] = serializer_class(qs, many=True, context={'request': request}).data
+            data['deleted'][name] = []
+
+        if since is not None:
+            tombstones = Tombstone.objects.filter(Q(bar=bar.id) | Q(bar=''), timestamp__gt=since)
+            for model, object_id in tombstones.values_list('model', 'object_id'):
+                if model in data['deleted']:
+                    data['deleted'][model].append(object_id)
+
+        return Response(data)
@@ -1,9 +1,26 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from mock import patch
+from django.conf import settings
+from django.core import mail
+from django.db import connection
+from django.utils import timezone
+from django.utils.http import urlquote
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase
 from bars_django.utils import get_root_bar
-from bars_core.models.bar import Bar, BarSerializer, BarSettingsSerializer
+from bars_django.metrics import MetricsFile, get_metrics_file
+from bars_core.models.bar import Bar, BarSettings, BarSerializer, BarSettingsSerializer, get_bar, get_bar_settings
 from bars_core.models.user import User, UserSerializer
 from bars_core.models.role import Role
 from bars_core.models.account import Account, AccountSerializer
+from bars_core.models.outbox import OutboxMail, queue_mail, send_queued_mails
+from bars_core.perms import get_bar_perms
+from bars_core.roles import roles_map, root_roles_map
 
 
 def reload(obj):
@@ -151,6 +168,91 @@ class BarSettingsTests(APITestCase):
         self.assertEqual(reload(self.barsettings).agios_enabled, self.data['agios_enabled'])
 
 
+class BarCacheTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(BarCacheTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id="barjone")
+
+    def test_cached(self):
+        get_bar(self.bar.id)
+        with self.assertNumQueries(0):
+            bar = get_bar(self.bar.id)
+            self.assertEqual(bar.settings.bar_id, self.bar.id)
+
+    def test_middleware_cached(self):
+        get_bar(self.bar.id)
+        with CaptureQueriesContext(connection) as without_bar:
+            self.client.get('/bar/')
+        with CaptureQueriesContext(connection) as with_bar:
+            response = self.client.get('/bar/?bar=%s' % self.bar.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(with_bar), len(without_bar))
+
+    def test_unknown_bar(self):
+        response = self.client.get('/bar/?bar=nope')
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalidate_on_settings_save(self):
+        get_bar(self.bar.id)
+        barsettings = BarSettings.objects.get(bar=self.bar)
+        barsettings.transaction_cancel_threshold = 12
+        barsettings.save()
+        self.assertEqual(get_bar_settings(self.bar.id).transaction_cancel_threshold, 12)
+
+    def test_invalidate_on_bar_save(self):
+        get_bar(self.bar.id)
+        bar = Bar.objects.get(pk=self.bar.id)
+        bar.name = "Bar jone"
+        bar.save()
+        self.assertEqual(get_bar(self.bar.id).name, "Bar jone")
+
+    def test_ttl(self):
+        get_bar(self.bar.id)
+        BarSettings.objects.filter(bar=self.bar).update(agios_factor=0.5)
+        self.assertNotEqual(get_bar_settings(self.bar.id).agios_factor, 0.5)
+
+        with patch('bars_core.models.bar.time.time', return_value=time.time() + 3600):
+            self.assertEqual(get_bar_settings(self.bar.id).agios_factor, 0.5)
+
+
+class MetricsTests(APITestCase):
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        settings = self.settings(METRICS_FILE=path, METRICS_ALLOWED_IPS=('127.0.0.1',))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_metrics(self):
+        self.client.get('/bar/')
+        self.client.get('/bar/')
+        account = Account.objects.create(bar=Bar.objects.create(id='metrics'), owner=User.objects.create(username='metrics'))
+        self.client.get('/account/%d/balance_at/?ts=2015-01-01T00:00:00Z' % account.id)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        self.assertIn('bars_request_duration_seconds_count{endpoint="BarViewSet.list"} 2\n', content)
+        self.assertIn('bars_sql_queries_bucket{endpoint="BarViewSet.list",le="+Inf"} 2\n', content)
+        self.assertIn('bars_render_duration_seconds_count{endpoint="AccountViewSet.balance_at"} 1\n', content)
+
+    def test_metrics_forbidden(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_shared(self):
+        MetricsFile(settings.METRICS_FILE).observe("SyncView.get", (0.2, 0.1, 0.05, 12))
+        data = get_metrics_file().read()
+        self.assertEqual(data["SyncView.get"][0], ((0,) * 5 + (1,) + (0,) * 6, 0.2))
+        self.assertEqual(data["SyncView.get"][3], ((0,) * 4 + (1,) + (0,) * 5, 12))
+
+    def test_slow_request(self):
+        with self.settings(SLOW_REQUEST_THRESHOLD=0), patch('bars_django.metrics.logger') as logger:
+            self.client.get('/bar/')
+        message = logger.warning.call_args[0][0] % logger.warning.call_args[0][1:]
+        self.assertIn("GET /bar/ (BarViewSet.list)", message)
+        self.assertIn("SELECT", message)
+
 class UserTests(APITestCase):
     @classmethod
     def setUpTestData(self):
@@ -329,6 +431,17 @@ class AccountTests(APITestCase):
         self.assertEqual(reload(self.account).deleted, self.account.deleted)
 
 
+    def test_balance_at(self):
+        response = self.client.get('/account/%d/balance_at/?ts=2015-01-01T00:00:00Z' % self.account.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['balance'], self.account.money)
+
+    def test_balance_at_invalid(self):
+        response = self.client.get('/account/%d/balance_at/' % self.account.id)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/account/%d/balance_at/?ts=yesterday' % self.account.id)
+        self.assertEqual(response.status_code, 400)
+
 
 class RoleTests(APITestCase):
     @classmethod
@@ -389,3 +502,242 @@ class RoleTests(APITestCase):
         self.client.force_authenticate(user=self.root)
         response = self.client.post('/role/?bar=root', self.create_data_root)
         self.assertEqual(response.status_code, 201)
+
+    def test_get_permissions(self):
+        role = Role.objects.get(name='admin', bar=self.bar, user=self.user2)
+        self.assertEqual(role.get_permissions(), sorted(set(roles_map['admin'])))
+        root_role = Role.objects.get(name='admin', bar=get_root_bar(), user=self.root)
+        self.assertEqual(root_role.get_permissions(), sorted(set(root_roles_map['admin'])))
+
+
+class PermissionBackendTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(PermissionBackendTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='natationjone')
+        self.bar2, _ = Bar.objects.get_or_create(id='avironjone')
+        self.user, _ = User.objects.get_or_create(username='nadrieril')
+        Role.objects.get_or_create(name='staff', bar=self.bar, user=self.user)
+        Role.objects.get_or_create(name='policeman', bar=self.bar2, user=self.user)
+        Role.objects.get_or_create(name='treasurer', bar=self.bar2, user=self.user)
+
+    def test_perms_in_bar(self):
+        user = reload(self.user)
+        self.assertTrue(user.has_perm('bars_transactions.change_transaction', self.bar))
+        self.assertFalse(user.has_perm('bars_transactions.change_transaction', self.bar2))
+        self.assertTrue(user.has_perm('bars_transactions.add_punishtransaction', self.bar2))
+        self.assertTrue(user.has_perm('bars_transactions.add_deposittransaction', self.bar2))
+
+    def test_perms_index(self):
+        user = reload(self.user)
+        user.has_perm('bars_transactions.change_transaction', self.bar)
+        with self.assertNumQueries(0):
+            for _ in range(100):
+                user.has_perm('bars_transactions.change_transaction', self.bar)
+                user.has_perm('bars_transactions.change_transaction', self.bar2)
+        self.assertEqual(get_bar_perms(user, self.bar2.id), frozenset(roles_map['treasurer']))
+
+
+class OutboxTests(APITestCase):
+    def queue(self, n=1):
+        for i in range(n):
+            queue_mail(subject="Test %d" % i, message="Hello", from_email="bar@chocapix.org", recipient_list=["a@m4x.org", "b@m4x.org"])
+
+
+    def test_queue_does_not_send(self):
+        self.queue()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMail.objects.get().recipients, "a@m4x.org,b@m4x.org")
+
+    def test_send(self):
+        self.queue(3)
+        self.assertEqual(send_queued_mails(batch_size=2), (2, 0))
+        self.assertEqual(send_queued_mails(batch_size=2), (1, 0))
+        self.assertEqual(send_queued_mails(batch_size=2), (0, 0))
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].to, ["a@m4x.org", "b@m4x.org"])
+        self.assertFalse(OutboxMail.objects.filter(sent_at__isnull=True).exists())
+
+    def test_retry_with_backoff(self):
+        self.queue()
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=IOError("Relay down")):
+            self.assertEqual(send_queued_mails(), (0, 1))
+
+        m = OutboxMail.objects.get()
+        self.assertEqual((m.attempts, m.last_error), (1, "Relay down"))
+        self.assertGreater(m.next_attempt, timezone.now())
+        # Not due yet
+        self.assertEqual(send_queued_mails(), (0, 0))
+
+        OutboxMail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_queued_mails(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_give_up(self):
+        self.queue()
+        OutboxMail.objects.update(attempts=OutboxMail.MAX_ATTEMPTS)
+        self.assertEqual(send_queued_mails(), (0, 0))
+
+    def test_reset_password(self):
+        User.objects.create(username="bob", email="bob@chocapix.org")
+        response = self.client.post('/reset-password/', {'email': "bob@chocapix.org"})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMail.objects.get().recipients, "bob@chocapix.org")
+
+
+class SyncTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(SyncTests, self).setUpTestData()
+        from bars_items.models.itemdetails import ItemDetails
+        from bars_items.models.sellitem import SellItem
+        from bars_items.models.stockitem import StockItem
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.bar2, _ = Bar.objects.get_or_create(id='barrouje')
+        self.user, _ = User.objects.get_or_create(username='bob')
+        self.account, _ = Account.objects.get_or_create(bar=self.bar, owner=self.user)
+        Account.objects.get_or_create(bar=self.bar2, owner=self.user)
+
+        self.sellitem = SellItem.objects.create(bar=self.bar, name="Chocolat")
+        self.itemdetails = ItemDetails.objects.create(name="Chocolat")
+        self.stockitem = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem, details=self.itemdetails, price=1)
+
+    def setUp(self):
+        self.client.force_authenticate(user=self.user)
+
+    def sync(self, since=None):
+        url = '/sync/?bar=barjone'
+        if since is not None:
+            url += '&since=' + urlquote(since)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def ids(self, data, name):
+        return [obj['id'] for obj in data[name]]
+
+
+    def test_full_sync(self):
+        data = self.sync()
+        self.assertEqual(self.ids(data, 'account'), [self.account.id])
+        self.assertEqual(self.ids(data, 'sellitem'), [self.sellitem.id])
+        self.assertEqual(data['itemdetails'][0]['stockitem'], self.stockitem.id)
+        self.assertIn(self.user.id, self.ids(data, 'user'))
+
+    def test_nothing_changed(self):
+        since = timezone.now().isoformat()
+        data = self.sync(since)
+        for name in ('account', 'user', 'role', 'sellitem', 'stockitem', 'itemdetails', 'buyitem', 'news', 'barsettings'):
+            self.assertEqual(data[name], [])
+            self.assertEqual(data['deleted'][name], [])
+
+    def test_operation_changes(self):
+        from bars_transactions.models import Transaction
+        since = timezone.now().isoformat()
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type='buy')
+        t.accountoperation_set.create(target=self.account, delta=-1)
+        self.stockitem.create_operation(transaction=t, delta=-1)
+
+        data = self.sync(since)
+        self.assertEqual(self.ids(data, 'account'), [self.account.id])
+        self.assertEqual(self.ids(data, 'stockitem'), [self.stockitem.id])
+        # Its quantity depends on the stockitem
+        self.assertEqual(self.ids(data, 'sellitem'), [self.sellitem.id])
+        self.assertEqual(data['user'], [])
+
+    def test_deletion(self):
+        role = Role.objects.create(bar=self.bar, user=self.user, name='customer')
+        Role.objects.create(bar=self.bar2, user=self.user, name='customer').delete()
+        since = timezone.now().isoformat()
+        role_id = role.id
+        role.delete()
+
+        data = self.sync(since)
+        self.assertEqual(data['deleted']['role'], [role_id])
+
+    def test_timestamp_round_trip(self):
+        data = self.sync()
+        self.account.save()
+        data = self.sync(data['timestamp'])
+        self.assertEqual(self.ids(data, 'account'), [self.account.id])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/sync/').status_code, 400)
+        self.assertEqual(self.client.get('/sync/?bar=barjone&since=yesterday').status_code, 400)
+        since = (timezone.now() - timedelta(seconds=settings.TOMBSTONE_TTL + 60)).isoformat()
+        self.assertEqual(self.client.get('/sync/?bar=barjone&since=' + urlquote(since)).status_code, 400)
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.client.get('/sync/?bar=barjone').status_code, 401)
+
+
+class ConditionalGetTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(ConditionalGetTests, self).setUpTestData()
+        from bars_items.models.itemdetails import ItemDetails
+        from bars_items.models.sellitem import SellItem
+        from bars_items.models.stockitem import StockItem
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.bar2, _ = Bar.objects.get_or_create(id='barrouje')
+        self.user, _ = User.objects.get_or_create(username='bob')
+        self.account, _ = Account.objects.get_or_create(bar=self.bar, owner=self.user)
+
+        self.sellitem = SellItem.objects.create(bar=self.bar, name="Chocolat")
+        self.stockitem = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem, details=ItemDetails.objects.create(name="Chocolat"), price=1)
+
+    def get(self, url, etag=None):
+        if etag is None:
+            return self.client.get(url)
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+
+    def test_list_not_modified(self):
+        response = self.get('/account/?bar=barjone')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get('/account/?bar=barjone', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # Only the validator, the bar filter aside
+        self.assertEqual(len([q for q in queries if 'bars_core_account' in q['sql']]), 1)
+
+    def test_list_modified(self):
+        etag = self.get('/account/?bar=barjone')['ETag']
+        reload(self.account).save()
+        self.assertEqual(self.get('/account/?bar=barjone', etag).status_code, 200)
+
+        etag = self.get('/account/?bar=barjone')['ETag']
+        Account.objects.create(bar=self.bar, owner=User.objects.create(username='alice'))
+        self.assertEqual(self.get('/account/?bar=barjone', etag).status_code, 200)
+
+    def test_query_string(self):
+        etag = self.get('/account/?bar=barjone')['ETag']
+        self.assertEqual(self.get('/account/?bar=barrouje', etag).status_code, 200)
+
+    def test_retrieve(self):
+        url = '/account/%d/' % self.account.id
+        etag = self.get(url)['ETag']
+        self.assertEqual(self.get(url, etag).status_code, 304)
+
+        reload(self.account).save()
+        self.assertEqual(self.get(url, etag).status_code, 200)
+
+    def test_related(self):
+        etag = self.get('/sellitem/?bar=barjone')['ETag']
+        self.assertEqual(self.get('/sellitem/?bar=barjone', etag).status_code, 304)
+
+        reload(self.stockitem).save()
+        self.assertEqual(self.get('/sellitem/?bar=barjone', etag).status_code, 200)
+
+    def test_permissions(self):
+        self.client.force_authenticate(user=self.user)
+        etag = self.get('/user/')['ETag']
+        self.assertEqual(self.get('/user/', etag).status_code, 304)
+
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.get('/user/', etag).status_code, 401)
@@ -0,0 +1,234 @@
+"""Per-endpoint request metrics, exposed at /metrics in the Prometheus text format.
+
+The histograms live in a memory-mapped file (settings.METRICS_FILE), so that the
+gunicorn workers all add to the same counters and any of them can serve /metrics.
+Each endpoint (for example "TransactionViewSet.cancel") gets a slot in the file,
+found by hashing its name; updates are serialized with flock().
+
+Only the addresses in settings.METRICS_ALLOWED_IPS may read /metrics.
+"""
+import fcntl
+import inspect
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from bisect import bisect_left
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from rest_framework.viewsets import ViewSetMixin
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# (name, help, buckets), in the order of the values given to MetricsFile.observe()
+HISTOGRAMS = (
+    ('bars_request_duration_seconds', "Time spent handling requests.", TIME_BUCKETS),
+    ('bars_sql_duration_seconds', "Time spent in SQL queries, per request.", TIME_BUCKETS),
+    ('bars_render_duration_seconds', "Time spent rendering responses, per request.", TIME_BUCKETS),
+    ('bars_sql_queries', "Number of SQL queries, per request.", COUNT_BUCKETS),
+)
+
+MAX_ENDPOINTS = 512
+NAME_SIZE = 120
+# A slot is the name of the endpoint, then for each histogram its bucket counts
+# (the last one for +Inf) and the sum of the observed values, as doubles
+SLOT_SIZE = NAME_SIZE + sum(len(buckets) + 2 for _, _, buckets in HISTOGRAMS) * 8
+
+
+class MetricsFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        # Opened by each process, since flock() locks are shared by inherited descriptors
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        size = MAX_ENDPOINTS * SLOT_SIZE
+        with self.lock():
+            if os.fstat(self.file.fileno()).st_size < size:
+                os.ftruncate(self.file.fileno(), size)
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.offsets = {}
+
+    def lock(self, exclusive=True):
+        return _FileLock(self.file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def _name_at(self, offset):
+        return self.mmap[offset:offset + NAME_SIZE].rstrip(b'\0')
+
+    def _offset(self, name):
+        """Returns the offset of the slot of name, taking an empty one if needed. Must be called under the lock."""
+        offset = self.offsets.get(name)
+        if offset is not None:
+            return offset
+
+        start = zlib.crc32(name) % MAX_ENDPOINTS
+        for i in range(MAX_ENDPOINTS):
+            offset = (start + i) % MAX_ENDPOINTS * SLOT_SIZE
+            slot_name = self._name_at(offset)
+            if not slot_name:
+                self.mmap[offset:offset + NAME_SIZE] = name.ljust(NAME_SIZE, b'\0')
+            if not slot_name or slot_name == name:
+                self.offsets[name] = offset
+                return offset
+        return None
+
+    def observe(self, endpoint, values):
+        """Adds one value to each histogram of endpoint."""
+        name = endpoint.encode('utf8')[:NAME_SIZE]
+        with self.lock():
+            offset = self._offset(name)
+            if offset is None:
+                return
+            offset += NAME_SIZE
+            for (_, _, buckets), value in zip(HISTOGRAMS, values):
+                bucket = offset + bisect_left(buckets, value) * 8
+                sum_ = offset + (len(buckets) + 1) * 8
+                struct.pack_into('d', self.mmap, bucket, struct.unpack_from('d', self.mmap, bucket)[0] + 1)
+                struct.pack_into('d', self.mmap, sum_, struct.unpack_from('d', self.mmap, sum_)[0] + value)
+                offset += (len(buckets) + 2) * 8
+
+    def read(self):
+        """Returns a dict mapping each endpoint to its list of (bucket counts, sum), one per histogram."""
+        data = {}
+        with self.lock(exclusive=False):
+            for i in range(MAX_ENDPOINTS):
+                offset = i * SLOT_SIZE
+                name = self._name_at(offset)
+                if not name:
+                    continue
+                offset += NAME_SIZE
+                values = []
+                for _, _, buckets in HISTOGRAMS:
+                    counts = struct.unpack_from('%dd' % (len(buckets) + 2), self.mmap, offset)
+                    values.append((counts[:-1], counts[-1]))
+                    offset += (len(buckets) + 2) * 8
+                data[name.decode('utf8')] = values
+        return data
+
+
+class _FileLock(object):
+    def __init__(self, file, operation):
+        self.file = file
+        self.operation = operation
+
+    def __enter__(self):
+        fcntl.flock(self.file, self.operation)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+_metrics_file = None
+
+def get_metrics_file():
+    global _metrics_file
+    if _metrics_file is None or _metrics_file.pid != os.getpid() or _metrics_file.path != settings.METRICS_FILE:
+        _metrics_file = MetricsFile(settings.METRICS_FILE)
+    return _metrics_file
+
+
+# Actions of the routes generated by DRF routers for the methods of a viewset
+ROUTE_ACTIONS = {
+    'list': {'get': 'list', 'post': 'create'},
+    'detail': {'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'},
+}
+
+def endpoint_name(view_func, request):
+    """Returns the name of a resolved view: "<ViewSet>.<action>" for viewsets, "<APIView>.<method>" for views."""
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return "%s.%s" % (view_func.__module__, view_func.__name__)
+
+    method = request.method.lower()
+    action = method
+    if issubclass(cls, ViewSetMixin):
+        # Routers name routes "<basename>-list", "<basename>-detail" or "<basename>-<extra-action>"
+        url_name = request.resolver_match.url_name or ''
+        route = url_name.rsplit('-', 1)[-1]
+        if route in ROUTE_ACTIONS:
+            action = ROUTE_ACTIONS[route].get(method, method)
+        else:
+            for name, attr in inspect.getmembers(cls, lambda attr: hasattr(attr, 'bind_to_methods')):
+                if url_name.endswith('-' + name.replace('_', '-')):
+                    action = name
+    return "%s.%s" % (cls.__name__, action)
+
+
+class MetricsMiddleware(object):
+    """Records the latency, SQL queries and rendering time of each request.
+
+    Requests slower than settings.SLOW_REQUEST_THRESHOLD seconds are logged with
+    their slowest SQL queries.
+    """
+    def process_request(self, request):
+        debug_cursor = connection.force_debug_cursor
+        if not debug_cursor:
+            # Nobody else looks at the query log, keep it from filling up
+            connection.queries_log.clear()
+        connection.force_debug_cursor = True
+        request._metrics = {
+            'start': time.time(),
+            'endpoint': "unresolved",
+            'queries': len(connection.queries_log),
+            'debug_cursor': debug_cursor,
+        }
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics['endpoint'] = endpoint_name(view_func, request)
+
+    def process_template_response(self, request, response):
+        # Called right before response.render()
+        request._metrics['render_start'] = time.time()
+        return response
+
+    def process_response(self, request, response):
+        metrics = getattr(request, '_metrics', None)
+        if metrics is None:
+            return response
+        end = time.time()
+        connection.force_debug_cursor = metrics['debug_cursor']
+
+        queries = list(islice(connection.queries_log, metrics['queries'], None))
+        sql_time = sum(float(q['time']) for q in queries)
+        render_time = end - metrics.get('render_start', end)
+        total = end - metrics['start']
+        get_metrics_file().observe(metrics['endpoint'], (total, sql_time, render_time, len(queries)))
+
+        if total > settings.SLOW_REQUEST_THRESHOLD:
+            slowest = sorted(queries, key=lambda q: float(q['time']), reverse=True)[:settings.SLOW_REQUEST_QUERIES]
+            logger.warning("Slow request: %s %s (%s), %.3fs, %d queries in %.3fs%s",
+                           request.method, request.get_full_path(), metrics['endpoint'], total, len(queries), sql_time,
+                           "".join("\n  %ss: %s" % (q['time'], q['sql']) for q in slowest))
+        return response
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics(data):
+    lines = []
+    for i, (name, help, buckets) in enumerate(HISTOGRAMS):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s histogram" % name)
+        for endpoint in sorted(data):
+            counts, sum_ = data[endpoint][i]
+            label = 'endpoint="%s"' % _escape(endpoint)
+            total = 0
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                total += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, bound, total))
+            lines.append("%s_sum{%s} %r" % (name, label, sum_))
+            lines.append("%s_count{%s} %d" % (name, label, total))
+    return "\n".join(lines) + "\n"
+
+def metrics_view(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(get_metrics_file().read()), content_type='text/plain; version=0.0.4')
@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
 # SECURITY WARNING: keep the secret key used in production secret!
@@ -70,10 +71,12 @@ INSTALLED_APPS = (
     'bars_news',
     'bars_bugtracker',
     'bars_menus',
+    'bars_stats',
 )
 
 
 MIDDLEWARE_CLASSES = (
+    'bars_django.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +93,44 @@ WSGI_APPLICATION = 'bars_django.wsgi.application'
 
 ATOMIC_REQUESTS = True
 
+# How long (in seconds) a bar and its settings are cached by each process
+BAR_CACHE_TTL = 60
+
+# How far (in seconds) the timestamp returned by /sync/ lags behind, to catch
+# objects saved by transactions that were still running
+SYNC_MARGIN = 5
+# How long (in seconds) deletions are kept for /sync/, see scripts/clean_tombstones.py
+TOMBSTONE_TTL = 30 * 24 * 3600
+
+# How long (in seconds) idempotency keys of transactions are kept, see scripts/clean_idempotency_keys.py
+IDEMPOTENCY_KEY_TTL = 24 * 3600
+
+# Where the request metrics shared by all the processes are kept, see bars_django/metrics.py
+METRICS_FILE = os.path.join(tempfile.gettempdir(), 'bars_metrics')
+# Addresses allowed to read /metrics, none by default. Behind a reverse proxy,
+# requests come from the address of the proxy: /metrics must then be blocked there
+METRICS_ALLOWED_IPS = ()
+
+# Requests slower than this (in seconds) are logged, with their SLOW_REQUEST_QUERIES slowest SQL queries
+SLOW_REQUEST_THRESHOLD = 1
+SLOW_REQUEST_QUERIES = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'bars_django.metrics': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
+}
+
 # Internationalization
 
 LANGUAGE_CODE = 'en-us'
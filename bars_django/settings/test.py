@@ -17,3 +17,5 @@ DATABASES = {
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+METRICS_FILE = os.path.join(tempfile.gettempdir(), 'bars_metrics_test')
@@ -12,6 +12,8 @@ from bars_core.models.user import UserViewSet, ResetPasswordView
 from bars_core.models.role import RoleViewSet
 from bars_core.models.account import AccountViewSet
 from bars_core.models.loginattempt import LoginAttemptViewSet
+from bars_core.sync import SyncView
+from bars_django.metrics import metrics_view
 
 from bars_items.models.sellitem import SellItemViewSet
 from bars_items.models.stockitem import StockItemViewSet
@@ -57,5 +59,7 @@ urlpatterns = patterns(
     # url(r'^api-token-auth/', 'rest_framework_jwt.views.obtain_jwt_token'),
     url(r'^api-token-auth/', 'bars_core.auth.obtain_jwt_token'),
     url(r'^reset-password/$', ResetPasswordView.as_view()),
+    url(r'^sync/$', SyncView.as_view()),
+    url(r'^metrics/?$', metrics_view),
     url(r'^', include(router.urls)),
 )
@@ -17,6 +17,42 @@ class VirtualField(fields.ReadOnlyField):
 
 
 
+from django.db import models
+class MoneyField(models.FloatField):
+    """A float in Python, stored as an exact decimal with a fixed number of decimal places.
+
+    Values are rounded to decimal_places when saved, and by to_python, so that rounding
+    errors cannot build up from one operation to the next. Serializers see a
+    FloatField, so the API is unchanged.
+    """
+    def __init__(self, *args, **kwargs):
+        # Not stored as max_digits and decimal_places, which serializers would pass to their FloatField
+        self.precision = kwargs.pop('max_digits', 12)
+        self.scale = kwargs.pop('decimal_places', 2)
+        super(MoneyField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(MoneyField, self).deconstruct()
+        kwargs['max_digits'] = self.precision
+        kwargs['decimal_places'] = self.scale
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        return connection.data_types['DecimalField'] % {'max_digits': self.precision, 'decimal_places': self.scale}
+
+    def from_db_value(self, value, expression, connection, context):
+        return float(value) if value is not None else None
+
+    def to_python(self, value):
+        value = super(MoneyField, self).to_python(value)
+        return round(value, self.scale) if value is not None else None
+
+    def get_prep_value(self, value):
+        value = super(MoneyField, self).get_prep_value(value)
+        return round(value, self.scale) if value is not None else None
+
+
+
 from permission import add_permission_logic
 def permission_logic(logic):
     def decorator(model):
@@ -38,13 +74,13 @@ get_root_bar._cache = None
 from django.http import Http404
 class BarMiddleware(object):
     def process_request(self, request):
-        from bars_core.models.bar import Bar
+        from bars_core.models.bar import Bar, get_bar
         bar = request.GET.get('bar', None)
         if bar is None:
             request.bar = None
         else:
             try:
-                request.bar = Bar.objects.get(pk=bar)
+                request.bar = get_bar(bar)
             except Bar.DoesNotExist:
                 raise Http404("Unknown bar: %s" % bar)
         return None
@@ -80,3 +116,59 @@ def get_client_ip(request):
     else:
         ip = request.META.get('REMOTE_ADDR')
     return ip
+
+
+
+import hashlib
+from calendar import timegm
+from django.db.models import Max, Count
+from django.utils.encoding import force_bytes
+from django.utils.http import parse_etags, quote_etag, http_date
+from rest_framework.response import Response
+class ConditionalGetMixin(object):
+    """Answers 304 Not Modified to list and retrieve requests when nothing changed.
+
+    The ETag of a list is computed from MAX(last_modified) and COUNT(*) over the
+    filtered queryset, and the query string, so nothing gets serialized when it
+    matches. Permissions are checked as usual beforehand. Relations whose objects
+    appear in the representation are listed in etag_related.
+    """
+    etag_related = ()
+
+    def get_validator(self, queryset):
+        aggregates = {'last_modified': Max('last_modified'), 'count': Count('pk', distinct=True)}
+        for related in self.etag_related:
+            aggregates[related + '_last_modified'] = Max(related + '__last_modified')
+            aggregates[related + '_count'] = Count(related, distinct=True)
+        return queryset.aggregate(**aggregates)
+
+    def get_etag(self, request, validator):
+        key = "%s|%s" % (request.META.get('QUERY_STRING', ''), sorted(validator.items()))
+        return hashlib.md5(force_bytes(key)).hexdigest()
+
+    def set_validator_headers(self, response, etag, validator):
+        response['ETag'] = quote_etag(etag)
+        if validator['last_modified'] is not None:
+            response['Last-Modified'] = http_date(timegm(validator['last_modified'].utctimetuple()))
+        return response
+
+    def conditional_response(self, request, validator, get_response):
+        etag = self.get_etag(request, validator)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=304)
+        else:
+            response = get_response()
+        return self.set_validator_headers(response, etag, validator)
+
+    def list(self, request, *args, **kwargs):
+        validator = self.get_validator(self.filter_queryset(self.get_queryset()))
+        parent = super(ConditionalGetMixin, self)
+        return self.conditional_response(request, validator, lambda: parent.list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        if self.etag_related:
+            validator = self.get_validator(self.get_queryset().filter(pk=instance.pk))
+        else:
+            validator = {'last_modified': instance.last_modified, 'count': 1}
+        return self.conditional_response(request, validator, lambda: Response(self.get_serializer(instance).data))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0008_auto_20150913_2047'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='buyitem',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, auto_now=True, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='itemdetails',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, auto_now=True, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='sellitem',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, auto_now=True, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='stockitem',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, auto_now=True, db_index=True),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import F, Func
+import bars_django.utils
+
+
+def round_money(apps, schema_editor):
+    # Some databases do not round the existing values when changing the column type
+    StockItem = apps.get_model('bars_items', 'StockItem')
+    StockItem.objects.update(price=Func(F('price'), 4, function='ROUND', output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0009_last_modified'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockitem',
+            name='price',
+            field=bars_django.utils.MoneyField(max_digits=12, decimal_places=4),
+        ),
+        migrations.RunPython(round_money, migrations.RunPython.noop),
+    ]
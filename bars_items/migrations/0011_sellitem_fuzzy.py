@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from bars_items.models.sellitem import refresh_fuzzy
+
+
+def backfill(apps, schema_editor):
+    SellItem = apps.get_model('bars_items', 'SellItem')
+    StockItem = apps.get_model('bars_items', 'StockItem')
+    ids = list(SellItem.objects.values_list('pk', flat=True))
+    for i in range(0, len(ids), 200):
+        refresh_fuzzy(ids[i:i + 200], SellItem, StockItem)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0010_money_decimal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sellitem',
+            name='fuzzy_price',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sellitem',
+            name='fuzzy_qty',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
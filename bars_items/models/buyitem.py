@@ -1,6 +1,7 @@
 from django.http import Http404
-from django.db import models
-from django.db.models import Prefetch
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_delete
+from django.db.models import Prefetch, Case, When, Value
 from rest_framework import viewsets, serializers, permissions
 from rest_framework.response import Response
 from rest_framework.serializers import ValidationError
@@ -10,6 +11,7 @@ from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOn
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic, RootBarRolePermissionLogic, RootBarPermissionsOrAnonReadOnly
 from bars_core.models.bar import Bar
 from bars_items.models.itemdetails import ItemDetails
+from bars_core.models.tombstone import record_deletion
 
 
 @permission_logic(BarRolePermissionLogic())
@@ -25,6 +27,28 @@ class BuyItemPrice(models.Model):
         return "%s (%s)" % (unicode(self.buyitem), unicode(self.bar))
 
 
+def set_buyitem_prices(bar, prices, existing):
+    """Sets the prices of buyitems in bar, given as a dict {buyitem id: price}.
+
+    `existing` is the set of the buyitems that already have a price in bar: those
+    are updated with a single UPDATE, and the others are created in bulk.
+    """
+    updated = [(pk, price) for pk, price in prices.items() if pk in existing]
+    for i in range(0, len(updated), 200):
+        chunk = updated[i:i + 200]
+        BuyItemPrice.objects.filter(bar=bar, buyitem__in=[pk for pk, _ in chunk]).update(
+            price=Case(*[When(buyitem=pk, then=Value(price)) for pk, price in chunk], output_field=models.FloatField()))
+
+    missing = [(pk, price) for pk, price in prices.items() if pk not in existing]
+    try:
+        with transaction.atomic():
+            BuyItemPrice.objects.bulk_create([BuyItemPrice(bar=bar, buyitem_id=pk, price=price) for pk, price in missing], batch_size=100)
+    except IntegrityError:
+        # Some prices were created concurrently
+        for pk, price in missing:
+            BuyItemPrice.objects.update_or_create(bar=bar, buyitem_id=pk, defaults={'price': price})
+
+
 @permission_logic(RootBarRolePermissionLogic())
 class BuyItem(models.Model):
     class Meta:
@@ -32,11 +56,15 @@ class BuyItem(models.Model):
     barcode = models.CharField(max_length=25, blank=True)
     details = models.ForeignKey(ItemDetails)
     itemqty = models.FloatField(default=1)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return "%s * %f" % (unicode(self.details), self.itemqty)
 
 
+post_delete.connect(record_deletion, sender=BuyItem)
+
+
 class BuyItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = BuyItem
@@ -1,5 +1,6 @@
 from django.http import Http404
 from django.db import models
+from django.db.models.signals import post_delete
 from django.db.models import Sum, F, Prefetch, Value as V
 from rest_framework import viewsets, serializers, decorators
 from bars_django.utils import VirtualField, permission_logic
@@ -7,6 +8,7 @@ from rest_framework.response import Response
 
 from bars_core.perms import RootBarRolePermissionLogic, RootBarPermissionsOrAnonReadOnly
 from bars_items.models.stockitem import StockItem
+from bars_core.models.tombstone import record_deletion
 
 
 @permission_logic(RootBarRolePermissionLogic())
@@ -25,11 +27,15 @@ class ItemDetails(models.Model):
     ranking_unit_factor = models.FloatField(default=1)
 
     keywords = models.CharField(max_length=200, blank=True)  # Todo: length
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return self.name
 
 
+post_delete.connect(record_deletion, sender=ItemDetails)
+
+
 class ItemDetailsSerializer(serializers.ModelSerializer):
     class Meta:
         model = ItemDetails
@@ -88,8 +94,10 @@ class ItemDetailsViewSet(viewsets.ModelViewSet):
     @decorators.detail_route()
     def stats(self, request, pk):
         from bars_stats.utils import compute_transaction_stats
+        from bars_stats.models import ItemDailyStat
         f = lambda qs: qs.filter(itemoperation__target__sellitem=pk)
         aggregate = Sum(F('itemoperation__delta') * V(1)) # TODO: change if buy_unit
+        rollup = (ItemDailyStat.objects.filter(stockitem__sellitem=pk), Sum('total'))
 
-        stats = compute_transaction_stats(request, f, aggregate)
+        stats = compute_transaction_stats(request, f, aggregate, rollup)
         return Response(stats, 200)
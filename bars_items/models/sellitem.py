@@ -1,15 +1,18 @@
 from django.http import Http404, HttpResponseBadRequest
-from django.db import models
-from django.db.models import Sum, F, Prefetch
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.db.models import Sum, F, Count, Case, When, Value, Prefetch
 import datetime
+from django.utils import timezone
 from django.utils.timezone import utc
 from rest_framework import viewsets, serializers, permissions, decorators, exceptions
 from rest_framework.response import Response
 
-from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault
+from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, ConditionalGetMixin
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
 from bars_core.models.bar import Bar
 from bars_items.models.stockitem import StockItem
+from bars_core.models.tombstone import record_deletion
 
 class SellItemManager(models.Manager):
     def get_queryset(self):
@@ -29,11 +32,21 @@ class SellItem(models.Model):
     unit_name_plural = models.CharField(max_length=100, blank=True)
 
     tax = models.FloatField(default=0)
+    # Denormalized calc_qty() and calc_price(), kept up to date by refresh_fuzzy()
+    fuzzy_qty = models.FloatField(default=0)
+    fuzzy_price = models.FloatField(default=0)
 
     deleted = models.BooleanField(default=False)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     objects = SellItemManager()
 
+    def save(self, *args, **kwargs):
+        if self.pk:
+            # The tax may have changed, and the fuzzy values of this instance may be stale
+            self.fuzzy_qty, self.fuzzy_price = fuzzy_values(SellItem, StockItem, [self.pk], {self.pk: self.tax})[self.pk]
+        super(SellItem, self).save(*args, **kwargs)
+
     def calc_qty(self):
         if not hasattr(self, '_qty'):
             self._qty = sum(i.sell_qty for i in self.stockitems.all())
@@ -70,6 +83,57 @@ class SellItem(models.Model):
         return self.name
 
 
+post_delete.connect(record_deletion, sender=SellItem)
+
+
+def fuzzy_values(sellitem_model, stockitem_model, ids, taxes):
+    """Returns {sellitem id: (fuzzy_qty, fuzzy_price)}, computed like calc_qty() and calc_price() in a single query."""
+    sums = (stockitem_model.objects.filter(sellitem__in=ids)
+            .values('sellitem')
+            .annotate(total_qty=Sum(F('qty') * F('unit_factor'), output_field=models.FloatField()),
+                      total_value=Sum(F('qty') * F('price'), output_field=models.FloatField()),
+                      unit_price_sum=Sum(F('price') / F('unit_factor'), output_field=models.FloatField()),
+                      n=Count('pk'))
+            .order_by())
+    values = dict((pk, (0, 0)) for pk in ids)
+    for row in sums:
+        pk, qty = row['sellitem'], row['total_qty']
+        taxfactor = 1. + taxes[pk]
+        if qty != 0:
+            values[pk] = (qty, row['total_value'] * taxfactor / qty)
+        else:
+            values[pk] = (0, row['unit_price_sum'] * taxfactor / row['n'])
+    return values
+
+
+def refresh_fuzzy(ids, sellitem_model=SellItem, stockitem_model=StockItem):
+    """Recomputes the fuzzy_qty and fuzzy_price columns of the given sellitems.
+
+    Called whenever the quantity, price or unit factor of one of their stockitems,
+    or their tax, changes. Takes the models as arguments so that it can be run from a migration.
+    """
+    ids = sorted(set(ids))
+    with transaction.atomic():
+        for i in range(0, len(ids), 100):
+            chunk = ids[i:i + 100]
+            # Locks the rows first, so that concurrent refreshes of a sellitem see each other's changes
+            taxes = dict(sellitem_model.objects.select_for_update().filter(pk__in=chunk).order_by('pk').values_list('pk', 'tax'))
+            values = fuzzy_values(sellitem_model, stockitem_model, taxes.keys(), taxes).items()
+            sellitem_model.objects.filter(pk__in=taxes.keys()).update(
+                fuzzy_qty=Case(*[When(pk=pk, then=Value(qty)) for pk, (qty, _) in values], output_field=models.FloatField()),
+                fuzzy_price=Case(*[When(pk=pk, then=Value(price)) for pk, (_, price) in values], output_field=models.FloatField()),
+                last_modified=timezone.now())
+
+
+def refresh_stockitem_sellitem(sender, instance, **kwargs):
+    """post_save and post_delete receiver for StockItem."""
+    if SellItem.objects.filter(pk=instance.sellitem_id).exists():
+        refresh_fuzzy([instance.sellitem_id])
+
+post_save.connect(refresh_stockitem_sellitem, sender=StockItem)
+post_delete.connect(refresh_stockitem_sellitem, sender=StockItem)
+
+
 class SellItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = SellItem
@@ -80,8 +144,8 @@ class SellItemSerializer(serializers.ModelSerializer):
     _type = VirtualField("SellItem")
     bar = serializers.PrimaryKeyRelatedField(read_only=True, default=CurrentBarCreateOnlyDefault())
     stockitems = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
-    fuzzy_qty = serializers.FloatField(read_only=True, source='calc_qty')
-    fuzzy_price = serializers.FloatField(read_only=True, source='calc_price')
+    fuzzy_qty = serializers.FloatField(read_only=True)
+    fuzzy_price = serializers.FloatField(read_only=True)
     unit_factor = serializers.FloatField(write_only=True, default=1)
     oldest_inventory = serializers.DateTimeField(read_only=True, source='calc_oldest_inventory')
 
@@ -100,11 +164,14 @@ class RemoveStockItemSerializer(serializers.Serializer):
 class ChangeTaxSerializer(serializers.Serializer):
     tax = serializers.FloatField(default=None)
 
-class SellItemViewSet(viewsets.ModelViewSet):
-    queryset = SellItem.objects.all()
+class SellItemViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    # Only the ids and inventory dates of the stockitems are needed
+    queryset = SellItem.objects.prefetch_related(None).prefetch_related(Prefetch(
+        'stockitems', queryset=StockItem.objects.select_related(None).only('id', 'sellitem', 'last_inventory').order_by('last_inventory')))
     serializer_class = SellItemSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
     filter_fields = ['bar']
+    etag_related = ('stockitems',)
 
     @decorators.detail_route(methods=['put'])
     def merge(self, request, pk=None):
@@ -130,7 +197,7 @@ class SellItemViewSet(viewsets.ModelViewSet):
             stockitem.save()
         other.delete()
 
-        srz = SellItemSerializer(this)
+        srz = SellItemSerializer(SellItem.objects.get(pk=this.pk))
         return Response(srz.data, 200)
 
     @decorators.detail_route(methods=['put'])
@@ -155,8 +222,10 @@ class SellItemViewSet(viewsets.ModelViewSet):
 
         if old_sellitem.stockitems.count() == 0:
             old_sellitem.delete()
+        else:
+            refresh_fuzzy([old_sellitem.pk])
 
-        srz = SellItemSerializer(sellitem)
+        srz = SellItemSerializer(SellItem.objects.get(pk=sellitem.pk))
         return Response(srz.data, 200)
 
     @decorators.detail_route(methods=['put'])
@@ -188,8 +257,9 @@ class SellItemViewSet(viewsets.ModelViewSet):
 
         stockitem.sellitem = new_sellitem
         stockitem.save()
+        refresh_fuzzy([sellitem.pk])
 
-        srz = SellItemSerializer(new_sellitem)
+        srz = SellItemSerializer(SellItem.objects.get(pk=new_sellitem.pk))
         return Response(srz.data, 200)
 
     @decorators.list_route(methods=['put'])
@@ -206,23 +276,26 @@ class SellItemViewSet(viewsets.ModelViewSet):
         if tax < 0 or tax > 1:
             return Response('Tax must be between 0 and 1', 400)
 
-        SellItem.objects.filter(bar=bar).update(tax=tax)
+        SellItem.objects.filter(bar=bar).update(tax=tax, last_modified=timezone.now())
+        refresh_fuzzy(SellItem.objects.filter(bar=bar).values_list('pk', flat=True))
         return Response(status=204)
 
     @decorators.detail_route()
     def stats(self, request, pk):
         from bars_stats.utils import compute_transaction_stats
+        from bars_stats.models import ItemDailyStat
         f = lambda qs: qs.filter(itemoperation__target__sellitem=pk)
         aggregate = Sum(F('itemoperation__delta') * F('itemoperation__target__unit_factor'))
+        rollup = (ItemDailyStat.objects.filter(stockitem__sellitem=pk), Sum(F('total') * F('stockitem__unit_factor')))
 
-        stats = compute_transaction_stats(request, f, aggregate)
+        stats = compute_transaction_stats(request, f, aggregate, rollup)
         return Response(stats, 200)
 
     @decorators.detail_route()
     def ranking(self, request, pk):
         from bars_stats.utils import compute_ranking
         f = {'accountoperation__transaction__itemoperation__target__sellitem': pk}
-        ranking = compute_ranking(request, filter=f, annotate=Sum(F('accountoperation__transaction__itemoperation__delta') * F('accountoperation__transaction__itemoperation__target__unit_factor') * F('accountoperation__delta') / F('accountoperation__transaction__moneyflow')))
+        ranking = compute_ranking(request, filter=f, annotate=Sum(F('accountoperation__transaction__itemoperation__delta') * F('accountoperation__transaction__itemoperation__target__unit_factor') * F('accountoperation__delta') / F('accountoperation__transaction__moneyflow'), output_field=models.FloatField()))
         if ranking is None:
             return HttpResponseBadRequest("I can only give a ranking within a bar")
         else:
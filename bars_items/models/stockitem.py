@@ -1,14 +1,16 @@
 import datetime
 from django.db import models
+from django.db.models.signals import post_delete
 from django.db.models import Sum, F
 from django.core.exceptions import ValidationError
 from django.utils.timezone import utc
 from rest_framework import viewsets, serializers, permissions, decorators
 from rest_framework.response import Response
 
-from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault
+from bars_django.utils import VirtualField, MoneyField, permission_logic, CurrentBarCreateOnlyDefault, ConditionalGetMixin
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
 from bars_core.models.bar import Bar
+from bars_core.models.tombstone import record_deletion
 # from bars_items.models.itemdetails import ItemDetails
 # from bars_items.models.sellitem import SellItem
 
@@ -29,10 +31,11 @@ class StockItem(models.Model):
 
     qty = models.FloatField(default=0)
     unit_factor = models.FloatField(default=1)
-    price = models.FloatField()
+    price = MoneyField(decimal_places=4)  # Per buy unit, hence the extra precision
 
     last_inventory = models.DateTimeField(auto_now_add=True)
     deleted = models.BooleanField(default=False)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     objects = StockItemManager()
 
@@ -84,6 +87,9 @@ class StockItem(models.Model):
         return "%s (%s)" % (unicode(self.details), unicode(self.bar))
 
 
+post_delete.connect(record_deletion, sender=StockItem)
+
+
 class StockItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = StockItem
@@ -102,7 +108,7 @@ class StockItemSerializer(serializers.ModelSerializer):
         return value
 
 
-class StockItemViewSet(viewsets.ModelViewSet):
+class StockItemViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = StockItem.objects.all()
     serializer_class = StockItemSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
@@ -111,8 +117,10 @@ class StockItemViewSet(viewsets.ModelViewSet):
     @decorators.detail_route()
     def stats(self, request, pk):
         from bars_stats.utils import compute_transaction_stats
+        from bars_stats.models import ItemDailyStat
         f = lambda qs: qs.filter(itemoperation__target=pk)
         aggregate = Sum(F('itemoperation__delta') * F('itemoperation__target__unit_factor'))
+        rollup = (ItemDailyStat.objects.filter(stockitem=pk), Sum(F('total') * F('stockitem__unit_factor')))
 
-        stats = compute_transaction_stats(request, f, aggregate)
+        stats = compute_transaction_stats(request, f, aggregate, rollup)
         return Response(stats, 200)
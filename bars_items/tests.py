@@ -1,4 +1,6 @@
 from mock import Mock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import exceptions, serializers
 from rest_framework.test import APITestCase
 from bars_django.utils import get_root_bar
@@ -10,8 +12,9 @@ from bars_core.models.account import Account
 
 from bars_items.models.buyitem import BuyItem, BuyItemSerializer, BuyItemPrice, BuyItemPriceSerializer
 from bars_items.models.itemdetails import ItemDetails, ItemDetailsSerializer
-from bars_items.models.sellitem import SellItem, SellItemSerializer
+from bars_items.models.sellitem import SellItem, SellItemSerializer, fuzzy_values
 from bars_items.models.stockitem import StockItem, StockItemSerializer
+from bars_transactions.models import Transaction, ItemOperation
 
 
 def reload(obj):
@@ -192,6 +195,59 @@ class SellItemTests(ItemTests, AutoTestBarMixin):
         self.assertEqual(reload(self.sellitem).tax, 0.15)
         self.assertEqual(reload(self.sellitem2).tax, 0.15)
         self.assertEqual(reload(self.sellitem3).tax, 0.1)
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_price, 1.15)
+
+    def test_fuzzy(self):
+        def check():
+            sellitem = reload(self.sellitem)
+            sellitem_calc = reload(self.sellitem)
+            self.assertAlmostEqual(sellitem.fuzzy_qty, sellitem_calc.calc_qty())
+            self.assertAlmostEqual(sellitem.fuzzy_price, sellitem_calc.calc_price())
+            return sellitem
+
+        self.assertAlmostEqual(check().fuzzy_price, 1.2)
+
+        t = Transaction.objects.create(bar=self.bar, author=self.staff_user, type='appro')
+        op = ItemOperation.objects.create(transaction=t, target=self.stockitem, delta=4)
+        self.assertAlmostEqual(check().fuzzy_qty, 4)
+
+        t.canceled = True
+        t.save()
+        op.propagate_cancel(True)
+        self.assertAlmostEqual(check().fuzzy_qty, 0)
+
+        stockitem = reload(self.stockitem)
+        stockitem.price = 2
+        stockitem.unit_factor = 2
+        stockitem.save()
+        self.assertAlmostEqual(check().fuzzy_price, 1.2)
+
+        sellitem = reload(self.sellitem)
+        sellitem.tax = 0.5
+        sellitem.save()
+        self.assertAlmostEqual(check().fuzzy_price, 1.5)
+
+    def test_fuzzy_values(self):
+        # The aggregates must not be resolved against each other, whatever their order
+        StockItem.objects.filter(pk=self.stockitem.pk).update(qty=4, unit_factor=2)
+        values = fuzzy_values(SellItem, StockItem, [self.sellitem.pk, self.sellitem2.pk], {self.sellitem.pk: 0.2, self.sellitem2.pk: 0.1})
+        self.assertAlmostEqual(values[self.sellitem.pk][0], 8)
+        self.assertAlmostEqual(values[self.sellitem.pk][1], 0.6)
+        self.assertEqual(values[self.sellitem2.pk], (0, 0))
+
+    def test_list_queries(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/sellitem/?bar=barjone')
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        n = count_queries()
+        for i in range(3):
+            sellitem = SellItem.objects.create(bar=self.bar, name="Glace %d" % i)
+            details = ItemDetails.objects.create(name="Glace %d" % i)
+            StockItem.objects.create(bar=self.bar, sellitem=sellitem, details=details, price=2)
+        self.assertEqual(count_queries(), n)
 
 
 class ItemDetailsTests(ItemTests, AutoTestMixin):
@@ -1,10 +1,12 @@
 from django.db import models
+from django.db.models.signals import post_delete
 from rest_framework import serializers, viewsets, filters
 
-from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, CurrentUserCreateOnlyDefault
+from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, CurrentUserCreateOnlyDefault, ConditionalGetMixin
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
+from bars_core.models.tombstone import record_deletion
 
 
 @permission_logic(BarRolePermissionLogic())
@@ -17,7 +19,7 @@ class News(models.Model):
     text = models.TextField()
 
     timestamp = models.DateTimeField(auto_now_add=True)
-    last_modified = models.DateTimeField(auto_now=True)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     deleted = models.BooleanField(default=False)
 
@@ -25,6 +27,9 @@ class News(models.Model):
         return self.name
 
 
+post_delete.connect(record_deletion, sender=News)
+
+
 class NewsSerializer(serializers.ModelSerializer):
     class Meta:
         model = News
@@ -44,7 +49,7 @@ class NewsFilterBackend(filters.BaseFilterBackend):
             return queryset
 
 
-class NewsViewSet(viewsets.ModelViewSet):
+class NewsViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = News.objects.all()
     serializer_class = NewsSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from bars_stats.models import build_daily_stats
+
+
+def backfill(apps, schema_editor):
+    build_daily_stats(apps.get_model('bars_transactions', 'AccountOperation'), apps.get_model('bars_stats', 'AccountDailyStat'), 'account')
+    build_daily_stats(apps.get_model('bars_transactions', 'ItemOperation'), apps.get_model('bars_stats', 'ItemDailyStat'), 'stockitem')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0008_auto_20150913_2047'),
+        ('bars_core', '0020_auto_20151116_1253'),
+        ('bars_transactions', '0004_transaction_bar_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountDailyStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('type', models.CharField(max_length=25)),
+                ('total', models.FloatField(default=0)),
+                ('account', models.ForeignKey(to='bars_core.Account')),
+                ('bar', models.ForeignKey(to='bars_core.Bar')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ItemDailyStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('type', models.CharField(max_length=25)),
+                ('total', models.FloatField(default=0)),
+                ('bar', models.ForeignKey(to='bars_core.Bar')),
+                ('stockitem', models.ForeignKey(to='bars_items.StockItem')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='itemdailystat',
+            unique_together=set([('stockitem', 'type', 'day')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='itemdailystat',
+            index_together=set([('bar', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='accountdailystat',
+            unique_together=set([('account', 'type', 'day')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='accountdailystat',
+            index_together=set([('bar', 'day')]),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,120 @@
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Case, When
+
+from bars_core.models.bar import Bar
+from bars_core.models.account import Account
+from bars_items.models.stockitem import StockItem
+
+
+class DailyStat(models.Model):
+    """Sum of the deltas of the non-canceled operations of a day on a target, per transaction type."""
+    class Meta:
+        abstract = True
+    bar = models.ForeignKey(Bar)
+    day = models.DateField()
+    type = models.CharField(max_length=25)
+    total = models.FloatField(default=0)
+
+
+class AccountDailyStat(DailyStat):
+    class Meta:
+        app_label = 'bars_stats'
+        unique_together = ('account', 'type', 'day')
+        index_together = [('bar', 'day')]
+    account = models.ForeignKey(Account)
+
+    target_field = 'account'
+
+
+class ItemDailyStat(DailyStat):
+    class Meta:
+        app_label = 'bars_stats'
+        unique_together = ('stockitem', 'type', 'day')
+        index_together = [('bar', 'day')]
+    stockitem = models.ForeignKey(StockItem)
+
+    target_field = 'stockitem'
+
+
+stat_models = {
+    Account: AccountDailyStat,
+    StockItem: ItemDailyStat,
+}
+
+
+def record_operations(operations):
+    """Adds deltas to the daily rows of operations, given as a list of (operation, delta)."""
+    totals = {}
+    for op, delta in operations:
+        t = op.transaction
+        key = (stat_models[op.op_model], t.timestamp.date(), t.type, op.target_id)
+        bar, total = totals.get(key, (t.bar_id, 0))
+        totals[key] = (bar, total + delta)
+
+    for model in set(key[0] for key in totals):
+        rows = dict((key[1:], value) for key, value in totals.items() if key[0] is model and value[1] != 0)
+        if rows:
+            _add_to_rows(model, rows)
+
+
+def _add_to_rows(model, rows):
+    """Adds to existing rows with a single UPDATE, and creates the missing ones in bulk."""
+    target_id = model.target_field + '_id'
+    existing = (model.objects
+                .filter(day__in=set(k[0] for k in rows), type__in=set(k[1] for k in rows))
+                .filter(**{target_id + '__in': set(k[2] for k in rows)})
+                .values_list('pk', 'day', 'type', target_id))
+    pks = dict(((day, type, target), pk) for pk, day, type, target in existing)
+
+    updated = [(pks[key], rows[key][1]) for key in rows if key in pks]
+    for i in range(0, len(updated), 200):
+        chunk = updated[i:i + 200]
+        model.objects.filter(pk__in=[pk for pk, _ in chunk]).update(
+            total=Case(*[When(pk=pk, then=F('total') + delta) for pk, delta in chunk], default=F('total')))
+
+    missing = [key for key in rows if key not in pks]
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([
+                model(bar_id=rows[key][0], day=key[0], type=key[1], total=rows[key][1], **{target_id: key[2]})
+                for key in missing
+            ], batch_size=100)
+    except IntegrityError:
+        # Some rows were created concurrently
+        for key in missing:
+            _add_to_row(model, key, *rows[key])
+
+
+def _add_to_row(model, key, bar, delta):
+    day, type, target = key
+    rows = model.objects.filter(day=day, type=type, **{model.target_field: target})
+    if rows.update(total=F('total') + delta):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(bar_id=bar, day=day, type=type, total=delta, **{model.target_field + '_id': target})
+    except IntegrityError:
+        rows.update(total=F('total') + delta)
+
+
+def build_daily_stats(operation_model, stat_model, target_field, targets=None):
+    """Recomputes every row of stat_model from scratch, or only the rows of targets if given.
+
+    Takes the models as arguments so that it can be run from a migration.
+    """
+    totals = {}
+    ops = operation_model.objects.filter(transaction__canceled=False)
+    rows = stat_model.objects.all()
+    if targets is not None:
+        ops = ops.filter(target__in=targets)
+        rows = rows.filter(**{target_field + '__in': targets})
+    ops = ops.values_list('transaction__bar', 'transaction__timestamp', 'transaction__type', 'target', 'delta')
+    for bar, timestamp, type, target, delta in ops.iterator():
+        key = (bar, timestamp.date(), type, target)
+        totals[key] = totals.get(key, 0) + delta
+
+    rows.delete()
+    stat_model.objects.bulk_create([
+        stat_model(bar_id=bar, day=day, type=type, total=total, **{target_field + '_id': target})
+        for (bar, day, type, target), total in totals.items()
+    ], batch_size=100)
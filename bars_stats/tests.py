@@ -0,0 +1,115 @@
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.account import Account
+
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation
+from bars_stats.models import AccountDailyStat, ItemDailyStat, build_daily_stats
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+
+class DailyStatTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(DailyStatTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.user, _ = User.objects.get_or_create(username='user')
+
+        self.sellitem, _ = SellItem.objects.get_or_create(bar=self.bar, name="Chocolat")
+        self.itemdetails, _ = ItemDetails.objects.get_or_create(name="Chocolat")
+
+    def setUp(self):
+        self.account = Account.objects.create(bar=self.bar, owner=self.user, money=100)
+        self.stockitem = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem, details=self.itemdetails, price=1, qty=10, unit_factor=2)
+        self.today = timezone.now().date()
+
+    def make_aop(self, type, delta):
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type=type)
+        return t.accountoperation_set.create(target=reload(self.account), delta=delta)
+
+    def make_iop(self, **kwargs):
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type='inventory' if kwargs.get('fixed') else 'buy')
+        return reload(self.stockitem).create_operation(transaction=t, **kwargs)
+
+    def account_stats(self):
+        return dict(AccountDailyStat.objects.filter(account=self.account).values_list('type', 'total'))
+
+    def item_stats(self):
+        return dict(ItemDailyStat.objects.filter(stockitem=self.stockitem).values_list('type', 'total'))
+
+
+    def test_operations_are_recorded(self):
+        self.make_aop('deposit', 10)
+        self.make_aop('buy', -3)
+        self.make_aop('buy', -2)
+
+        self.assertEqual(self.account_stats(), {'deposit': 10, 'buy': -5})
+        self.assertEqual(AccountDailyStat.objects.get(account=self.account, type='buy').day, self.today)
+
+    def test_cancel_and_restore(self):
+        self.make_aop('buy', -3)
+        aop = self.make_aop('buy', -2)
+
+        aop.transaction.set_canceled(True)
+        self.assertEqual(self.account_stats(), {'buy': -3})
+
+        aop.transaction.set_canceled(False)
+        self.assertEqual(self.account_stats(), {'buy': -5})
+
+    def test_fixed_operation_absorbs_cancel(self):
+        iop = self.make_iop(delta=-2)
+        self.make_iop(next_value=4, fixed=True)
+        self.assertEqual(self.item_stats(), {'buy': -2, 'inventory': -4})
+
+        iop.transaction.set_canceled(True)
+        self.assertEqual(self.item_stats(), {'buy': 0, 'inventory': -6})
+
+    def test_same_result_as_rebuild(self):
+        ops = [self.make_iop(delta=-1), self.make_iop(next_value=8, fixed=True), self.make_iop(delta=-3)]
+        self.make_aop('deposit', 10)
+        ops[0].transaction.set_canceled(True)
+        ops[2].transaction.set_canceled(True)
+        ops[0].transaction.set_canceled(False)
+
+        stats = self.item_stats()
+        build_daily_stats(ItemOperation, ItemDailyStat, 'stockitem')
+        self.assertEqual(self.item_stats(), {k: v for k, v in stats.items() if v != 0})
+
+        stats = self.account_stats()
+        build_daily_stats(AccountOperation, AccountDailyStat, 'account')
+        self.assertEqual(self.account_stats(), stats)
+
+    def test_stats_endpoints(self):
+        self.make_aop('deposit', 10)
+        self.make_aop('buy', -3)
+        self.make_iop(delta=-2)
+        day = self.today.strftime('%Y-%m-%d')
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.get('/account/%d/stats/?bar=barjone' % self.account.id)
+        self.assertEqual(response.data, [(day, 7)])
+        response = self.client.get('/user/%d/stats/?bar=barjone&type=buy' % self.user.id)
+        self.assertEqual(response.data, [(day, -3)])
+        response = self.client.get('/stockitem/%d/stats/?bar=barjone&interval=months' % self.stockitem.id)
+        self.assertEqual(response.data, [(self.today.strftime('%Y-%m-01'), -4)])
+        response = self.client.get('/sellitem/%d/stats/?bar=barjone&date_start=%s' % (self.sellitem.id, day))
+        self.assertEqual(response.data, [(day, -4)])
+
+    def test_stats_same_as_raw_path(self):
+        self.make_aop('deposit', 10)
+        self.make_aop('buy', -3)
+        day = self.today.strftime('%Y-%m-%d')
+
+        # A date range that is not made of whole days is served from the transactions
+        for query in ('date_start=%s' % day, 'date_start=%sT00:00:00' % day):
+            response = self.client.get('/account/%d/stats/?bar=barjone&%s' % (self.account.id, query))
+            self.assertEqual(response.data, [(day, 7)])
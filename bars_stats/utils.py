@@ -69,6 +69,7 @@ def _get_interval_sql(date_field, interval, engine):
 # Inspired from https://github.com/kmike/django-qsstats-magic
 from datetime import datetime
 from django.db.models import Count, Sum, F
+from django.utils.dateparse import parse_date
 from bars_transactions.models import Transaction
 from bars_core.models.bar import Bar
 from bars_core.models.account import Account
@@ -85,7 +86,46 @@ def time_series(qs, date_field, aggregate=None, interval='days', engine=None):
     return [(x['agg_date'], x['agg']) for x in aggregate_data]
 
 
-def compute_transaction_stats(request, filter=id, aggregate=None):
+ROLLUP_INTERVALS = ('days', 'weeks', 'months', 'years')
+
+def compute_rollup_stats(request, qs, aggregate, interval):
+    """Computes the stats from the daily rollup tables of bars_stats.models.
+
+    Returns None when the requested date range does not fall on day boundaries.
+    """
+    if request.bar:
+        qs = qs.filter(bar=request.bar)
+
+    date_start = request.query_params.get('date_start')
+    date_end = request.query_params.get('date_end')
+    if date_start is not None:
+        start = parse_date(date_start)
+        end = parse_date(date_end) if date_end is not None else None
+        if start is None or (date_end is not None and end is None):
+            return None
+        qs = qs.filter(day__gte=start)
+        if end is not None:
+            qs = qs.filter(day__lt=end)
+
+    types = request.query_params.getlist("type")
+    if len(types) != 0:
+        qs = qs.filter(type__in=types)
+
+    result = time_series(qs, date_field='day', interval=interval, aggregate=aggregate)
+    return sorted(result)
+
+def compute_transaction_stats(request, filter=id, aggregate=None, rollup=None):
+    """Computes the stats of the transactions selected by filter.
+
+    rollup is an optional (queryset, aggregate) pair over a daily stats table,
+    used instead of the transactions for intervals of at least a day.
+    """
+    interval = request.query_params.get('interval', 'days')
+    if rollup is not None and interval in ROLLUP_INTERVALS:
+        result = compute_rollup_stats(request, rollup[0], rollup[1], interval)
+        if result is not None:
+            return result
+
     qs = Transaction.objects.filter(canceled=False)
     qs = filter(qs)
 
@@ -103,7 +143,6 @@ def compute_transaction_stats(request, filter=id, aggregate=None):
 
     qs = qs.order_by('-timestamp', '-id').distinct()
 
-    interval = request.query_params.get('interval', 'days')
     result = time_series(qs, date_field='timestamp', interval=interval, aggregate=aggregate)
     return sorted(result)
 
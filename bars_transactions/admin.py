@@ -1,6 +1,8 @@
 from django.contrib import admin
-from bars_transactions.models import Transaction, AccountOperation, ItemOperation
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, IdempotencyKey, AccountSnapshot
 
 admin.site.register(Transaction)
 admin.site.register(AccountOperation)
 admin.site.register(ItemOperation)
+admin.site.register(IdempotencyKey)
+admin.site.register(AccountSnapshot)
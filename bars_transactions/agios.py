@@ -0,0 +1,94 @@
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Q, F, Case, When
+from django.utils import timezone
+
+from bars_core.models.bar import get_bar_settings
+from bars_core.models.user import get_default_user
+from bars_core.models.account import Account
+from bars_core.models.outbox import OutboxMail
+from bars_transactions.models import Transaction, AccountOperation
+from bars_stats.models import record_operations
+
+
+def eligible_accounts(bar, today):
+    """Returns the accounts of a bar that have to pay agios today."""
+    bar_settings = get_bar_settings(bar.id)
+    if not bar_settings.agios_enabled:
+        return Account.objects.none()
+
+    limit = today - timedelta(bar_settings.agios_threshold)
+    overdrawn = Q(overdrawn_since__lte=limit)
+    if limit >= today:
+        # Accounts overdrawn since today, when the dates were not updated (dry run)
+        overdrawn |= Q(overdrawn_since__isnull=True)
+    return Account.objects.filter(overdrawn, bar=bar, deleted=False, money__lt=0)
+
+
+def apply_agios(bar, dry_run=False):
+    """Charges agios to every eligible account of a bar, in a constant number of queries.
+
+    Returns the list of (account, amount) charged; accounts hold their balance
+    after the agios. Notification mails are queued in the outbox.
+    With dry_run, nothing is written.
+    """
+    today = date.today()
+    factor = get_bar_settings(bar.id).agios_factor
+    accounts = Account.objects.filter(bar=bar, deleted=False)
+    # Rounds money to cents, like operations do
+    clean = AccountOperation._meta.get_field('delta').to_python
+
+    if dry_run:
+        return [(a, clean(abs(a.money) * factor)) for a in eligible_accounts(bar, today).select_related('owner')]
+
+    with transaction.atomic():
+        now = timezone.now()
+        accounts.filter(money__gte=0, overdrawn_since__isnull=False).update(overdrawn_since=None, last_modified=now)
+        accounts.filter(money__lt=0, overdrawn_since__isnull=True).update(overdrawn_since=today, last_modified=now)
+
+        charges = [(a, clean(abs(a.money) * factor))
+                   for a in eligible_accounts(bar, today).select_related('owner').select_for_update().order_by('pk')]
+        if not charges:
+            return []
+
+        # Ids are not returned by bulk_create on every backend, so they are given explicitly.
+        # Locking the last transaction keeps concurrent inserts from taking the ids that follow it
+        author = get_default_user()
+        last = Transaction.objects.select_for_update().order_by('-pk').values_list('pk', flat=True).first() or 0
+        transactions = [Transaction(id=last + 1 + i, bar=bar, author=author, type='agios', moneyflow=-amount)
+                        for i, (_, amount) in enumerate(charges)]
+        Transaction.objects.bulk_create(transactions, batch_size=100)
+
+        aops = []
+        for t, (account, amount) in zip(transactions, charges):
+            next_value = clean(account.money - amount)
+            aops.append(AccountOperation(transaction=t, target=account,
+                                         prev_value=account.money, delta=-amount, next_value=next_value))
+            account.money = next_value
+        AccountOperation.objects.bulk_create(aops, batch_size=100)
+
+        for i in range(0, len(charges), 200):
+            chunk = charges[i:i + 200]
+            Account.objects.filter(pk__in=[a.pk for a, _ in chunk]).update(
+                last_modified=now,
+                money=Case(*[When(pk=a.pk, then=F('money') - amount) for a, amount in chunk], default=F('money')))
+
+        record_operations([(aop, aop.delta) for aop in aops])
+        OutboxMail.objects.bulk_create(agios_mails(bar, charges), batch_size=100)
+
+    return charges
+
+
+def agios_mails(bar, charges):
+    """Returns the (unsaved) notification mails for the agios charged by apply_agios."""
+    from bars_transactions.serializers import agios_notification_mail
+    mails = []
+    for account, amount in charges:
+        if account.owner.email:
+            mails.append(OutboxMail(
+                subject=agios_notification_mail['subject'],
+                message=agios_notification_mail['message'].format(amount=amount, solde=account.money, bar=bar.name),
+                from_email="babe@eleves.polytechnique.fr",
+                recipients=account.owner.email))
+    return mails
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_transactions', '0003_transaction_moneyflow'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('bar', 'timestamp', 'id')]),
+        ),
+    ]
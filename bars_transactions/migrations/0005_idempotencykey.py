@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('bars_transactions', '0004_transaction_bar_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=100)),
+                ('timestamp', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('author', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+                ('transaction', models.ForeignKey(to='bars_transactions.Transaction', null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='idempotencykey',
+            unique_together=set([('author', 'key')]),
+        ),
+    ]
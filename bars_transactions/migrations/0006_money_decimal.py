@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import F, Func
+import bars_django.utils
+
+
+def round_money(apps, schema_editor):
+    # Some databases do not round the existing values when changing the column type
+    def round(field):
+        return Func(F(field), 2, function='ROUND', output_field=models.FloatField())
+
+    AccountOperation = apps.get_model('bars_transactions', 'AccountOperation')
+    AccountOperation.objects.update(prev_value=round('prev_value'), delta=round('delta'), next_value=round('next_value'))
+    Transaction = apps.get_model('bars_transactions', 'Transaction')
+    Transaction.objects.update(moneyflow=round('moneyflow'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_transactions', '0005_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accountoperation',
+            name='delta',
+            field=bars_django.utils.MoneyField(max_digits=12, decimal_places=2),
+        ),
+        migrations.AlterField(
+            model_name='accountoperation',
+            name='next_value',
+            field=bars_django.utils.MoneyField(max_digits=12, decimal_places=2),
+        ),
+        migrations.AlterField(
+            model_name='accountoperation',
+            name='prev_value',
+            field=bars_django.utils.MoneyField(max_digits=12, decimal_places=2),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='moneyflow',
+            field=bars_django.utils.MoneyField(default=0, max_digits=12, decimal_places=2),
+        ),
+        migrations.RunPython(round_money, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import bars_django.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_core', '0023_money_decimal'),
+        ('bars_transactions', '0006_money_decimal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('timestamp', models.DateTimeField()),
+                ('balance', bars_django.utils.MoneyField(max_digits=12, decimal_places=2)),
+                ('account', models.ForeignKey(to='bars_core.Account')),
+                ('operation', models.ForeignKey(to='bars_transactions.AccountOperation')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='accountsnapshot',
+            index_together=set([('account', 'timestamp', 'operation')]),
+        ),
+    ]
@@ -1,11 +1,16 @@
-from django.db import models
-from bars_django.utils import VirtualField, permission_logic
+from itertools import chain
+from django.db import models, transaction as db_transaction
+from django.db.models import Q, F, Case, When
+from django.utils import timezone
+from bars_django.utils import VirtualField, MoneyField, permission_logic
 from bars_core.perms import BarRolePermissionLogic
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_items.models.stockitem import StockItem
+from bars_items.models.sellitem import refresh_fuzzy
 from bars_core.models.account import Account
 from bars_transactions.perms import TransactionAuthorPermissionLogic
+from bars_stats.models import record_operations
 
 
 @permission_logic(BarRolePermissionLogic())
@@ -13,6 +18,7 @@ from bars_transactions.perms import TransactionAuthorPermissionLogic
 class Transaction(models.Model):
     class Meta:
         app_label = 'bars_transactions'
+        index_together = [('bar', 'timestamp', 'id')]
     bar = models.ForeignKey(Bar)
     author = models.ForeignKey(User)
     type = models.CharField(max_length=25)
@@ -20,7 +26,7 @@ class Transaction(models.Model):
     canceled = models.BooleanField(default=False)
     last_modified = models.DateTimeField(auto_now=True)
     _type = VirtualField("Transaction")
-    moneyflow = models.FloatField(default=0)
+    moneyflow = MoneyField(default=0)
 
     def __unicode__(self):
         return self.type + ": " \
@@ -28,6 +34,15 @@ class Transaction(models.Model):
                       + list(self.itemoperation_set.all())
                       + list(self.transactiondata_set.all()))
 
+    def set_canceled(self, canceled):
+        if self.canceled == canceled:
+            return
+        self.canceled = canceled
+        self.save()
+
+        for op in chain(self.accountoperation_set.all(), self.itemoperation_set.all()):
+            op.propagate_cancel(canceled)
+
     def check_integrity(self):
         t = self.type
         iops = self.itemoperation_set.all()
@@ -99,14 +114,43 @@ class TransactionData(models.Model):
     data = models.TextField()
 
 
+class IdempotencyKey(models.Model):
+    """A key given by a client with a transaction, so that resubmitting it does not create it twice.
+
+    The key is saved before the transaction is created: a concurrent submission
+    of the same key then waits on the unique index instead of creating a duplicate.
+    """
+    class Meta:
+        app_label = 'bars_transactions'
+        unique_together = ('author', 'key')
+    author = models.ForeignKey(User)
+    key = models.CharField(max_length=100)
+    transaction = models.ForeignKey(Transaction, null=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+def lock_targets(op_model, ids):
+    """Locks the given rows, in pk order.
+
+    Operations lock their target when they are created; a transaction with several
+    targets locks them all beforehand, so that two transactions sharing targets
+    always lock them in the same order and cannot deadlock.
+    Stock items are locked before accounts.
+    """
+    ids = set(ids)
+    if len(ids) > 1:
+        list(op_model.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk', flat=True))
+
+
 class BaseOperation(models.Model):
     class Meta:
         abstract = True
     transaction = models.ForeignKey(Transaction)
-    prev_value = models.FloatField()
     fixed = models.BooleanField(default=False)  # Whether the operation was a delta or a fixed value
-    delta = models.FloatField()  # Fixed if not self.fixed
-    next_value = models.FloatField()  # Fixed if self.fixed
+    # Subclasses define prev_value, delta (fixed if not self.fixed) and next_value (fixed if self.fixed)
 
     def __unicode__(self):
         if self.fixed:
@@ -115,18 +159,79 @@ class BaseOperation(models.Model):
             return unicode(self.target) + "+=" + unicode(self.delta)
 
     def save(self, *args, **kwargs):
-        if not self.pk:
-            self.prev_value = getattr(self.target, self.op_model_field)
-
-        if self.fixed:
-            self.delta = self.next_value - self.prev_value
-        else:
-            self.next_value = self.prev_value + self.delta
+        # Rounds money to cents
+        clean = self._meta.get_field('delta').to_python
 
-        if not self.pk:
-            self.op_model.objects.filter(pk=self.target.id).update(**{self.op_model_field: self.next_value})
-
-        super(BaseOperation, self).save(*args, **kwargs)
+        if self.pk:
+            if self.fixed:
+                self.delta = clean(self.next_value - self.prev_value)
+            else:
+                self.next_value = clean(self.prev_value + self.delta)
+            return super(BaseOperation, self).save(*args, **kwargs)
+
+        # The value of the target is read from the database under a row lock, not from
+        # self.target that may be stale, and deltas are applied in the database,
+        # so that concurrent operations on the same target cannot lose an update
+        field = self.op_model_field
+        with db_transaction.atomic():
+            target = self.op_model.objects.filter(pk=self.target_id)
+            self.prev_value = target.select_for_update().values_list(field, flat=True).get()
+            if self.fixed:
+                self.next_value = clean(self.next_value)
+                self.delta = clean(self.next_value - self.prev_value)
+                value = self.next_value
+            else:
+                self.delta = clean(self.delta)
+                self.next_value = clean(self.prev_value + self.delta)
+                value = F(field) + self.delta
+            target.update(last_modified=timezone.now(), **{field: value})
+            setattr(self.target, field, self.next_value)
+
+            super(BaseOperation, self).save(*args, **kwargs)
+
+            if not self.transaction.canceled:
+                record_operations([(self, self.delta)])
+
+    @classmethod
+    def bulk_create_operations(cls, transaction, deltas, **kwargs):
+        """Creates the operations of transaction adding each delta to its target, given as a list of (target, delta).
+
+        Does what save() does for each of them, with a constant number of queries: the
+        targets are read under a row lock in one query, their values are updated in
+        a single UPDATE and the operations are inserted with bulk_create.
+        """
+        if not deltas:
+            return []
+        clean = cls._meta.get_field('delta').to_python
+        field = cls.op_model_field
+        with db_transaction.atomic():
+            values = dict(cls.op_model.objects.select_for_update()
+                          .filter(pk__in=set(target.pk for target, _ in deltas))
+                          .order_by('pk').values_list('pk', field))
+            shifts = {}
+            operations = []
+            for target, delta in deltas:
+                delta = clean(delta)
+                prev_value = values[target.pk]
+                next_value = clean(prev_value + delta)
+                values[target.pk] = next_value
+                shifts[target.pk] = shifts.get(target.pk, 0) + delta
+                setattr(target, field, next_value)
+                operations.append(cls(transaction=transaction, target=target, prev_value=prev_value,
+                                      delta=delta, next_value=next_value, **kwargs))
+
+            shifts = list(shifts.items())
+            for i in range(0, len(shifts), 200):
+                chunk = shifts[i:i + 200]
+                cls.op_model.objects.filter(pk__in=[pk for pk, _ in chunk]).update(
+                    last_modified=timezone.now(),
+                    **{field: Case(*[When(pk=pk, then=F(field) + shift) for pk, shift in chunk],
+                                   default=F(field), output_field=cls.op_model._meta.get_field(field))})
+            cls.objects.bulk_create(operations, batch_size=100)
+
+            if not transaction.canceled:
+                record_operations([(op, op.delta) for op in operations])
+        return operations
 
     def propagate(self):
         olders_or_self = (self.__class__.objects.select_related()
@@ -145,21 +250,158 @@ class BaseOperation(models.Model):
             else:
                 next_prev = op.next_value
 
-        self.op_model.objects.filter(pk=self.target.id).update(**{self.op_model_field: next_prev})
+        self.op_model.objects.filter(pk=self.target.id).update(last_modified=timezone.now(), **{self.op_model_field: next_prev})
+
+    def propagate_cancel(self, canceled):
+        # The delta of a fixed operation may have been changed by a previous shift
+        delta = self.__class__.objects.values_list('delta', flat=True).get(pk=self.pk)
+        shift = -delta if canceled else delta
+        anchor = self.shift_later(shift)
+
+        stats = [(self, shift)]
+        if anchor is not None:
+            stats.append((anchor, -shift))
+        record_operations(stats)
+        return anchor
+
+    def shift_later(self, shift):
+        """Shifts the value of the target by `shift` from this operation on.
+
+        Every later operation is shifted in a single UPDATE, up to the first later
+        fixed operation that is not canceled: that one absorbs the shift in its delta,
+        and the value of the target is left untouched. Returns that operation, if any.
+        """
+        if shift == 0:
+            return None
+
+        ts = self.transaction.timestamp
+        later = (self.__class__.objects
+                 .filter(target=self.target_id)
+                 .filter(Q(transaction__timestamp__gt=ts) | Q(transaction__timestamp=ts, pk__gt=self.pk)))
+
+        anchor = (later.filter(fixed=True, transaction__canceled=False)
+                  .select_related('transaction')
+                  .order_by('transaction__timestamp', 'pk')
+                  .first())
+        if anchor is not None:
+            anchor_ts = anchor.transaction.timestamp
+            later = later.filter(Q(transaction__timestamp__lt=anchor_ts) | Q(transaction__timestamp=anchor_ts, pk__lte=anchor.pk))
+
+        later.update(
+            prev_value=F('prev_value') + shift,
+            delta=Case(When(fixed=True, then=F('delta') - shift), default=F('delta')),
+            next_value=Case(When(fixed=True, then=F('next_value')), default=F('next_value') + shift))
+
+        if anchor is None:
+            field = self.op_model_field
+            self.op_model.objects.filter(pk=self.target_id).update(last_modified=timezone.now(), **{field: F(field) + shift})
+
+        return anchor
 
 class ItemOperation(BaseOperation):
     class Meta:
         app_label = 'bars_transactions'
     target = models.ForeignKey(StockItem)
+    prev_value = models.FloatField()
+    delta = models.FloatField()
+    next_value = models.FloatField()
     fuzzy = models.BooleanField(default=False)
 
     op_model = StockItem
     op_model_field = 'qty'
 
+    # The sellitem of the target keeps its quantity and price denormalized
+    def save(self, *args, **kwargs):
+        created = not self.pk
+        super(ItemOperation, self).save(*args, **kwargs)
+        if created:
+            refresh_fuzzy([self.target.sellitem_id])
+
+    @classmethod
+    def bulk_create_operations(cls, transaction, deltas, **kwargs):
+        operations = super(ItemOperation, cls).bulk_create_operations(transaction, deltas, **kwargs)
+        refresh_fuzzy([target.sellitem_id for target, _ in deltas])
+        return operations
+
+    def propagate(self):
+        super(ItemOperation, self).propagate()
+        refresh_fuzzy([self.target.sellitem_id])
+
+    def shift_later(self, shift):
+        anchor = super(ItemOperation, self).shift_later(shift)
+        if shift != 0 and anchor is None:
+            refresh_fuzzy([self.target.sellitem_id])
+        return anchor
+
 class AccountOperation(BaseOperation):
     class Meta:
         app_label = 'bars_transactions'
     target = models.ForeignKey(Account)
+    prev_value = MoneyField()
+    delta = MoneyField()
+    next_value = MoneyField()
 
     op_model = Account
     op_model_field = 'money'
+
+    def propagate(self):
+        # Every operation from this one on may be rewritten
+        AccountSnapshot.objects.filter(account=self.target_id, timestamp__gte=self.transaction.timestamp).delete()
+        super(AccountOperation, self).propagate()
+
+    def shift_later(self, shift):
+        anchor = super(AccountOperation, self).shift_later(shift)
+        if shift != 0:
+            ts = self.transaction.timestamp
+            snapshots = (AccountSnapshot.objects
+                         .filter(account=self.target_id)
+                         .filter(Q(timestamp__gt=ts) | Q(timestamp=ts, operation__gte=self.pk)))
+            if anchor is not None:
+                anchor_ts = anchor.transaction.timestamp
+                snapshots = snapshots.filter(Q(timestamp__lt=anchor_ts) | Q(timestamp=anchor_ts, operation__lt=anchor.pk))
+            snapshots.update(balance=F('balance') + shift)
+        return anchor
+
+
+class AccountSnapshot(models.Model):
+    """The balance of an account right after one of its operations.
+
+    Snapshots are taken periodically by scripts/snapshot_balances.py, so that
+    balance_at() only has to look at the operations since the last one.
+    timestamp is the timestamp of the transaction of the operation.
+    """
+    class Meta:
+        app_label = 'bars_transactions'
+        index_together = [('account', 'timestamp', 'operation')]
+    account = models.ForeignKey(Account)
+    operation = models.ForeignKey(AccountOperation)
+    timestamp = models.DateTimeField()
+    balance = MoneyField()
+
+    def __unicode__(self):
+        return "%s: %s" % (self.timestamp, self.balance)
+
+
+def balance_at(account_id, timestamp):
+    """Returns the balance of an account at the given time."""
+    snapshot = (AccountSnapshot.objects
+                .filter(account=account_id, timestamp__lte=timestamp)
+                .order_by('-timestamp', '-operation')
+                .first())
+    ops = AccountOperation.objects.filter(target=account_id)
+    tail = ops.filter(transaction__timestamp__lte=timestamp)
+    if snapshot is not None:
+        tail = tail.filter(Q(transaction__timestamp__gt=snapshot.timestamp) | Q(transaction__timestamp=snapshot.timestamp, pk__gt=snapshot.operation_id))
+
+    last = tail.order_by('-transaction__timestamp', '-pk').values_list('prev_value', 'next_value', 'transaction__canceled').first()
+    if last is not None:
+        prev_value, next_value, canceled = last
+        return prev_value if canceled else next_value
+    if snapshot is not None:
+        return snapshot.balance
+
+    # Before the first operation
+    first = ops.order_by('transaction__timestamp', 'pk').values_list('prev_value', flat=True).first()
+    if first is not None:
+        return first
+    return Account.objects.values_list('money', flat=True).get(pk=account_id)
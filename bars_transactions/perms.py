@@ -1,7 +1,8 @@
 from datetime import timedelta
 from django.utils import timezone
 from permission.logics import AuthorPermissionLogic
-from bars_core.perms import debug_perm
+from bars_core.perms import debug_perm, get_bar_perms
+from bars_core.models.bar import get_bar_settings
 
 class TransactionAuthorPermissionLogic(AuthorPermissionLogic):
     @debug_perm("Logic (transaction)")
@@ -10,8 +11,33 @@ class TransactionAuthorPermissionLogic(AuthorPermissionLogic):
             return False
 
         if obj is not None and perm == 'bars_transactions.change_transaction':
-            threshold = obj.bar.settings.transaction_cancel_threshold
+            threshold = get_bar_settings(obj.bar_id).transaction_cancel_threshold
             if timezone.now() - obj.timestamp > timedelta(hours=threshold):
                 return False
 
         return super(TransactionAuthorPermissionLogic, self).has_perm(user, perm, obj)
+
+
+def cancel_checker(user):
+    """Returns a function telling whether user can cancel a given transaction.
+
+    It answers like user.has_perm('bars_transactions.change_transaction', t), but
+    the role permissions and the cancel threshold of each bar are looked up once,
+    so that checking a whole list of transactions costs no query per row.
+    """
+    if not user.is_authenticated() or not user.is_active:
+        return lambda t: False
+    if user.is_superuser:
+        return lambda t: True
+
+    now = timezone.now()
+    bars = {}
+
+    def can_cancel(t):
+        if t.bar_id not in bars:
+            threshold = get_bar_settings(t.bar_id).transaction_cancel_threshold
+            has_role = 'bars_transactions.change_transaction' in get_bar_perms(user, t.bar_id)
+            bars[t.bar_id] = (has_role, now - timedelta(hours=threshold))
+        has_role, cutoff = bars[t.bar_id]
+        return has_role or (t.author_id == user.id and t.timestamp >= cutoff)
+    return can_cancel
@@ -1,23 +1,27 @@
 # encoding: utf8
-from django.core.mail import send_mail
+from collections import OrderedDict
 from django.utils import timezone
 
 from django.http import Http404
+from django.db import transaction as db_transaction
 from rest_framework import serializers
 from rest_framework.serializers import ValidationError
 from rest_framework import exceptions
 
 from bars_core.models.user import get_default_user
+from bars_core.models.outbox import queue_mail
 from bars_core.models.account import Account, get_default_account
-from bars_items.models.buyitem import BuyItem, BuyItemPrice
+from bars_items.models.buyitem import BuyItem, BuyItemPrice, set_buyitem_prices
 from bars_items.models.stockitem import StockItem
 from bars_items.models.sellitem import SellItem
-from bars_transactions.models import Transaction
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, lock_targets
+from bars_transactions.perms import cancel_checker
 
 ERROR_MESSAGES = {
     'negative': "%(field)s must be positive",
     'wrong_bar': "%(model)s (id=%(id)d) is in the wrong bar",
-    'deleted': "%(model)s (id=%(id)d) is deleted"
+    'deleted': "%(model)s (id=%(id)d) is deleted",
+    'no_stockitem': "%(model)s (id=%(id)d) has no stockitem in this bar",
 }
 
 class BaseTransactionSerializer(serializers.ModelSerializer):
@@ -26,29 +30,18 @@ class BaseTransactionSerializer(serializers.ModelSerializer):
         read_only_fields = ('bar', 'author', 'timestamp', 'last_modified', 'moneyflow', )
 
     def to_representation(self, transaction):
-        if 'ignore_type' in self.context or transaction.type == "":
-            obj = super(BaseTransactionSerializer, self).to_representation(transaction)
-
-            for a in transaction.author.account_set.all():
-                if a.bar_id == transaction.bar_id:
-                    obj["author_account"] = a.id
-
-            if self.context.get('request') is not None:
-                authed_user = self.context['request'].user
-                obj['can_cancel'] = authed_user.has_perm('bars_transactions.change_transaction', transaction)
-
-            obj['_type'] = "Transaction"
-
-            return obj
-        else:
-            serializer = serializers_class_map[transaction.type](transaction, context=self.context)
-            try:
-                return serializer.data
-            except Exception as e:
-                obj = BaseTransactionSerializer(transaction, context={'ignore_type': True}).data
-                obj['type'] = 'error'
-                obj['error'] = str(e)
-                return obj
+        request = self.context.get('request')
+        if request is None:
+            return render_transaction(transaction)
+        # Shared by all the rows of a list
+        if 'can_cancel' not in self.context:
+            self.context['can_cancel'] = cancel_checker(request.user)
+        return render_transaction(transaction, self.context['can_cancel'])
+
+    def save(self, **kwargs):
+        # A transaction is created with all its operations, or not at all
+        with db_transaction.atomic():
+            return super(BaseTransactionSerializer, self).save(**kwargs)
 
     def create(self, data):
         request = self.context['request']
@@ -120,21 +113,32 @@ class ItemQtySerializer(serializers.Serializer):
 
         elif "sellitem" in data:
             sellitem = data['sellitem']
-            total_qty = sellitem.calc_qty()
-            stockitems = sellitem.stockitems.all()
+            stockitems = list(sellitem.stockitems.all())
+            total_qty = sum(si.sell_qty for si in stockitems)
 
+            # The quantity is split between the stockitems in proportion of their stock
             total_price = 0
-            for si in stockitems.all():
+            deltas = []
+            for si in stockitems:
                 if total_qty != 0:
                     delta = (si.sell_qty * qty) / total_qty
                 else:
-                    delta = qty / stockitems.count()
+                    delta = qty / len(stockitems)
 
-                si.create_operation(delta=-delta, unit='sell', transaction=t, fuzzy=True)
+                deltas.append((si, -delta / si.get_unit('sell')))
                 total_price += delta * si.get_price(unit='sell')
 
+            ItemOperation.bulk_create_operations(t, deltas, fuzzy=True)
             return total_price
 
+    @staticmethod
+    def lock_stockitems(items):
+        ids = [i['stockitem'].id for i in items if 'stockitem' in i]
+        sellitems = [i['sellitem'].id for i in items if 'sellitem' in i]
+        if sellitems:
+            ids += StockItem.objects.filter(sellitem__in=sellitems).values_list('id', flat=True)
+        lock_targets(StockItem, ids)
+
     @staticmethod
     def serializeOperations(iops, force_fuzzy=True):
         stockitems = []
@@ -153,8 +157,43 @@ class ItemQtySerializer(serializers.Serializer):
         return stockitems + list(sellitem_map.values())
 
 
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """A PrimaryKeyRelatedField that looks objects up in `prefetched`, a dict by pk, before querying them."""
+    prefetched = None
+
+    def to_internal_value(self, data):
+        if self.prefetched is not None:
+            try:
+                return self.prefetched[int(data)]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return super(PrefetchedPrimaryKeyRelatedField, self).to_internal_value(data)
+
+
+class PrefetchingListSerializer(serializers.ListSerializer):
+    """Fetches the objects of the `prefetch_field` of all the items of a list with a single query, instead of one per item."""
+    def to_internal_value(self, data):
+        name = self.child.Meta.prefetch_field
+        field = self.child.fields[name]
+        ids = set()
+        if isinstance(data, list):
+            for item in data:
+                try:
+                    ids.add(int(item.get(name)))
+                except (AttributeError, TypeError, ValueError):
+                    pass
+        field.prefetched = field.get_queryset().in_bulk(ids) if ids else {}
+        try:
+            return super(PrefetchingListSerializer, self).to_internal_value(data)
+        finally:
+            field.prefetched = None
+
+
 class BuyItemQtyPriceSerializer(serializers.Serializer):
-    buyitem = serializers.PrimaryKeyRelatedField(queryset=BuyItem.objects.all())
+    class Meta:
+        list_serializer_class = PrefetchingListSerializer
+        prefetch_field = 'buyitem'
+    buyitem = PrefetchedPrimaryKeyRelatedField(queryset=BuyItem.objects.all())
     qty = serializers.FloatField()
     price = serializers.FloatField(required=False)
 
@@ -170,12 +209,15 @@ class BuyItemQtyPriceSerializer(serializers.Serializer):
 
 
 class AccountSerializer(serializers.Serializer):
-    account = serializers.PrimaryKeyRelatedField(queryset=Account.objects.all())
+    class Meta:
+        list_serializer_class = PrefetchingListSerializer
+        prefetch_field = 'account'
+    account = PrefetchedPrimaryKeyRelatedField(queryset=Account.objects.all())
 
     def validate_account(self, account):
         if account.deleted:
             raise ValidationError("Account is deleted")
-        if self.context['request'].bar.id != account.bar.id:
+        if self.context['request'].bar.id != account.bar_id:
             raise serializers.ValidationError("Cannot operate across bars")
         return account
 
@@ -215,16 +257,6 @@ class BuyTransactionSerializer(BaseTransactionSerializer, ItemQtySerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        force_fuzzy = True
-        obj["items"] = ItemQtySerializer.serializeOperations(transaction.itemoperation_set.all(), force_fuzzy)
-
-        return obj
-
 
 class ThrowTransactionSerializer(BaseTransactionSerializer):
     stockitem = serializers.PrimaryKeyRelatedField(queryset=StockItem.objects.all())
@@ -258,18 +290,6 @@ class ThrowTransactionSerializer(BaseTransactionSerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        iop = transaction.itemoperation_set.all()[0]
-        stockitem = iop.target
-        obj["stockitem"] = stockitem.id
-        obj["qty"] = -iop.delta * stockitem.get_unit('sell')
-
-        return obj
-
 
 
 class DepositTransactionSerializer(BaseTransactionSerializer, AccountAmountSerializer):
@@ -288,18 +308,6 @@ class DepositTransactionSerializer(BaseTransactionSerializer, AccountAmountSeria
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        for aop in transaction.accountoperation_set.all():
-            if aop.target.owner != get_default_user():
-                obj["account"] = aop.target.id
-                obj["amount"] = aop.delta
-
-        return obj
-
 
 class WithdrawTransactionSerializer(BaseTransactionSerializer, AccountAmountSerializer):
     def create(self, data):
@@ -317,18 +325,6 @@ class WithdrawTransactionSerializer(BaseTransactionSerializer, AccountAmountSeri
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        for aop in transaction.accountoperation_set.all():
-            if aop.target.owner != get_default_user():
-                obj["account"] = aop.target.id
-                obj["amount"] = -aop.delta
-
-        return obj
-
 
 class GiveTransactionSerializer(BaseTransactionSerializer, AccountAmountSerializer):
     def validate_account(self, account):
@@ -342,8 +338,10 @@ class GiveTransactionSerializer(BaseTransactionSerializer, AccountAmountSerializ
     def create(self, data):
         t = super(GiveTransactionSerializer, self).create(data)
 
+        account = Account.objects.get(owner=t.author, bar=t.bar)
+        lock_targets(Account, [account.id, data["account"].id])
         t.accountoperation_set.create(
-            target=Account.objects.get(owner=t.author, bar=t.bar),
+            target=account,
             delta=-data["amount"])
         t.accountoperation_set.create(
             target=data["account"],
@@ -354,20 +352,6 @@ class GiveTransactionSerializer(BaseTransactionSerializer, AccountAmountSerializ
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        from_op = transaction.accountoperation_set.all()[0]
-        to_op = transaction.accountoperation_set.all()[1]
-        if to_op.target.owner == transaction.author:
-            from_op, to_op = to_op, from_op
-        obj["account"] = to_op.target.id
-        obj["amount"] = to_op.delta
-
-        return obj
-
 
 class RefundTransactionSerializer(BaseTransactionSerializer, AccountAmountSerializer):
     motive = serializers.CharField()
@@ -390,21 +374,6 @@ class RefundTransactionSerializer(BaseTransactionSerializer, AccountAmountSerial
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        for aop in transaction.accountoperation_set.all():
-            if aop.target.owner != get_default_user():
-                obj["account"] = aop.target.id
-                obj["amount"] = aop.delta
-
-        data = transaction.transactiondata_set.all()[0]
-        obj["motive"] = data.data
-
-        return obj
-
 punishement_notification_mail = {
     'subject': "[Chocapix] Notification d'amende",
     'message': u"""
@@ -447,24 +416,10 @@ class PunishTransactionSerializer(BaseTransactionSerializer, AccountAmountSerial
                 cause=data["motive"],
                 bar=account.bar.name
             )
-            send_mail(**message)
+            queue_mail(**message)
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        aop = transaction.accountoperation_set.all()[0]
-        obj["account"] = aop.target.id
-        obj["amount"] = aop.delta
-
-        data = transaction.transactiondata_set.all()[0]
-        obj["motive"] = data.data
-
-        return obj
-
 
 agios_notification_mail = {
     'subject': "[Chocapix] Notification d'agios",
@@ -501,21 +456,10 @@ class AgiosTransactionSerializer(BaseTransactionSerializer, AccountAmountSeriali
                 solde=account.money,
                 bar=account.bar.name
             )
-            send_mail(**message)
+            queue_mail(**message)
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        aop = transaction.accountoperation_set.all()[0]
-        obj["account"] = aop.target.id
-        obj["amount"] = -aop.delta
-
-        return obj
-
 
 class BarInvestmentTransactionSerializer(BaseTransactionSerializer):
     amount = serializers.FloatField()
@@ -536,19 +480,6 @@ class BarInvestmentTransactionSerializer(BaseTransactionSerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        aop = transaction.accountoperation_set.all()[0]
-        obj["amount"] = -aop.delta
-
-        data = transaction.transactiondata_set.all()[0]
-        obj['motive'] = data.data
-
-        return obj
-
 
 
 
@@ -566,6 +497,8 @@ class MealTransactionSerializer(BaseTransactionSerializer):
     def create(self, data):
         t = super(MealTransactionSerializer, self).create(data)
 
+        ItemQtySerializer.lock_stockitems(data["items"])
+
         s = ItemQtySerializer()
         s.context["transaction"] = t
 
@@ -576,10 +509,8 @@ class MealTransactionSerializer(BaseTransactionSerializer):
         total_ratio = 0
         for a in data["accounts"]:
             total_ratio += a["ratio"]
-        for a in data["accounts"]:
-            t.accountoperation_set.create(
-                target=a["account"],
-                delta=-total_price * a["ratio"] / total_ratio)
+        AccountOperation.bulk_create_operations(t, [
+            (a["account"], -total_price * a["ratio"] / total_ratio) for a in data["accounts"]])
 
         t.transactiondata_set.create(
             label='name',
@@ -590,62 +521,59 @@ class MealTransactionSerializer(BaseTransactionSerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        force_fuzzy = True
-        obj["items"] = ItemQtySerializer.serializeOperations(transaction.itemoperation_set.all(), force_fuzzy)
-
-        total_price = 0
-        obj["accounts"] = []
-        aops = transaction.accountoperation_set.all()
-        for aop in aops:
-            total_price += abs(aop.delta)
-        for aop in aops:
-            obj["accounts"].append({
-                'account': aop.target.id,
-                'ratio': abs(aop.delta) / total_price if total_price != 0 else 0
-            })
-
-        data = transaction.transactiondata_set.all()[0]
-        obj[data.label] = data.data
-
-        return obj
-
 
 class ApproTransactionSerializer(BaseTransactionSerializer):
     items = BuyItemQtyPriceSerializer(many=True)
 
+    def validate_items(self, items):
+        # Finds the stockitems of all the buyitems with a single query
+        bar = self.context['request'].bar
+        stockitems = StockItem.objects.filter(bar=bar, details__in=set(i["buyitem"].details_id for i in items))
+        stockitems = dict((si.details_id, si) for si in stockitems)
+
+        errors = []
+        for i in items:
+            buyitem = i["buyitem"]
+            if buyitem.details_id in stockitems:
+                i["stockitem"] = stockitems[buyitem.details_id]
+                errors.append({})
+            else:
+                errors.append({'buyitem': [ERROR_MESSAGES['no_stockitem'] % {'model':'BuyItem', 'id':buyitem.id}]})
+        if any(errors):
+            raise ValidationError(errors)
+        return items
+
     def create(self, data):
         t = super(ApproTransactionSerializer, self).create(data)
 
-        stockitem_map = {}
+        prices = dict(BuyItemPrice.objects
+                      .filter(bar=t.bar, buyitem__in=set(i["buyitem"].id for i in data["items"]))
+                      .values_list('buyitem', 'price'))
+        existing = set(prices)
+        new_prices = {}
+
+        stockitem_map = OrderedDict()
         total = 0
         for i in data["items"]:
             buyitem = i["buyitem"]
             qty = i["qty"]
 
-            priceobj, _ = BuyItemPrice.objects.get_or_create(bar=t.bar, buyitem=buyitem)
             if "price" in i:
-                priceobj.price = i["price"] / qty
-                priceobj.save()
+                prices[buyitem.id] = new_prices[buyitem.id] = i["price"] / qty
                 total += i["price"]
             else:
-                total += priceobj.price * qty
+                if buyitem.id not in prices:
+                    prices[buyitem.id] = new_prices[buyitem.id] = 0
+                total += prices[buyitem.id] * qty
 
-            try:
-                stockitem = StockItem.objects.get(bar=t.bar, details=buyitem.details)
-                if stockitem.id not in stockitem_map:
-                    stockitem_map[stockitem.id] = {'stockitem': stockitem, 'delta': 0}
-                stockitem_map[stockitem.id]['delta'] += qty * buyitem.itemqty
-            except:
-                t.delete()
-                raise Http404("Stockitem does not exist")
+            stockitem = i["stockitem"]
+            if stockitem.id not in stockitem_map:
+                stockitem_map[stockitem.id] = {'stockitem': stockitem, 'delta': 0}
+            stockitem_map[stockitem.id]['delta'] += qty * buyitem.itemqty
 
-        for x in stockitem_map.values():
-            x['stockitem'].create_operation(delta=x['delta'], unit='buy', transaction=t)
+        set_buyitem_prices(t.bar, new_prices, existing)
+        ItemOperation.bulk_create_operations(t, [
+            (x['stockitem'], x['delta'] / x['stockitem'].get_unit('buy')) for x in stockitem_map.values()])
 
         t.accountoperation_set.create(
             target=get_default_account(t.bar),
@@ -656,22 +584,6 @@ class ApproTransactionSerializer(BaseTransactionSerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        obj["items"] = []
-        for iop in transaction.itemoperation_set.all():
-            obj["items"].append({
-                'stockitem': iop.target.id,
-                'qty': iop.delta * iop.target.get_unit('sell')
-            })
-
-        aop = transaction.accountoperation_set.all()[0]
-
-        return obj
-
 
 class InventoryTransactionSerializer(BaseTransactionSerializer):
     items = ItemQtySerializer(many=True)
@@ -681,6 +593,7 @@ class InventoryTransactionSerializer(BaseTransactionSerializer):
 
         total_price = 0
 
+        ItemQtySerializer.lock_stockitems(data["items"])
         for i in data["items"]:
             i["stockitem"].last_inventory = timezone.now()
             i["stockitem"].save()
@@ -692,20 +605,6 @@ class InventoryTransactionSerializer(BaseTransactionSerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        obj["items"] = []
-        for iop in transaction.itemoperation_set.all():
-            obj["items"].append({
-                'stockitem': iop.target.id,
-                'qty': iop.delta * iop.target.get_unit('sell')
-            })
-
-        return obj
-
 
 class CollectivePaymentTransactionSerializer(BaseTransactionSerializer):
     accounts = AccountRatioSerializer(many=True)
@@ -719,10 +618,8 @@ class CollectivePaymentTransactionSerializer(BaseTransactionSerializer):
         total_ratio = 0
         for a in data["accounts"]:
             total_ratio += a["ratio"]
-        for a in data["accounts"]:
-            t.accountoperation_set.create(
-                target=a["account"],
-                delta=-amount * a["ratio"] / total_ratio)
+        AccountOperation.bulk_create_operations(t, [
+            (a["account"], -amount * a["ratio"] / total_ratio) for a in data["accounts"]])
 
         t.transactiondata_set.create(
             label='motive',
@@ -733,27 +630,143 @@ class CollectivePaymentTransactionSerializer(BaseTransactionSerializer):
 
         return t
 
-    def to_representation(self, transaction):
-        obj = BaseTransactionSerializer(transaction, context={'request':self.context.get('request'), 'ignore_type': True}).data
-        if transaction is None:
-            return obj
-
-        total_price = 0
-        obj["accounts"] = []
-        aops = transaction.accountoperation_set.all()
-        for aop in aops:
-            total_price += abs(aop.delta)
-        for aop in aops:
-            obj["accounts"].append({
-                'account': aop.target.id,
-                'ratio': abs(aop.delta) / total_price
-            })
-
-        data = transaction.transactiondata_set.all()[0]
-        obj['motive'] = data.data
 
-        return obj
 
+# Rendering goes through plain functions rather than the serializers above:
+# instantiating a serializer (and its fields) for each transaction of a history
+# is what used to dominate the time spent rendering it.
+# They expect the prefetches of TransactionViewSet.queryset.
+
+_datetime_field = serializers.DateTimeField()
+
+def render_transaction(transaction, can_cancel=None):
+    """Renders a transaction; can_cancel is a function returned by cancel_checker()."""
+    render_type = type_renderers[transaction.type]
+    obj = _render_fields(transaction)
+    try:
+        if can_cancel is not None:
+            obj['can_cancel'] = can_cancel(transaction)
+        obj['_type'] = "Transaction"
+        render_type(transaction, obj)
+    except Exception as e:
+        if transaction.type == "":
+            raise
+        obj = _render_fields(transaction)
+        obj['_type'] = "Transaction"
+        obj['type'] = 'error'
+        obj['error'] = str(e)
+    return obj
+
+
+def _render_fields(t):
+    obj = OrderedDict()
+    obj['id'] = t.id
+    obj['type'] = t.type
+    obj['timestamp'] = _datetime_field.to_representation(t.timestamp)
+    obj['canceled'] = t.canceled
+    obj['last_modified'] = _datetime_field.to_representation(t.last_modified)
+    obj['moneyflow'] = float(t.moneyflow)
+    obj['bar'] = t.bar_id
+    obj['author'] = t.author_id
+    for a in t.author.account_set.all():
+        if a.bar_id == t.bar_id:
+            obj['author_account'] = a.id
+    return obj
+
+
+def _render_nothing(t, obj):
+    pass
+
+def _render_items(t, obj):
+    obj['items'] = ItemQtySerializer.serializeOperations(t.itemoperation_set.all(), True)
+
+def _render_stockitems(t, obj):
+    obj['items'] = [{'stockitem': iop.target_id, 'qty': iop.delta * iop.target.unit_factor}
+                    for iop in t.itemoperation_set.all()]
+
+def _render_throw(t, obj):
+    iop = t.itemoperation_set.all()[0]
+    obj['stockitem'] = iop.target_id
+    obj['qty'] = -iop.delta * iop.target.unit_factor
+
+def _render_account_amount(sign):
+    def render(t, obj):
+        default_user_id = get_default_user().id
+        for aop in t.accountoperation_set.all():
+            if aop.target.owner_id != default_user_id:
+                obj['account'] = aop.target_id
+                obj['amount'] = sign * aop.delta
+    return render
+
+def _render_first_account_amount(sign):
+    def render(t, obj):
+        aop = t.accountoperation_set.all()[0]
+        obj['account'] = aop.target_id
+        obj['amount'] = sign * aop.delta
+    return render
+
+def _render_accounts_ratios(t, obj, zero_guard):
+    aops = t.accountoperation_set.all()
+    total = sum(abs(aop.delta) for aop in aops)
+    if zero_guard and total == 0:
+        obj['accounts'] = [{'account': aop.target_id, 'ratio': 0} for aop in aops]
+    else:
+        obj['accounts'] = [{'account': aop.target_id, 'ratio': abs(aop.delta) / total} for aop in aops]
+
+def _render_motive(t, obj):
+    obj['motive'] = t.transactiondata_set.all()[0].data
+
+
+def _render_give(t, obj):
+    aops = t.accountoperation_set.all()
+    to_op = aops[1]
+    if to_op.target.owner_id == t.author_id:
+        to_op = aops[0]
+    obj['account'] = to_op.target_id
+    obj['amount'] = to_op.delta
+
+def _render_refund(t, obj):
+    _render_account_amount(1)(t, obj)
+    _render_motive(t, obj)
+
+def _render_punish(t, obj):
+    _render_first_account_amount(1)(t, obj)
+    _render_motive(t, obj)
+
+def _render_bar_investment(t, obj):
+    obj['amount'] = -t.accountoperation_set.all()[0].delta
+    _render_motive(t, obj)
+
+def _render_meal(t, obj):
+    _render_items(t, obj)
+    _render_accounts_ratios(t, obj, zero_guard=True)
+    data = t.transactiondata_set.all()[0]
+    obj[data.label] = data.data
+
+def _render_appro(t, obj):
+    _render_stockitems(t, obj)
+    t.accountoperation_set.all()[0]  # Appros without an account operation are rendered as errors
+
+def _render_collective_payment(t, obj):
+    _render_accounts_ratios(t, obj, zero_guard=False)
+    _render_motive(t, obj)
+
+
+type_renderers = {
+    "": _render_nothing,
+    "buy": _render_items,
+    "throw": _render_throw,
+    "deposit": _render_account_amount(1),
+    "withdraw": _render_account_amount(-1),
+    "give": _render_give,
+    "refund": _render_refund,
+    "punish": _render_punish,
+    "agios": _render_first_account_amount(-1),
+    "barInvestment": _render_bar_investment,
+    "meal": _render_meal,
+    "appro": _render_appro,
+    "inventory": _render_stockitems,
+    "collectivePayment": _render_collective_payment}
 
 
 serializers_class_map = {
@@ -0,0 +1,131 @@
+from datetime import date, timedelta
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+
+from bars_core.models.bar import Bar, BarSettings
+from bars_core.models.user import User, get_default_user
+from bars_core.models.account import Account
+from bars_core.models.outbox import OutboxMail
+
+from bars_transactions.models import Transaction, AccountOperation
+from bars_transactions.agios import apply_agios
+from bars_stats.models import AccountDailyStat
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+
+class AgiosTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(AgiosTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.today = date.today()
+
+    def setUp(self):
+        # The caches outlive the rollback of each test
+        self.set_settings(agios_enabled=True, agios_threshold=2, agios_factor=0.1)
+        get_default_user._cache = None
+        get_default_user()
+
+    def set_settings(self, **kwargs):
+        bar_settings = BarSettings.objects.get(bar=self.bar)
+        for k, v in kwargs.items():
+            setattr(bar_settings, k, v)
+        bar_settings.save()
+
+    def make_account(self, money, overdrawn_for=None):
+        since = self.today - timedelta(overdrawn_for) if overdrawn_for is not None else None
+        user = User.objects.create(username='user%d' % User.objects.count(), email='a@example.com')
+        return Account.objects.create(bar=self.bar, owner=user, money=money, overdrawn_since=since)
+
+
+    def test_charge(self):
+        account = self.make_account(-10, overdrawn_for=3)
+
+        charges = apply_agios(self.bar)
+
+        self.assertEqual([(a.id, amount) for a, amount in charges], [(account.id, 1)])
+        self.assertAlmostEqual(reload(account).money, -11)
+        t = Transaction.objects.get(type='agios')
+        self.assertAlmostEqual(t.moneyflow, -1)
+        aop = AccountOperation.objects.get(transaction=t)
+        self.assertEqual((aop.target_id, aop.prev_value, aop.delta, aop.next_value), (account.id, -10, -1, -11))
+        self.assertEqual(AccountDailyStat.objects.get(account=account).total, -1)
+
+    def test_charge_rounded(self):
+        self.set_settings(agios_factor=0.05)
+        account = self.make_account(-3.30, overdrawn_for=3)
+
+        charges = apply_agios(self.bar)
+
+        self.assertEqual(charges[0][1], 0.17)
+        self.assertEqual(reload(account).money, -3.47)
+        aop = AccountOperation.objects.get(target=account)
+        self.assertEqual((aop.prev_value, aop.delta, aop.next_value), (-3.3, -0.17, -3.47))
+        self.assertEqual(aop.transaction.moneyflow, -0.17)
+        self.assertIn("0.17", OutboxMail.objects.get().message)
+
+    def test_other_agios_transactions(self):
+        # An agios transaction created at the same time must not be taken for one of the charges
+        other = Transaction.objects.create(bar=self.bar, author=get_default_user(), type='agios')
+        Transaction.objects.filter(pk=other.pk).update(timestamp=other.timestamp + timedelta(1))
+        account = self.make_account(-10, overdrawn_for=3)
+
+        apply_agios(self.bar)
+
+        aop = AccountOperation.objects.get(target=account)
+        self.assertNotEqual(aop.transaction_id, other.id)
+        self.assertAlmostEqual(aop.transaction.moneyflow, -1)
+
+    def test_overdrawn_since(self):
+        positive = self.make_account(5, overdrawn_for=3)
+        new = self.make_account(-5)
+        recent = self.make_account(-5, overdrawn_for=1)
+
+        self.assertEqual(apply_agios(self.bar), [])
+
+        self.assertIsNone(reload(positive).overdrawn_since)
+        self.assertEqual(reload(new).overdrawn_since, self.today)
+        self.assertEqual(reload(recent).overdrawn_since, self.today - timedelta(1))
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_dry_run(self):
+        account = self.make_account(-10, overdrawn_for=3)
+        new = self.make_account(-10)
+
+        charges = apply_agios(self.bar, dry_run=True)
+
+        self.assertEqual([(a.id, amount) for a, amount in charges], [(account.id, 1)])
+        self.assertAlmostEqual(reload(account).money, -10)
+        self.assertIsNone(reload(new).overdrawn_since)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_disabled(self):
+        self.make_account(-10, overdrawn_for=3)
+        self.set_settings(agios_enabled=False)
+
+        self.assertEqual(apply_agios(self.bar), [])
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_constant_queries(self):
+        def count(n):
+            for _ in range(n):
+                self.make_account(-10, overdrawn_for=3)
+            with CaptureQueriesContext(connection) as queries:
+                apply_agios(self.bar)
+            return len(queries)
+
+        # Accounts charged the first time are still overdrawn the second time
+        self.assertEqual(count(2), count(3))
+
+    def test_mails(self):
+        self.make_account(-10, overdrawn_for=3)
+        apply_agios(self.bar)
+
+        mail = OutboxMail.objects.get()
+        self.assertEqual(mail.recipients, 'a@example.com')
+        self.assertIn(u'-11.00', mail.message)
@@ -0,0 +1,255 @@
+from datetime import datetime, timedelta
+from threading import Thread
+from django.db import connection
+from django.test import TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APITestCase, APIClient
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.role import Role
+from bars_core.models.account import Account
+
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+
+from bars_stats.models import ItemDailyStat
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, AccountSnapshot, balance_at
+from scripts.reconcile import reconcile, reconcile_bar
+from scripts.snapshot_balances import take_snapshots
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+
+class PropagationTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(PropagationTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.user, _ = User.objects.get_or_create(username='user')
+
+        self.sellitem, _ = SellItem.objects.get_or_create(bar=self.bar, name="Chocolat")
+        self.itemdetails, _ = ItemDetails.objects.get_or_create(name="Chocolat")
+
+    def setUp(self):
+        self.account = Account.objects.create(bar=self.bar, owner=self.user, money=100)
+        self.stockitem = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem, details=self.itemdetails, price=1, qty=10)
+
+    def make_aop(self, delta):
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type='deposit')
+        return t.accountoperation_set.create(target=reload(self.account), delta=delta)
+
+    def make_iop(self, **kwargs):
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type='inventory' if kwargs.get('fixed') else 'buy')
+        return reload(self.stockitem).create_operation(transaction=t, **kwargs)
+
+    def assertChained(self, op_class, target, field):
+        ops = op_class.objects.filter(target=target).order_by('transaction__timestamp', 'pk')
+        value = ops[0].prev_value
+        for op in ops:
+            self.assertAlmostEqual(op.prev_value, value)
+            if op.fixed:
+                self.assertAlmostEqual(op.delta, op.next_value - op.prev_value)
+            else:
+                self.assertAlmostEqual(op.next_value, op.prev_value + op.delta)
+            value = op.prev_value if op.transaction.canceled else op.next_value
+        self.assertAlmostEqual(getattr(reload(target), field), value)
+
+
+    def test_cancel_shifts_later_operations(self):
+        ops = [self.make_aop(d) for d in (10, -3, 5)]
+
+        ops[0].transaction.set_canceled(True)
+
+        self.assertAlmostEqual(reload(self.account).money, 102)
+        self.assertAlmostEqual(reload(ops[1]).prev_value, 100)
+        self.assertAlmostEqual(reload(ops[2]).next_value, 102)
+        self.assertChained(AccountOperation, self.account, 'money')
+
+    def test_restore(self):
+        ops = [self.make_aop(d) for d in (10, -3, 5)]
+
+        ops[1].transaction.set_canceled(True)
+        ops[1].transaction.set_canceled(False)
+
+        self.assertAlmostEqual(reload(self.account).money, 112)
+        self.assertChained(AccountOperation, self.account, 'money')
+
+    def test_cancel_twice(self):
+        ops = [self.make_aop(d) for d in (10, -3)]
+
+        ops[0].transaction.set_canceled(True)
+        ops[0].transaction.set_canceled(True)
+
+        self.assertAlmostEqual(reload(self.account).money, 97)
+        self.assertChained(AccountOperation, self.account, 'money')
+
+    def test_fixed_operation_stops_propagation(self):
+        iop = self.make_iop(delta=-2)
+        inventory = self.make_iop(next_value=4, fixed=True)
+        after = self.make_iop(delta=-1)
+
+        iop.transaction.set_canceled(True)
+
+        self.assertAlmostEqual(reload(self.stockitem).qty, 3)
+        self.assertAlmostEqual(reload(inventory).prev_value, 10)
+        self.assertAlmostEqual(reload(inventory).delta, -6)
+        self.assertAlmostEqual(reload(after).prev_value, 4)
+        self.assertChained(ItemOperation, self.stockitem, 'qty')
+
+    def test_canceled_fixed_operation_is_transparent(self):
+        iop = self.make_iop(delta=-2)
+        inventory = self.make_iop(next_value=4, fixed=True)
+        self.make_iop(delta=-1)
+
+        inventory.transaction.set_canceled(True)
+        self.assertAlmostEqual(reload(self.stockitem).qty, 7)
+
+        iop.transaction.set_canceled(True)
+        self.assertAlmostEqual(reload(self.stockitem).qty, 9)
+        self.assertChained(ItemOperation, self.stockitem, 'qty')
+
+        inventory.transaction.set_canceled(False)
+        self.assertAlmostEqual(reload(self.stockitem).qty, 3)
+        self.assertChained(ItemOperation, self.stockitem, 'qty')
+
+    def test_same_result_as_full_propagation(self):
+        ops = [self.make_iop(delta=-1)]
+        ops += [self.make_iop(next_value=8, fixed=True)]
+        ops += [self.make_iop(delta=d) for d in (-1, 3, -2)]
+        ops += [self.make_iop(next_value=5, fixed=True)]
+        ops += [self.make_iop(delta=-1)]
+
+        for i in (3, 1, 0, 5, 1, 3):
+            t = reload(ops[i].transaction)
+            t.set_canceled(not t.canceled)
+            self.assertChained(ItemOperation, self.stockitem, 'qty')
+
+        qty = reload(self.stockitem).qty
+        reload(ops[0]).propagate()
+        self.assertAlmostEqual(reload(self.stockitem).qty, qty)
+
+    def test_stale_target(self):
+        stale = reload(self.account)
+        self.make_aop(-10)
+
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type='deposit')
+        aop = t.accountoperation_set.create(target=stale, delta=5)
+        self.assertAlmostEqual(aop.prev_value, 90)
+        self.assertAlmostEqual(stale.money, 95)
+        self.assertAlmostEqual(reload(self.account).money, 95)
+
+
+    def test_bulk_create_operations(self):
+        self.make_aop(-10)
+        stale = Account.objects.get(pk=self.account.pk)
+        other = Account.objects.create(bar=self.bar, owner=User.objects.create(username='other'), money=50)
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type='deposit')
+
+        AccountOperation.bulk_create_operations(t, [(stale, 1 / 3.), (other, 5), (stale, -2)])
+        self.assertEqual(reload(self.account).money, 88.33)
+        self.assertEqual(reload(other).money, 55)
+        self.assertEqual(stale.money, 88.33)
+        self.assertEqual(list(t.accountoperation_set.filter(target=stale).order_by('pk').values_list('prev_value', 'delta', 'next_value')),
+                         [(90, 0.33, 90.33), (90.33, -2, 88.33)])
+        self.assertChained(AccountOperation, self.account, 'money')
+
+        t.set_canceled(True)
+        self.assertEqual(reload(self.account).money, 90)
+        self.assertChained(AccountOperation, self.account, 'money')
+
+    def test_money_rounded(self):
+        aops = [self.make_aop(d) for d in (1 / 3., 0.1, 0.2)]
+        self.assertEqual(reload(aops[0]).delta, 0.33)
+        self.assertEqual(reload(aops[2]).next_value, 100.63)
+        self.assertEqual(reload(self.account).money, 100.63)
+        self.assertChained(AccountOperation, self.account, 'money')
+
+    def test_reconcile_balances(self):
+        self.account.money = 0
+        self.account.save()
+        self.make_aop(10)
+        self.make_aop(-2.5).transaction.set_canceled(True)
+        self.assertEqual(reconcile(AccountOperation, self.bar.id), [])
+
+        Account.objects.filter(pk=self.account.pk).update(money=12)
+        self.assertEqual(reconcile(AccountOperation, self.bar.id), [(self.account.id, 12, 10, None)])
+
+    def test_balance_at(self):
+        days = [timezone.make_aware(datetime(2015, 1, d), timezone.utc) for d in range(1, 7)]
+        ops = [self.make_aop(d) for d in (10, -3, 5, 7, -2)]
+        for op, day in zip(ops, days):
+            Transaction.objects.filter(pk=op.transaction_id).update(timestamp=day)
+        self.assertEqual(take_snapshots(self.account.id, 2), 2)
+        self.assertEqual(take_snapshots(self.account.id, 2), 0)
+
+        def balances():
+            return [balance_at(self.account.id, day - timedelta(hours=1)) for day in days]
+        self.assertEqual(balances(), [100, 110, 107, 112, 119, 117])
+
+        reload(ops[0].transaction).set_canceled(True)
+        self.assertEqual(balances(), [100, 100, 97, 102, 109, 107])
+        self.assertEqual(list(AccountSnapshot.objects.order_by('timestamp').values_list('balance', flat=True)), [97, 109])
+
+        reload(ops[2]).propagate()
+        self.assertEqual(list(AccountSnapshot.objects.values_list('operation', flat=True)), [ops[1].id])
+        self.assertEqual(balances(), [100, 100, 97, 102, 109, 107])
+
+    def test_reconcile(self):
+        ops = [self.make_iop(delta=-1), self.make_iop(next_value=8, fixed=True), self.make_iop(delta=-2)]
+        ops[0].transaction.set_canceled(True)
+        aop = self.make_aop(5)
+        self.assertEqual(reconcile(ItemOperation, self.bar.id), [])
+        self.assertEqual(reconcile(AccountOperation, self.bar.id), [])
+
+        ItemOperation.objects.filter(pk=ops[2].pk).update(prev_value=7)
+        Account.objects.filter(pk=self.account.pk).update(money=0)
+        ItemDailyStat.objects.filter(stockitem=self.stockitem).update(total=42)
+        self.assertEqual(reconcile(ItemOperation, self.bar.id), [(self.stockitem.id, 6, 6, ops[2].pk)])
+        self.assertEqual(reconcile(AccountOperation, self.bar.id), [(self.account.id, 0, 105, None)])
+
+        reconcile_bar((self.bar.id, True))
+        self.assertEqual(reconcile(ItemOperation, self.bar.id), [])
+        self.assertEqual(reconcile(AccountOperation, self.bar.id), [])
+        self.assertAlmostEqual(reload(self.stockitem).qty, 6)
+        self.assertAlmostEqual(reload(self.account).money, 105)
+        self.assertAlmostEqual(sum(ItemDailyStat.objects.filter(stockitem=self.stockitem).values_list('total', flat=True)), -4)
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.user = User.objects.create(username='user')
+        Role.objects.create(bar=self.bar, user=self.user, name='customer')
+        self.account = Account.objects.create(bar=self.bar, owner=self.user, money=0)
+        sellitem = SellItem.objects.create(bar=self.bar, name="Chocolat", tax=0)
+        itemdetails = ItemDetails.objects.create(name="Chocolat")
+        self.stockitem = StockItem.objects.create(bar=self.bar, sellitem=sellitem, details=itemdetails, price=1, qty=1000)
+
+    def test_concurrent_buys(self):
+        statuses = []
+
+        def buy(n):
+            client = APIClient()
+            client.force_authenticate(user=self.user)
+            try:
+                for _ in range(n):
+                    response = client.post('/transaction/?bar=%s' % self.bar.id, {'type': 'buy', 'stockitem': self.stockitem.id, 'qty': 1})
+                    statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=buy, args=(100,)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [201] * 1000)
+        self.assertAlmostEqual(reload(self.account).money, -1000)
+        self.assertAlmostEqual(reload(self.stockitem).qty, 0)
+        prev_values = sorted(AccountOperation.objects.values_list('prev_value', flat=True))
+        self.assertEqual(prev_values, [-float(i) for i in range(999, -1, -1)])
@@ -1,10 +1,14 @@
+from datetime import timedelta
 from mock import Mock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.http import Http404
 from rest_framework import exceptions, serializers
 from rest_framework.test import APITestCase
 
-from bars_core.models.bar import Bar
-from bars_core.models.user import User
+from bars_core.models.bar import Bar, _bar_cache
+from bars_core.models.user import User, get_default_user
 from bars_core.models.role import Role
 from bars_core.models.account import Account
 from bars_core.models.account import get_default_account
@@ -17,6 +21,8 @@ from bars_items.models.stockitem import StockItem
 from ..serializers import (BaseTransactionSerializer, BuyTransactionSerializer, GiveTransactionSerializer,
                            ThrowTransactionSerializer, DepositTransactionSerializer, PunishTransactionSerializer,
                            MealTransactionSerializer, ApproTransactionSerializer, InventoryTransactionSerializer,)
+from ..models import Transaction
+from ..views import TransactionViewSet
 
 
 def reload(obj):
@@ -134,7 +140,24 @@ class BuySerializerTests(SerializerTests):
         total_qty = self.stockitem.sell_qty + stockitem3.sell_qty
         self.assertAlmostEqual(reload(self.stockitem).sell_qty, self.stockitem.sell_qty * (1 - data['qty'] / total_qty))
         self.assertAlmostEqual(reload(stockitem3).sell_qty, stockitem3.sell_qty * (1 - data['qty'] / total_qty))
-        self.assertAlmostEqual(reload(self.account).money, self.account.money - data['qty'] * self.sellitem.calc_price())
+        self.assertAlmostEqual(reload(self.account).money, self.account.money - data['qty'] * self.sellitem.calc_price(), delta=0.005)  # Rounded to cents
+
+    def test_buy_sellitem_queries(self):
+        # The number of queries does not depend on the number of stockitems
+        def buy():
+            s = BuyTransactionSerializer(data={'type':'buy', 'sellitem':self.sellitem.id, 'qty':1}, context=self.context)
+            self.assertTrue(s.is_valid())
+            with CaptureQueriesContext(connection) as queries:
+                s.save()
+            return len(queries)
+
+        buy()  # Creates the daily stats rows
+        n = buy()
+        for i in range(3):
+            itemdetails, _ = ItemDetails.objects.get_or_create(name="Thing %d" % i)
+            StockItem.objects.create(bar=self.bar, sellitem=self.sellitem, details=itemdetails, price=0.5, qty=10)
+        buy()
+        self.assertEqual(buy(), n)
 
     def test_buy_itemdeleted(self):
         self.stockitem.deleted = True
@@ -373,10 +396,42 @@ class MealSerializerTests(SerializerTests):
         end_money = self.account.money - total_money * data['accounts'][0]['ratio'] / total_ratio
         end_money2 = self.account2.money - total_money * data['accounts'][1]['ratio'] / total_ratio
 
-        self.assertAlmostEqual(reload(self.account).money, end_money)
-        self.assertAlmostEqual(reload(self.account2).money, end_money2)
+        self.assertAlmostEqual(reload(self.account).money, end_money, delta=0.005)  # Rounded to cents
+        self.assertAlmostEqual(reload(self.account2).money, end_money2, delta=0.005)
         self.assertAlmostEqual(tct.moneyflow, total_money)
 
+    def test_meal_accounts_queries(self):
+        # The accounts are fetched and written with a constant number of queries
+        def meal(accounts):
+            data = {'type':'meal', 'name':'',
+                    'items': [{'stockitem':self.stockitem.id, 'qty':1}],
+                    'accounts': [{'account':a.id, 'ratio':1} for a in accounts]}
+            s = MealTransactionSerializer(data=data, context=self.context)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(s.is_valid())
+                s.save()
+            return len(queries)
+
+        meal([self.account])  # Creates the daily stats rows
+        n = meal([self.account])
+        accounts = [Account.objects.create(bar=self.bar, owner=User.objects.create(username='meal%d' % i)) for i in range(5)]
+        meal(accounts)
+        self.assertEqual(meal(accounts + [self.account]), n)
+        self.assertAlmostEqual(reload(accounts[0]).money, -self.stockitem.sell_price / 5 - self.stockitem.sell_price / 6, delta=0.01)
+
+    def test_meal_wrong_accounts(self):
+        data = {'type':'meal', 'name':'',
+                'items': [{'stockitem':self.stockitem.id, 'qty':1}],
+                'accounts': [{'account':self.account.id}, {'account':self.wrong_account.id}, {'account':12345}, {'account':'a'}]}
+        s = MealTransactionSerializer(data=data, context=self.context)
+        self.assertFalse(s.is_valid())
+        self.assertEqual(s.errors['accounts'], [
+            {},
+            {'account': ['Cannot operate across bars']},
+            {'account': ['Invalid pk "12345" - object does not exist.']},
+            {'account': ['Incorrect type. Expected pk value, received str.']},
+        ])
+
 
 class ApproSerializerTests(SerializerTests):
     @classmethod
@@ -409,6 +464,64 @@ class ApproSerializerTests(SerializerTests):
 
         self.assertAlmostEqual(reload(self.bar_account).money, end_money)
 
+    def test_appro_prices(self):
+        self.context = {'request': Mock(user=self.staff_user, bar=self.bar)}
+        BuyItemPrice.objects.filter(bar=self.bar, buyitem=self.buyitem).delete()
+        data = {'type':'appro',
+                'items': [
+                    {'buyitem':self.buyitem.id, 'qty':2},
+                    {'buyitem':self.buyitem.id, 'qty':4, 'price':10},
+                    {'buyitem':self.buyitem2.id, 'qty':1, 'price':3},
+                    {'buyitem':self.buyitem2.id, 'qty':2},
+                ]
+                }
+
+        s = ApproTransactionSerializer(data=data, context=self.context)
+        self.assertTrue(s.is_valid())
+        tct = s.save()
+        self.assertAlmostEqual(tct.moneyflow, 0 + 10 + 3 + 2 * 3)
+        self.assertEqual(BuyItemPrice.objects.get(bar=self.bar, buyitem=self.buyitem).price, 2.5)
+        self.assertEqual(BuyItemPrice.objects.get(bar=self.bar, buyitem=self.buyitem2).price, 3)
+        # One operation per stockitem
+        self.assertEqual(tct.itemoperation_set.count(), 2)
+        self.assertAlmostEqual(reload(self.stockitem).qty, self.stockitem.qty + 6 * self.buyitem.itemqty)
+
+    def test_appro_queries(self):
+        # The number of queries does not depend on the number of items
+        self.context = {'request': Mock(user=self.staff_user, bar=self.bar)}
+        def appro(buyitems):
+            data = {'type':'appro', 'items': [{'buyitem':b.id, 'qty':1, 'price':1} for b in buyitems]}
+            s = ApproTransactionSerializer(data=data, context=self.context)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(s.is_valid())
+                s.save()
+            return len(queries)
+
+        appro([self.buyitem])  # Creates the prices and the daily stats rows
+        n = appro([self.buyitem])
+        buyitems = [self.buyitem]
+        for i in range(3):
+            itemdetails = ItemDetails.objects.create(name="Thing %d" % i)
+            sellitem = SellItem.objects.create(bar=self.bar, name="Thing %d" % i)
+            StockItem.objects.create(bar=self.bar, sellitem=sellitem, details=itemdetails, price=1)
+            buyitems.append(BuyItem.objects.create(details=itemdetails))
+        appro(buyitems)
+        self.assertEqual(appro(buyitems), n)
+
+    def test_appro_no_stockitem(self):
+        self.context = {'request': Mock(user=self.staff_user, bar=self.bar)}
+        buyitem3 = BuyItem.objects.create(details=ItemDetails.objects.create(name="Thing"))
+        data = {'type':'appro',
+                'items': [
+                    {'buyitem':self.buyitem.id, 'qty':1},
+                    {'buyitem':buyitem3.id, 'qty':1},
+                ]
+                }
+
+        s = ApproTransactionSerializer(data=data, context=self.context)
+        self.assertFalse(s.is_valid())
+        self.assertEqual(s.errors['items'], [{}, {'buyitem': ['BuyItem (id=%d) has no stockitem in this bar' % buyitem3.id]}])
+
     def test_appro_no_staff(self):
         data = {'type':'appro',
                 'items': [
@@ -465,4 +578,98 @@ class InventorySerializerTests(SerializerTests):
             s.save()
 
         self.assertAlmostEqual(reload(self.stockitem).sell_qty, self.stockitem.sell_qty)
-        self.assertAlmostEqual(reload(self.stockitem2).sell_qty, self.stockitem2.sell_qty)
\ No newline at end of file
+        self.assertAlmostEqual(reload(self.stockitem2).sell_qty, self.stockitem2.sell_qty)
+
+class RenderSerializerTests(SerializerTests):
+    def setUp(self):
+        get_default_user._cache = None  # The cache outlives the rollback of each test
+        self.user2, _ = User.objects.get_or_create(username='user2')
+        self.account2, _ = Account.objects.get_or_create(bar=self.bar, owner=self.user2)
+
+    def make_transaction(self, type, aops=(), iops=(), data=()):
+        t = Transaction.objects.create(bar=self.bar, author=self.user, type=type, moneyflow=10)
+        for account, delta in aops:
+            t.accountoperation_set.create(target=account, delta=delta)
+        for stockitem, delta in iops:
+            t.itemoperation_set.create(target=stockitem, delta=delta)
+        for label, value in data:
+            t.transactiondata_set.create(label=label, data=value)
+        return t
+
+    def render(self, t):
+        return BaseTransactionSerializer(t).data
+
+    def test_render_fields(self):
+        t = self.make_transaction('')
+        obj = self.render(t)
+
+        self.assertEqual(list(obj.keys()), ['id', 'type', 'timestamp', 'canceled', 'last_modified',
+                                            'moneyflow', 'bar', 'author', 'author_account', '_type'])
+        self.assertEqual(obj['author_account'], self.account.id)
+        self.assertTrue(obj['timestamp'].endswith('Z'))
+
+    def test_render_deposit(self):
+        t = self.make_transaction('deposit', aops=[(self.account, 10), (get_default_account(self.bar), 10)])
+        obj = self.render(t)
+        self.assertEqual((obj['type'], obj['account'], obj['amount']), ('deposit', self.account.id, 10))
+
+    def test_render_give(self):
+        t = self.make_transaction('give', aops=[(self.account2, 5), (self.account, -5)])
+        obj = self.render(t)
+        self.assertEqual((obj['account'], obj['amount']), (self.account2.id, 5))
+
+    def test_render_throw(self):
+        t = self.make_transaction('throw', iops=[(self.stockitem, -1)])
+        obj = self.render(t)
+        self.assertEqual((obj['stockitem'], obj['qty']), (self.stockitem.id, 5))
+
+    def test_render_meal(self):
+        t = self.make_transaction('meal', aops=[(self.account, -3), (self.account2, -1)],
+                                  iops=[(self.stockitem, -1), (self.stockitem2, -2)], data=[('name', 'Raclette')])
+        obj = self.render(t)
+        self.assertEqual(obj['accounts'], [{'account': self.account.id, 'ratio': 0.75},
+                                           {'account': self.account2.id, 'ratio': 0.25}])
+        self.assertEqual(sorted(obj['items'], key=lambda i: i['sellitem']),
+                         [{'sellitem': self.sellitem.id, 'qty': -5}, {'sellitem': self.sellitem2.id, 'qty': -4}])
+        self.assertEqual(obj['name'], 'Raclette')
+
+    def test_render_error(self):
+        t = self.make_transaction('appro', iops=[(self.stockitem, 1)])
+        obj = self.render(t)
+        self.assertEqual(obj['type'], 'error')
+        self.assertEqual(obj['error'], 'list index out of range')
+        self.assertNotIn('items', obj)
+
+    def test_render_many(self):
+        self.make_transaction('deposit', aops=[(self.account, 10), (get_default_account(self.bar), 10)])
+        self.make_transaction('punish', aops=[(self.account, -2)], data=[('motive', 'Bruit')])
+        transactions = list(TransactionViewSet.queryset.filter(bar=self.bar).order_by('id'))
+
+        # Everything needed is prefetched
+        with self.assertNumQueries(0):
+            data = BaseTransactionSerializer(transactions, many=True).data
+        self.assertEqual([(o['type'], o['amount']) for o in data], [('deposit', 10), ('punish', -2)])
+        self.assertEqual(data[1]['motive'], 'Bruit')
+
+        data = BaseTransactionSerializer(transactions, many=True, context=self.context).data
+        self.assertEqual([o['can_cancel'] for o in data], [True, True])
+
+    def test_can_cancel(self):
+        recent = self.make_transaction('deposit', aops=[(self.account, 10), (get_default_account(self.bar), 10)])
+        old = self.make_transaction('deposit', aops=[(self.account, 10), (get_default_account(self.bar), 10)])
+        Transaction.objects.filter(pk=old.pk).update(timestamp=timezone.now() - timedelta(days=100))
+        staff, _ = User.objects.get_or_create(username='staff')
+        Role.objects.get_or_create(name='staff', bar=self.bar, user=staff)
+        transactions = list(TransactionViewSet.queryset.filter(pk__in=[recent.pk, old.pk]).order_by('id'))
+
+        for user in (self.user, self.user2, staff):
+            user = User.objects.get(pk=user.pk)
+            context = {'request': Mock(user=user, bar=self.bar)}
+            _bar_cache.clear()
+            # The settings of the bar, once for all the rows
+            with self.assertNumQueries(1):
+                data = BaseTransactionSerializer(transactions, many=True, context=context).data
+            expected = [user.has_perm('bars_transactions.change_transaction', t) for t in transactions]
+            self.assertEqual([o['can_cancel'] for o in data], expected)
+        self.assertEqual(expected, [True, True])
+        self.assertEqual([o['can_cancel'] for o in BaseTransactionSerializer(transactions, many=True, context=self.context).data], [True, False])
@@ -1,4 +1,7 @@
+import csv
+import json
 from datetime import timedelta
+from mock import patch
 from django.utils import timezone
 from rest_framework.test import APITestCase
 
@@ -12,7 +15,8 @@ from bars_items.models.itemdetails import ItemDetails
 from bars_items.models.sellitem import SellItem
 from bars_items.models.stockitem import StockItem
 
-from bars_transactions.models import Transaction
+from bars_transactions.models import Transaction, IdempotencyKey
+from bars_transactions.views import TransactionViewSet
 
 
 def reload(obj):
@@ -121,6 +125,76 @@ class TransactionTests(APITestCase):
         self.assertEqual(reload(self.stockitem).qty, end_qty)
 
 
+    def test_bulk(self):
+        self.client.force_authenticate(user=self.user)
+        money = reload(self.account).money
+        data = [
+            {'type': 'buy', 'stockitem': self.stockitem.id, 'qty': 1},
+            {'type': 'buy', 'stockitem': self.stockitem.id, 'qty': -1},
+            {'type': 'unknown'},
+            {'type': 'give', 'account': self.staff_account.id, 'amount': 2},
+        ]
+
+        response = self.client.post('/transaction/bulk/?bar=%s' % self.bar.id, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.data], [201, 400, 400, 201])
+        self.assertEqual(response.data[0]['data']['type'], 'buy')
+        self.assertIn('qty', response.data[1]['errors'])
+        self.assertAlmostEqual(reload(self.account).money, money - self.stockitem.sell_price - 2)
+
+    def test_bulk_idempotency(self):
+        self.client.force_authenticate(user=self.user)
+        money = reload(self.account).money
+        data = [{'type': 'give', 'account': self.staff_account.id, 'amount': 2, 'idempotency_key': 'abc'}]
+
+        response = self.client.post('/transaction/bulk/?bar=%s' % self.bar.id, data * 2, format='json')
+        self.assertEqual([r['status'] for r in response.data], [201, 200])
+        response2 = self.client.post('/transaction/bulk/?bar=%s' % self.bar.id, data, format='json')
+        self.assertEqual(response2.data[0]['status'], 200)
+
+        self.assertEqual(response.data[1]['data'], response.data[0]['data'])
+        self.assertEqual(response2.data[0]['data']['id'], response.data[0]['data']['id'])
+        self.assertEqual(Transaction.objects.filter(type='give').count(), 1)
+        self.assertAlmostEqual(reload(self.account).money, money - 2)
+
+    def test_bulk_idempotency_failed(self):
+        # The key of a transaction that failed can be used again
+        self.client.force_authenticate(user=self.user)
+        data = {'type': 'give', 'account': self.staff_account.id, 'amount': -2, 'idempotency_key': 'abc'}
+
+        response = self.client.post('/transaction/bulk/?bar=%s' % self.bar.id, [data], format='json')
+        self.assertEqual(response.data[0]['status'], 400)
+        data['amount'] = 2
+        response = self.client.post('/transaction/bulk/?bar=%s' % self.bar.id, [data], format='json')
+        self.assertEqual(response.data[0]['status'], 201)
+
+    def test_idempotency_key(self):
+        self.client.force_authenticate(user=self.user)
+        money = reload(self.account).money
+        data = {'type': 'give', 'account': self.staff_account.id, 'amount': 2}
+
+        response = self.client.post('/transaction/?bar=%s' % self.bar.id, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, 201)
+        response2 = self.client.post('/transaction/?bar=%s' % self.bar.id, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response2.status_code, 200)
+        self.assertEqual(response2.data, response.data)
+        self.assertAlmostEqual(reload(self.account).money, money - 2)
+
+        self.client.force_authenticate(user=self.staff_user)
+        data['account'] = self.account.id
+        response3 = self.client.post('/transaction/?bar=%s' % self.bar.id, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response3.status_code, 201)
+
+    def test_idempotency_key_conflict(self):
+        # The key was saved by a transaction that is still running
+        IdempotencyKey.objects.create(author=self.user, key='abc')
+        self.client.force_authenticate(user=self.user)
+        data = {'type': 'give', 'account': self.staff_account.id, 'amount': 2}
+
+        response = self.client.post('/transaction/?bar=%s' % self.bar.id, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Transaction.objects.filter(type='give').count(), 0)
+
     def test_cancel_transaction_after_threshold(self):
         self.bar.cancel_transaction_threshold = 48
         self.bar.save()
@@ -137,3 +211,140 @@ class TransactionTests(APITestCase):
         response = self.client.put('/transaction/%d/cancel/' % transaction.id, {})
         self.assertEqual(response.status_code, 200)
         self.assertTrue(reload(transaction).canceled)
+
+
+class TransactionPaginationTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(TransactionPaginationTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.wrong_bar, _ = Bar.objects.get_or_create(id='barrouje')
+        self.user, _ = User.objects.get_or_create(username='user')
+
+        timestamp = timezone.now()
+        for i in range(25):
+            t = Transaction.objects.create(bar=self.bar, author=self.user, type='deposit')
+            # Same timestamp for some transactions, to check ties are broken by id
+            t.timestamp = timestamp - timedelta(minutes=i // 2)
+            t.save()
+        Transaction.objects.create(bar=self.wrong_bar, author=self.user, type='deposit')
+
+    def test_cursor_pagination(self):
+        expected = list(Transaction.objects.filter(bar=self.bar).order_by('-timestamp', '-id').values_list('id', flat=True))
+
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get('/transaction/', {'bar': self.bar.id, 'page_size': 10, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 10)
+            ids += [t['id'] for t in response.data['results']]
+            cursor = response.data['next']
+
+        self.assertEqual(ids, expected)
+
+    def test_cursor_same_as_page(self):
+        response = self.client.get('/transaction/', {'bar': self.bar.id, 'page_size': 7, 'cursor': ''})
+        response = self.client.get('/transaction/', {'bar': self.bar.id, 'page_size': 7, 'cursor': response.data['next']})
+        response2 = self.client.get('/transaction/', {'bar': self.bar.id, 'page_size': 7, 'page': 2})
+        self.assertEqual(response.data['results'], response2.data)
+
+    def test_cursor_page_size(self):
+        def page_size(value):
+            response = self.client.get('/transaction/', {'bar': self.bar.id, 'page_size': value, 'cursor': ''})
+            self.assertEqual(response.status_code, 200)
+            return len(response.data['results'])
+
+        self.assertEqual(page_size(-1), 1)
+        self.assertEqual(page_size(0), 1)
+        self.assertEqual(page_size('x'), 10)
+        with patch.object(TransactionViewSet, 'max_page_size', 5):
+            self.assertEqual(page_size(20), 5)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/transaction/', {'bar': self.bar.id, 'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TransactionExportTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(TransactionExportTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.wrong_bar, _ = Bar.objects.get_or_create(id='barrouje')
+        self.user, _ = User.objects.get_or_create(username='user')
+
+        timestamp = timezone.now()
+        for i in range(11):
+            t = Transaction.objects.create(bar=self.bar, author=self.user, type='', moneyflow=i)
+            t.timestamp = timestamp - timedelta(minutes=i // 2)
+            t.save()
+        Transaction.objects.create(bar=self.wrong_bar, author=self.user, type='')
+        self.expected = list(Transaction.objects.filter(bar=self.bar).order_by('-timestamp', '-id').values_list('id', flat=True))
+
+    def export(self, format):
+        with patch.object(TransactionViewSet, 'export_chunk_size', 4):
+            response = self.client.get('/transaction/export/', {'bar': self.bar.id, 'format': format})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_export_ndjson(self):
+        lines = self.export('ndjson').splitlines()
+        rows = [json.loads(l) for l in lines]
+        self.assertEqual([r['id'] for r in rows], self.expected)
+        self.assertEqual(rows[0]['_type'], 'Transaction')
+
+    def test_export_csv(self):
+        rows = list(csv.DictReader(self.export('csv').splitlines()))
+        self.assertEqual([int(r['id']) for r in rows], self.expected)
+        self.assertEqual(float(rows[-1]['moneyflow']), 10)
+
+    def test_export_no_bar(self):
+        response = self.client.get('/transaction/export/')
+        self.assertEqual(response.status_code, 400)
+
+
+class TransactionFilterTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(TransactionFilterTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.user, _ = User.objects.get_or_create(username='user')
+        self.account, _ = Account.objects.get_or_create(bar=self.bar, owner=self.user)
+        self.user2, _ = User.objects.get_or_create(username='user2')
+        self.account2, _ = Account.objects.get_or_create(bar=self.bar, owner=self.user2)
+
+        self.sellitem, _ = SellItem.objects.get_or_create(bar=self.bar, name="Chocolat")
+        self.itemdetails, _ = ItemDetails.objects.get_or_create(name="Chocolat")
+        self.itemdetails2, _ = ItemDetails.objects.get_or_create(name="Chocolat noir")
+        self.stockitem, _ = StockItem.objects.get_or_create(bar=self.bar, sellitem=self.sellitem, details=self.itemdetails, price=1)
+        self.stockitem2, _ = StockItem.objects.get_or_create(bar=self.bar, sellitem=self.sellitem, details=self.itemdetails2, price=1)
+
+        # Authored by user
+        self.t_authored = Transaction.objects.create(bar=self.bar, author=self.user, type='deposit')
+        # Authored by user2, with two operations on the account of user and both stockitems
+        self.t_meal = Transaction.objects.create(bar=self.bar, author=self.user2, type='meal')
+        self.t_meal.accountoperation_set.create(target=self.account, delta=-1)
+        self.t_meal.accountoperation_set.create(target=self.account, delta=-1)
+        self.stockitem.create_operation(transaction=self.t_meal, delta=-1)
+        self.stockitem2.create_operation(transaction=self.t_meal, delta=-1)
+        # Unrelated to user
+        self.t_other = Transaction.objects.create(bar=self.bar, author=self.user2, type='deposit')
+        self.t_other.accountoperation_set.create(target=self.account2, delta=1)
+
+    def get_ids(self, **params):
+        params['bar'] = self.bar.id
+        response = self.client.get('/transaction/', params)
+        self.assertEqual(response.status_code, 200)
+        return [t['id'] for t in response.data]
+
+    def test_filter_user(self):
+        self.assertEqual(self.get_ids(user=self.user.id), [self.t_meal.id, self.t_authored.id])
+
+    def test_filter_account(self):
+        self.assertEqual(self.get_ids(account=self.account.id), [self.t_meal.id, self.t_authored.id])
+        self.assertEqual(self.get_ids(account=self.account2.id), [self.t_other.id, self.t_meal.id])
+
+    def test_filter_items(self):
+        self.assertEqual(self.get_ids(sellitem=self.sellitem.id), [self.t_meal.id])
+        self.assertEqual(self.get_ids(stockitem=self.stockitem2.id), [self.t_meal.id])
@@ -1,24 +1,57 @@
-from django.http import Http404
+import base64
+import csv
+import json
+from django.http import Http404, StreamingHttpResponse
+from django.db import IntegrityError, transaction as db_transaction
 from django.db.models import Q, Prefetch
-from rest_framework import viewsets, decorators, exceptions, filters
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes
+from rest_framework import viewsets, decorators, exceptions, filters, renderers
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
 from bars_core.perms import PerBarPermissionsOrObjectPermissionsOrAnonReadOnly
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_core.models.account import Account
-from bars_transactions.models import Transaction
-from bars_transactions.serializers import serializers_class_map
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, IdempotencyKey
+from bars_transactions.serializers import serializers_class_map, render_transaction
+
+
+def encode_cursor(transaction):
+    key = "%s|%d" % (transaction.timestamp.isoformat(), transaction.id)
+    return base64.urlsafe_b64encode(key.encode('ascii')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(str(cursor)).decode('ascii').split('|')
+        timestamp = parse_datetime(timestamp)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        timestamp = None
+    if timestamp is None:
+        raise exceptions.ParseError("Invalid cursor")
+    return timestamp, pk
+
+
+def _aops(**kwargs):
+    return AccountOperation.objects.filter(**kwargs).values('transaction')
+
+def _iops(**kwargs):
+    return ItemOperation.objects.filter(**kwargs).values('transaction')
 
 
 class TransactionFilterBackend(filters.BaseFilterBackend):
+    # Filters on operations go through id subqueries rather than joins, so that
+    # they never duplicate rows and the result does not need a DISTINCT
     filter_q = {
         'bar': lambda bar: Q(bar=bar),
-        'user': lambda user: Q(accountoperation__target__owner=user) | Q(author=user),
-        'account': lambda account: Q(accountoperation__target=account) | Q(author__account=account),
-        'item': lambda item: Q(itemoperation__target=item),
-        'stockitem': lambda stockitem: Q(itemoperation__target=stockitem),
-        'sellitem': lambda sellitem: Q(itemoperation__target__sellitem=sellitem),
+        'user': lambda user: Q(pk__in=_aops(target__owner=user)) | Q(author=user),
+        'account': lambda account: Q(pk__in=_aops(target=account)) | Q(author__in=Account.objects.filter(pk=account).values('owner')),
+        'item': lambda item: Q(pk__in=_iops(target=item)),
+        'stockitem': lambda stockitem: Q(pk__in=_iops(target=stockitem)),
+        'sellitem': lambda sellitem: Q(pk__in=_iops(target__sellitem=sellitem)),
     }
 
     def filter_queryset(self, request, queryset, view):
@@ -31,7 +64,15 @@ class TransactionFilterBackend(filters.BaseFilterBackend):
         if len(types) != 0:
             queryset = queryset.filter(type__in=types)
 
-        queryset = queryset.order_by('-timestamp', '-id').distinct()
+        queryset = queryset.order_by('-timestamp', '-id')
+
+        cursor = request.query_params.get('cursor', None)
+        if cursor is not None:
+            # Keyset pagination; the page itself is cut by TransactionViewSet.list
+            if cursor != '':
+                timestamp, pk = decode_cursor(cursor)
+                queryset = queryset.filter(timestamp__lte=timestamp).exclude(timestamp=timestamp, id__gte=pk)
+            return queryset
 
         page = int(request.query_params.get('page', 0))
         if page != 0:
@@ -41,6 +82,53 @@ class TransactionFilterBackend(filters.BaseFilterBackend):
         return queryset
 
 
+class Conflict(exceptions.APIException):
+    status_code = 409
+    default_detail = "A transaction with the same idempotency key is still being created"
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render_rows(self, rows):
+        encoder = JSONEncoder(ensure_ascii=False)
+        for row in rows:
+            yield (encoder.encode(row) + '\n').encode('utf-8')
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, list):  # Errors
+            return renderers.JSONRenderer().render(data)
+        return b''.join(self.render_rows(data))
+
+
+class CSVRenderer(NDJSONRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    fields = ('id', 'timestamp', 'type', 'canceled', 'author', 'author_account', 'moneyflow',
+              'account', 'amount', 'stockitem', 'qty', 'motive', 'name', 'items', 'accounts', 'error')
+
+    def encode(self, value):
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        if six.PY2 and isinstance(value, six.text_type):
+            # The csv module of Python 2 only writes byte strings
+            return value.encode('utf-8')
+        return value
+
+    def render_rows(self, rows):
+        buf = six.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(self.fields)
+        for row in rows:
+            writer.writerow([self.encode(row.get(f, '')) for f in self.fields])
+            yield force_bytes(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+        yield force_bytes(buf.getvalue())
+
+
 class TransactionViewSet(viewsets.ModelViewSet):
     queryset = Transaction.objects.prefetch_related(
         Prefetch('bar', Bar.objects.only('id')),
@@ -56,6 +144,132 @@ class TransactionViewSet(viewsets.ModelViewSet):
     permission_classes = (PerBarPermissionsOrObjectPermissionsOrAnonReadOnly,)
     filter_backends = (TransactionFilterBackend,)
 
+    default_page_size = 10
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        """Returns the page_size parameter within [1, max_page_size], or the default one when it is not a number."""
+        try:
+            return min(max(int(request.query_params['page_size']), 1), self.max_page_size)
+        except (KeyError, ValueError):
+            return self.default_page_size
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('cursor', None) is None:
+            return super(TransactionViewSet, self).list(request, *args, **kwargs)
+
+        # Cursor mode: ?cursor= for the first page, then the 'next' cursor of the previous page
+        page_size = self.get_page_size(request)
+        transactions = list(self.filter_queryset(self.get_queryset())[:page_size + 1])
+        next_cursor = None
+        if len(transactions) > page_size:
+            transactions = transactions[:page_size]
+            next_cursor = encode_cursor(transactions[-1])
+
+        serializer = self.get_serializer(transactions, many=True)
+        return Response({'next': next_cursor, 'results': serializer.data})
+
+    def create(self, request, *args, **kwargs):
+        """With an Idempotency-Key header, a resubmitted transaction is returned again instead of being created twice."""
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if key is None:
+            return super(TransactionViewSet, self).create(request, *args, **kwargs)
+
+        with db_transaction.atomic():
+            status, data = self.create_once(request.data, key)
+        return Response(data, status=status)
+
+    export_chunk_size = 500
+
+    @decorators.list_route(methods=['get'], renderer_classes=(NDJSONRenderer, CSVRenderer))
+    def export(self, request):
+        """Streams the whole history of a bar, one transaction per line.
+
+        Accepts the filters of the list view, and ?format=ndjson (the default) or ?format=csv.
+        Transactions are fetched in keyset-paginated chunks, each with its own prefetches,
+        so that memory use does not depend on the size of the history.
+        """
+        if request.bar is None:
+            return Response("I can only export a bar", 400)
+        queryset = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(request.accepted_renderer.render_rows(self.export_rows(queryset)),
+                                         content_type=request.accepted_renderer.media_type)
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (request.bar.id, request.accepted_renderer.format)
+        return response
+
+    def export_rows(self, queryset):
+        chunk = list(queryset[:self.export_chunk_size])
+        while chunk:
+            for t in chunk:
+                yield render_transaction(t)
+            last = chunk[-1]
+            chunk = list(queryset.filter(timestamp__lte=last.timestamp)
+                         .exclude(timestamp=last.timestamp, id__gte=last.id)[:self.export_chunk_size])
+
+    bulk_max_size = 200
+
+    @decorators.list_route(methods=['post'])
+    def bulk(self, request):
+        """Creates a list of transactions, each given as it would be to POST /transaction/.
+
+        They are all created in one database transaction, each one in its own
+        savepoint, and each one gets its own result: {'status': 201, 'data': ...}
+        or {'status': 4xx, 'errors': ...}.
+        A transaction may come with an 'idempotency_key': if a transaction was
+        already created with the same key, it is returned with status 200
+        instead of being created again.
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return Response("Expected a list of transactions", 400)
+        if len(items) > self.bulk_max_size:
+            return Response("Too many transactions (at most %d)" % self.bulk_max_size, 400)
+
+        with db_transaction.atomic():
+            results = [self.bulk_create_one(item) for item in items]
+        return Response(results)
+
+    def bulk_create_one(self, item):
+        if not isinstance(item, dict) or item.get('type', '') not in serializers_class_map:
+            return {'status': 400, 'errors': "Unknown transaction type"}
+        data = dict(item)
+        key = data.pop('idempotency_key', None)
+        try:
+            with db_transaction.atomic():
+                status, obj = self.create_once(data, key)
+            return {'status': status, 'data': obj}
+        except exceptions.APIException as e:
+            return {'status': e.status_code, 'errors': e.detail}
+        except Http404 as e:
+            return {'status': 404, 'errors': str(e)}
+
+    def create_once(self, data, key=None):
+        """Creates a transaction, unless one was already created by the same user with the same key.
+
+        Returns the status (201 if created, 200 if not) and the serialized transaction.
+        """
+        if key is not None:
+            if not isinstance(key, six.string_types) or not 0 < len(key) <= IdempotencyKey._meta.get_field('key').max_length:
+                raise exceptions.ValidationError({'idempotency_key': ["Invalid idempotency key"]})
+            try:
+                with db_transaction.atomic():
+                    idempotency_key = IdempotencyKey.objects.create(author=self.request.user, key=key)
+            except IntegrityError:
+                # Depending on the isolation level, the other transaction may not be visible yet
+                previous = IdempotencyKey.objects.select_related('transaction').filter(author=self.request.user, key=key).first()
+                if previous is None or previous.transaction is None:
+                    raise Conflict()
+                serializer = serializers_class_map[""](previous.transaction, context=self.get_serializer_context())
+                return 200, serializer.data
+
+        serializer = serializers_class_map[data.get('type', '')](data=data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        t = serializer.save()
+        if key is not None:
+            idempotency_key.transaction = t
+            idempotency_key.save()
+        return 201, serializer.data
+
     def get_serializer_class(self):
         data = self.request.data
         if "type" in data:
@@ -72,14 +286,7 @@ class TransactionViewSet(viewsets.ModelViewSet):
             raise Http404()
 
         if request.user.has_perm('bars_transactions.change_transaction', transaction):
-            transaction.canceled = True
-            transaction.save()
-
-            for aop in transaction.accountoperation_set.all():
-                aop.propagate()
-
-            for iop in transaction.itemoperation_set.all():
-                iop.propagate()
+            transaction.set_canceled(True)
 
             serializer = self.get_serializer_class()(transaction)
             return Response(serializer.data)
@@ -95,14 +302,7 @@ class TransactionViewSet(viewsets.ModelViewSet):
             raise Http404()
 
         if request.user.has_perm('bars_transactions.change_transaction', transaction):
-            transaction.canceled = False
-            transaction.save()
-
-            for aop in transaction.accountoperation_set.all():
-                aop.propagate()
-
-            for iop in transaction.itemoperation_set.all():
-                iop.propagate()
+            transaction.set_canceled(False)
 
             serializer = self.get_serializer_class()(transaction)
             return Response(serializer.data)
@@ -4,3 +4,6 @@ LOGFILE=/srv/api/cron.log
 cd /app
 date >> $LOGFILE
 python manage.py runscript agios >> $LOGFILE 2>&1
+python manage.py runscript clean_idempotency_keys >> $LOGFILE 2>&1
+python manage.py runscript clean_tombstones >> $LOGFILE 2>&1
+python manage.py runscript snapshot_balances >> $LOGFILE 2>&1
@@ -0,0 +1,6 @@
+#!/bin/sh
+LOGFILE=/srv/api/cron.log
+
+cd /app
+# Skip this run if the previous one is still sending
+flock -n /tmp/send_mails.lock python manage.py runscript send_mails >> $LOGFILE 2>&1
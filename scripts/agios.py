@@ -1,7 +1,23 @@
-from bars_core.models.account import Account
+"""Charges the agios of every bar.
 
-def run():
-    sum = 0
-    for a in Account.objects.filter(deleted=False).select_related('bar'):
-        sum += a.bar.apply_agios(a)
-    print("Done (took %f euros)" % sum)
+Usage: manage.py runscript agios [--script-args dry_run=1]
+"""
+import time
+
+from bars_core.models.bar import Bar
+from bars_transactions.agios import apply_agios
+from scripts.utils import parse_args
+
+
+def run(*args):
+    opts = parse_args(args, dry_run=False)
+    total = 0
+    for bar in Bar.objects.order_by('pk'):
+        start = time.time()
+        charges = apply_agios(bar, dry_run=opts['dry_run'])
+        elapsed = time.time() - start
+
+        amount = sum(a for _, a in charges)
+        total += amount
+        print("%s: %d accounts, %f euros (%.3fs)" % (bar.id, len(charges), amount, elapsed))
+    print("Done (took %f euros%s)" % (total, ", dry run" if opts['dry_run'] else ""))
@@ -0,0 +1,141 @@
+"""Measures the latency and query count of the hot API endpoints on a generated dataset.
+
+Usage: manage.py runscript bench_endpoints --script-args bar=gen_0 samples=50 out=bench.json compare=previous.json
+
+Run scripts/gen_dataset.py first. Requests go through the whole Django stack
+with the test client, as a customer of the bar, and everything they write is
+rolled back. Results (p50/p99 latency and query counts per endpoint) are
+written to `out` as JSON; with `compare`, they are printed next to a previous run.
+"""
+import json
+import random
+from django.conf import settings
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from bars_core.models.bar import Bar
+from bars_core.models.account import Account
+from bars_items.models.stockitem import StockItem
+from bars_transactions.models import Transaction
+from scripts.bench_utils import rollback, measure
+from scripts.utils import parse_args
+
+
+class Endpoints(object):
+    def __init__(self, bar, client, rng):
+        self.bar = bar
+        self.client = client
+        self.rng = rng
+        self.accounts = list(Account.objects.filter(bar=bar, deleted=False).values_list('pk', flat=True))
+        self.stockitems = list(StockItem.objects.filter(bar=bar, deleted=False).values_list('pk', flat=True))
+        self.created = []
+
+    def url(self, path):
+        return '/%s?bar=%s' % (path, self.bar.id)
+
+    def transaction_list(self):
+        return self.client.get(self.url('transaction/') + '&page=1&page_size=20'), 200
+
+    def buy(self):
+        response = self.client.post(self.url('transaction/'), {'type': 'buy', 'stockitem': self.rng.choice(self.stockitems), 'qty': 1})
+        if response.status_code == 201:
+            self.created.append(response.data['id'])
+        return response, 201
+
+    def meal(self):
+        data = {
+            'type': 'meal', 'name': 'Bench',
+            'items': [{'stockitem': s, 'qty': 1} for s in self.rng.sample(self.stockitems, 3)],
+            'accounts': [{'account': a, 'ratio': 1} for a in self.rng.sample(self.accounts, 4)],
+        }
+        return self.client.post(self.url('transaction/'), data, format='json'), 201
+
+    def cancel(self):
+        # Cancels the transactions created by buy()
+        return self.client.put(self.url('transaction/%d/cancel/' % self.created.pop()), {}), 200
+
+    def ranking(self):
+        return self.client.get(self.url('account/ranking/')), 200
+
+    def stats(self):
+        return self.client.get(self.url('account/%d/stats/' % self.rng.choice(self.accounts))), 200
+
+    def sellitem_list(self):
+        return self.client.get(self.url('sellitem/')), 200
+
+
+ENDPOINTS = ['transaction_list', 'buy', 'meal', 'cancel', 'ranking', 'stats', 'sellitem_list']
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench(endpoint, samples, warmup):
+    timings, queries = [], []
+    for i in range(warmup + samples):
+        (response, status), elapsed, n = measure(endpoint)
+        if response.status_code != status:
+            raise Exception("%s: %d instead of %d: %s" % (endpoint.__name__, response.status_code, status, response.content[:500]))
+        if i >= warmup:
+            timings.append(elapsed * 1000)
+            queries.append(n)
+    return {
+        'p50_ms': percentile(timings, .5),
+        'p99_ms': percentile(timings, .99),
+        'mean_ms': sum(timings) / len(timings),
+        'queries_p50': percentile(queries, .5),
+        'queries_max': max(queries),
+    }
+
+
+def run(*args):
+    opts = parse_args(args, bar='gen_0', samples=50, warmup=3, seed=0, out='bench_endpoints.json', compare='')
+    # Allows the test client's host and keeps mails in memory
+    setup_test_environment()
+    # Like in production, and so that queries are not logged by Django
+    settings.DEBUG = False
+    rng = random.Random(opts['seed'])
+    bar = Bar.objects.get(pk=opts['bar'])
+
+    results = {
+        'date': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'bar': bar.id,
+        'samples': opts['samples'],
+        'dataset': {
+            'transactions': Transaction.objects.filter(bar=bar).count(),
+            'accounts': Account.objects.filter(bar=bar).count(),
+            'stockitems': StockItem.objects.filter(bar=bar).count(),
+        },
+        'endpoints': {},
+    }
+    print("Bar %s: %d transactions, %d accounts, %d stock items" % (
+        bar.id, results['dataset']['transactions'], results['dataset']['accounts'], results['dataset']['stockitems']))
+
+    with rollback():
+        client = APIClient()
+        client.force_authenticate(user=Account.objects.filter(bar=bar, deleted=False).order_by('pk')[0].owner)
+        endpoints = Endpoints(bar, client, rng)
+        for name in ENDPOINTS:
+            results['endpoints'][name] = bench(getattr(endpoints, name), opts['samples'], opts['warmup'])
+
+    previous = {}
+    if opts['compare']:
+        with open(opts['compare']) as f:
+            previous = json.load(f)['endpoints']
+
+    print("%-18s %9s %9s %8s %8s" % ("endpoint", "p50 (ms)", "p99 (ms)", "queries", "max"))
+    for name in ENDPOINTS:
+        r = results['endpoints'][name]
+        line = "%-18s %9.1f %9.1f %8d %8d" % (name, r['p50_ms'], r['p99_ms'], r['queries_p50'], r['queries_max'])
+        if name in previous:
+            line += "   p50 x%.2f, p99 x%.2f" % (r['p50_ms'] / previous[name]['p50_ms'], r['p99_ms'] / previous[name]['p99_ms'])
+        print(line)
+
+    with open(opts['out'], 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to %s" % opts['out'])
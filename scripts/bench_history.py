@@ -0,0 +1,72 @@
+"""Compares the per-user transaction history query with the former OR-join + DISTINCT one.
+
+Usage: manage.py runscript bench_history --script-args transactions=1000000 users=10000
+"""
+import random
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.account import Account
+from bars_transactions.models import Transaction, AccountOperation
+from bars_transactions.views import TransactionFilterBackend
+from scripts.bench_utils import rollback, measure, next_id
+from scripts.utils import parse_args
+
+
+def make_dataset(bar, n_users, n_transactions, rng):
+    User.objects.bulk_create([User(username='bench_history_%d' % i) for i in range(n_users)], batch_size=500)
+    users = list(User.objects.filter(username__startswith='bench_history_').values_list('id', flat=True))
+    Account.objects.bulk_create([Account(bar=bar, owner_id=u) for u in users], batch_size=500)
+    accounts = list(Account.objects.filter(bar=bar).values_list('id', flat=True))
+
+    t_id = next_id(Transaction)
+    now = timezone.now()
+    batch = 5000
+    for start in range(0, n_transactions, batch):
+        transactions, aops = [], []
+        for i in range(start, min(start + batch, n_transactions)):
+            transactions.append(Transaction(id=t_id + i, bar=bar, author_id=rng.choice(users), type='buy', timestamp=now))
+            aops.append(AccountOperation(transaction_id=t_id + i, target_id=rng.choice(accounts), prev_value=0, delta=-1, next_value=-1))
+        Transaction.objects.bulk_create(transactions)
+        AccountOperation.objects.bulk_create(aops)
+    return users
+
+
+def explain(qs):
+    sql, params = qs.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return "\n".join("    " + " | ".join(str(c) for c in row) for row in cursor.fetchall())
+
+
+def old_history(bar, user):
+    q = Q(accountoperation__target__owner=user) | Q(author=user)
+    return Transaction.objects.filter(bar=bar).filter(q).order_by('-timestamp', '-id').distinct()[:10]
+
+def new_history(bar, user):
+    q = TransactionFilterBackend.filter_q['user'](user)
+    return Transaction.objects.filter(bar=bar).filter(q).order_by('-timestamp', '-id')[:10]
+
+
+def run(*args):
+    opts = parse_args(args, transactions=1000000, users=10000, samples=20, seed=0)
+    rng = random.Random(opts['seed'])
+
+    with rollback():
+        bar, _ = Bar.objects.get_or_create(id='bench_history', name='Bench')
+        users = make_dataset(bar, opts['users'], opts['transactions'], rng)
+        print("%d transactions, %d users" % (opts['transactions'], opts['users']))
+
+        for name, history in (('OR-join + DISTINCT', old_history), ('id subqueries', new_history)):
+            print("\n%s:" % name)
+            print(explain(history(bar, users[0])))
+            timings = []
+            for user in rng.sample(users, min(opts['samples'], len(users))):
+                _, elapsed, _ = measure(lambda: list(history(bar, user)))
+                timings.append(elapsed)
+            timings.sort()
+            print("  first page of history: median %.1fms, max %.1fms" % (timings[len(timings) // 2] * 1000, timings[-1] * 1000))
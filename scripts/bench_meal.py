@@ -0,0 +1,73 @@
+"""Benchmarks creating a meal shared by many accounts.
+
+Usage: manage.py runscript bench_meal --script-args accounts=200 items=5 legacy=1
+
+With legacy, the accounts are also validated and debited one by one, the way
+meals were created before the operations were written in bulk.
+"""
+from mock import Mock
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.role import Role
+from bars_core.models.account import Account
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+from bars_transactions.models import Transaction
+from bars_transactions.serializers import MealTransactionSerializer, AccountRatioSerializer
+from scripts.bench_utils import rollback, measure
+from scripts.utils import parse_args
+
+
+def make_bar(n_accounts, n_items):
+    bar, _ = Bar.objects.get_or_create(id='bench_meal', name='Bench')
+    users = [User(username='bench_meal_%d' % i) for i in range(n_accounts)]
+    User.objects.bulk_create(users, batch_size=100)
+    users = User.objects.filter(username__startswith='bench_meal_')
+    Account.objects.bulk_create([Account(bar=bar, owner=u, money=100) for u in users], batch_size=100)
+    Role.objects.bulk_create([Role(bar=bar, user=u, name='customer') for u in users], batch_size=100)
+
+    stockitems = []
+    for i in range(n_items):
+        sellitem = SellItem.objects.create(bar=bar, name='Item %d' % i)
+        details = ItemDetails.objects.create(name='bench_meal item %d' % i)
+        stockitems.append(StockItem.objects.create(bar=bar, sellitem=sellitem, details=details, qty=1000, price=1))
+    return bar, list(Account.objects.filter(bar=bar)), stockitems
+
+
+def legacy_meal(context, data):
+    accounts = []
+    for a in data['accounts']:
+        s = AccountRatioSerializer(data=a, context=context)
+        s.is_valid(raise_exception=True)
+        accounts.append(s.validated_data)
+
+    t = Transaction.objects.create(bar=context['request'].bar, author=context['request'].user, type='meal')
+    total_ratio = sum(a['ratio'] for a in accounts)
+    for a in accounts:
+        t.accountoperation_set.create(target=a['account'], delta=-10. * a['ratio'] / total_ratio)
+
+
+def run(*args):
+    opts = parse_args(args, accounts=200, items=5, legacy=True)
+
+    with rollback():
+        bar, accounts, stockitems = make_bar(opts['accounts'], opts['items'])
+        context = {'request': Mock(user=accounts[0].owner, bar=bar)}
+        data = {
+            'type': 'meal', 'name': 'Bench',
+            'items': [{'stockitem': s.id, 'qty': 1} for s in stockitems],
+            'accounts': [{'account': a.id, 'ratio': 1} for a in accounts],
+        }
+        print("Meal of %d items shared by %d accounts" % (len(stockitems), len(accounts)))
+
+        s = MealTransactionSerializer(data=data, context=context)
+        _, elapsed, queries = measure(s.is_valid, raise_exception=True)
+        print("  validation: %.3fs, %d queries" % (elapsed, queries))
+        _, elapsed, queries = measure(s.save)
+        print("  creation:   %.3fs, %d queries" % (elapsed, queries))
+
+        if opts['legacy']:
+            _, elapsed, queries = measure(legacy_meal, context, data)
+            print("  accounts only, one by one (legacy): %.3fs, %d queries" % (elapsed, queries))
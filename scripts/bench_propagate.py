@@ -0,0 +1,55 @@
+"""Benchmarks canceling a transaction followed by many operations on the same account.
+
+Usage: manage.py runscript bench_propagate --script-args ops=10000 legacy=0
+"""
+from django.utils import timezone
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.account import Account
+from bars_transactions.models import Transaction, AccountOperation
+from scripts.bench_utils import rollback, measure, next_id
+from scripts.utils import parse_args
+
+
+def make_history(bar, account, n):
+    t_id = next_id(Transaction)
+    now = timezone.now()
+    transactions, aops = [], []
+    money = account.money
+    for i in range(n):
+        transactions.append(Transaction(id=t_id + i, bar=bar, author=account.owner, type='deposit', timestamp=now))
+        aops.append(AccountOperation(transaction_id=t_id + i, target=account, prev_value=money, delta=1, next_value=money + 1))
+        money += 1
+    Transaction.objects.bulk_create(transactions, batch_size=500)
+    AccountOperation.objects.bulk_create(aops, batch_size=500)
+    Account.objects.filter(pk=account.pk).update(money=money)
+    return Transaction.objects.get(pk=t_id)
+
+
+def legacy_propagate(transaction):
+    transaction.canceled = not transaction.canceled
+    transaction.save()
+    for aop in transaction.accountoperation_set.all():
+        aop.propagate()
+
+
+def run(*args):
+    opts = parse_args(args, ops=10000, legacy=True)
+
+    with rollback():
+        bar, _ = Bar.objects.get_or_create(id='bench_propagate', name='Bench')
+        user, _ = User.objects.get_or_create(username='bench_propagate')
+        account, _ = Account.objects.get_or_create(bar=bar, owner=user)
+
+        first = make_history(bar, account, opts['ops'])
+        print("Canceling a transaction followed by %d operations" % (opts['ops'] - 1))
+
+        _, elapsed, queries = measure(first.set_canceled, True)
+        print("  cancel:  %.3fs, %d queries" % (elapsed, queries))
+        _, elapsed, queries = measure(first.set_canceled, False)
+        print("  restore: %.3fs, %d queries" % (elapsed, queries))
+
+        if opts['legacy']:
+            _, elapsed, queries = measure(legacy_propagate, first)
+            print("  cancel (legacy propagate()): %.3fs, %d queries" % (elapsed, queries))
@@ -0,0 +1,116 @@
+"""Benchmarks the rendering of a transaction history, over all the transaction types.
+
+Usage: manage.py runscript bench_render --script-args transactions=10000 dump=/tmp/render.json
+
+With `dump`, the rendered JSON is written to a file, to check that two versions
+of the renderer produce the same output on the same (deterministic) dataset.
+"""
+import random
+import time
+from datetime import datetime
+from mock import Mock
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.role import Role
+from bars_core.models.account import Account, get_default_account
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, TransactionData
+from bars_transactions.serializers import serializers_class_map
+from bars_transactions.views import TransactionViewSet
+from scripts.bench_utils import rollback, next_id
+from scripts.utils import parse_args
+
+TYPES = ["", "buy", "throw", "deposit", "withdraw", "give", "refund", "punish", "agios",
+         "barInvestment", "meal", "appro", "inventory", "collectivePayment"]
+
+
+def make_dataset(bar, n, rng):
+    users = [User.objects.create(username='bench_render_%d' % i) for i in range(20)]
+    accounts = [Account.objects.create(bar=bar, owner=u) for u in users]
+    default_account = get_default_account(bar)
+    stockitems = []
+    for i in range(10):
+        sellitem = SellItem.objects.create(bar=bar, name='Item %d' % (i // 2))
+        details = ItemDetails.objects.create(name='Item %d' % i)
+        stockitems.append(StockItem.objects.create(bar=bar, sellitem=sellitem, details=details, price=1 + i, unit_factor=1 + i % 3))
+
+    t_id = next_id(Transaction)
+    transactions, aops, iops, data = [], [], [], []
+    def aop(t, account, delta):
+        aops.append(AccountOperation(transaction_id=t, target=account, prev_value=0, delta=delta, next_value=delta))
+    def iop(t, stockitem, delta, **kwargs):
+        iops.append(ItemOperation(transaction_id=t, target=stockitem, prev_value=0, delta=delta, next_value=delta, **kwargs))
+
+    for i in range(n):
+        t = t_id + i
+        type = TYPES[i % len(TYPES)]
+        author = rng.randrange(len(users))
+        account = accounts[author]
+        other = accounts[(author + 1 + rng.randrange(len(users) - 1)) % len(users)]
+        amount = rng.randint(1, 100) / 4.
+        transactions.append(Transaction(id=t, bar=bar, author=users[author], type=type, moneyflow=amount, canceled=(i % 7 == 0)))
+
+        if type in ("buy", "throw"):
+            iop(t, rng.choice(stockitems), -rng.randint(1, 4), fuzzy=rng.random() < .5)
+        if type == "buy":
+            aop(t, account, -amount)
+        elif type in ("deposit", "withdraw", "refund"):
+            aop(t, account, amount)
+            aop(t, default_account, amount)
+        elif type == "give":
+            aop(t, account, -amount)
+            aop(t, other, amount)
+        elif type in ("punish", "agios"):
+            aop(t, account, -amount)
+        elif type == "barInvestment":
+            aop(t, default_account, -amount)
+        elif type in ("meal", "collectivePayment"):
+            for a in rng.sample(accounts, 3):
+                aop(t, a, -amount * rng.randint(1, 3))
+        elif type == "appro" and i % 5 != 0:  # Appros without an account operation are rendered as errors
+            aop(t, default_account, -amount)
+        if type in ("meal", "appro", "inventory"):
+            for s in rng.sample(stockitems, 3):
+                iop(t, s, rng.randint(1, 10), fuzzy=rng.random() < .5, fixed=(type == "inventory"))
+        if type in ("refund", "punish", "barInvestment", "collectivePayment"):
+            data.append(TransactionData(transaction_id=t, label='motive', data='Motive %d' % i))
+        if type == "meal":
+            data.append(TransactionData(transaction_id=t, label='name', data='Meal %d' % i))
+
+    Transaction.objects.bulk_create(transactions, batch_size=100)
+    AccountOperation.objects.bulk_create(aops, batch_size=100)
+    ItemOperation.objects.bulk_create(iops, batch_size=100)
+    TransactionData.objects.bulk_create(data, batch_size=100)
+    # Make timestamps deterministic, so that dumps can be compared
+    epoch = timezone.make_aware(datetime(2015, 1, 1), timezone.utc)
+    Transaction.objects.filter(pk__gte=t_id).update(timestamp=epoch, last_modified=epoch)
+    return users
+
+
+def run(*args):
+    opts = parse_args(args, transactions=10000, samples=3, seed=0, dump='')
+    rng = random.Random(opts['seed'])
+
+    with rollback():
+        bar, _ = Bar.objects.get_or_create(id='bench_render', name='Bench')
+        users = make_dataset(bar, opts['transactions'], rng)
+        Role.objects.create(bar=bar, user=users[0], name='policeman')
+        request = Mock(user=User.objects.get(pk=users[0].pk), bar=bar)
+
+        transactions = list(TransactionViewSet.queryset.filter(bar=bar).order_by('-timestamp', '-id'))
+        times = []
+        for _ in range(opts['samples']):
+            start = time.time()
+            data = serializers_class_map[""](transactions, many=True, context={'request': request}).data
+            times.append(time.time() - start)
+        print("%d transactions rendered in %.3fs (best of %d), %.2fms per page of 10" % (
+            len(transactions), min(times), opts['samples'], min(times) / len(transactions) * 10 * 1000))
+
+        if opts['dump']:
+            with open(opts['dump'], 'wb') as f:
+                f.write(JSONRenderer().render(data))
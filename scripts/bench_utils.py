@@ -0,0 +1,28 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+
+@contextmanager
+def rollback():
+    """Runs the block in a transaction that is always rolled back, so benchmarks leave the database untouched."""
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def measure(f, *args, **kwargs):
+    """Returns (result, seconds, number of queries) of a call to f."""
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        result = f(*args, **kwargs)
+        elapsed = time.time() - start
+    return result, elapsed, len(queries)
+
+
+def next_id(model):
+    last = model.objects.order_by('-pk').values_list('pk', flat=True).first()
+    return (last or 0) + 1
+
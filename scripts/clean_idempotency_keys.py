@@ -0,0 +1,17 @@
+"""Deletes the idempotency keys of transactions older than IDEMPOTENCY_KEY_TTL.
+
+Usage: manage.py runscript clean_idempotency_keys
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+
+from bars_transactions.models import IdempotencyKey
+
+
+def run(*args):
+    limit = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    keys = IdempotencyKey.objects.filter(timestamp__lt=limit)
+    count = keys.count()
+    keys.delete()
+    print("Deleted %d idempotency keys" % count)
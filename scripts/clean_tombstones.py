@@ -0,0 +1,17 @@
+"""Deletes the tombstones older than TOMBSTONE_TTL, which /sync/ no longer serves.
+
+Usage: manage.py runscript clean_tombstones
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+
+from bars_core.models.tombstone import Tombstone
+
+
+def run(*args):
+    limit = timezone.now() - timedelta(seconds=settings.TOMBSTONE_TTL)
+    tombstones = Tombstone.objects.filter(timestamp__lt=limit)
+    count = tombstones.count()
+    tombstones.delete()
+    print("Deleted %d tombstones" % count)
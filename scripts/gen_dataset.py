@@ -0,0 +1,191 @@
+"""Fills the database with a synthetic multi-bar dataset, for scripts/bench_endpoints.py.
+
+Usage: manage.py runscript gen_dataset --script-args bars=10 users=10000 accounts=100000 items=500 transactions=1000000 seed=0
+
+Everything is written with bulk_create and is NOT rolled back: run it on a
+scratch database. Bars are named <prefix>_<n>. Operations are chained like real
+ones, so balances, stocks and daily stats are consistent with the history.
+"""
+import random
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.role import Role
+from bars_core.models.account import Account, get_default_account
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+from bars_stats.models import AccountDailyStat, ItemDailyStat, build_daily_stats
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, TransactionData
+from scripts.bench_utils import next_id
+from scripts.utils import parse_args
+
+# (type, weight)
+TYPES = [("buy", 60), ("deposit", 8), ("withdraw", 2), ("meal", 10), ("give", 6),
+         ("appro", 5), ("throw", 3), ("punish", 2), ("inventory", 1), ("collectivePayment", 3)]
+CANCELED_RATIO = 0.01
+INITIAL_QTY = 1000
+BATCH_SIZE = 5000
+
+
+def set_values(model, field, values):
+    """Sets field of many rows, given as a dict {pk: value}, with one UPDATE per chunk of rows."""
+    items = list(values.items())
+    for i in range(0, len(items), 200):
+        chunk = items[i:i + 200]
+        model.objects.filter(pk__in=[pk for pk, _ in chunk]).update(
+            **{field: Case(*[When(pk=pk, then=Value(value)) for pk, value in chunk], output_field=model._meta.get_field(field))})
+
+
+class Generator(object):
+    def __init__(self, opts):
+        self.opts = opts
+        self.rng = random.Random(opts['seed'])
+        self.money = {}
+        self.qty = {}
+
+    def make_bars(self):
+        prefix = self.opts['prefix']
+        users = [User(username='%s_%d' % (prefix, i), firstname='User', lastname=str(i)) for i in range(self.opts['users'])]
+        User.objects.bulk_create(users, batch_size=100)
+        users = list(User.objects.filter(username__startswith=prefix + '_').values_list('pk', flat=True))
+        ItemDetails.objects.bulk_create([ItemDetails(name='%s item %d' % (prefix, i)) for i in range(self.opts['items'])], batch_size=100)
+        details = list(ItemDetails.objects.filter(name__startswith=prefix + ' item ').values_list('pk', flat=True))
+
+        self.bars = []
+        per_bar = min(self.opts['accounts'] // self.opts['bars'], len(users))
+        for b in range(self.opts['bars']):
+            bar = Bar.objects.create(id='%s_%d' % (prefix, b), name='Bar %d' % b)
+            owners = self.rng.sample(users, per_bar)
+            Account.objects.bulk_create([Account(bar=bar, owner_id=u) for u in owners], batch_size=100)
+            Role.objects.bulk_create([Role(bar=bar, user_id=u, name='customer') for u in owners], batch_size=100)
+            accounts = list(Account.objects.filter(bar=bar).values_list('pk', 'owner_id'))
+            default_account = get_default_account(bar).pk
+
+            SellItem.objects.bulk_create([SellItem(bar=bar, name='Item %d' % i) for i in range(len(details))], batch_size=100)
+            sellitems = list(SellItem.objects.filter(bar=bar).order_by('pk').values_list('pk', flat=True))
+            StockItem.objects.bulk_create([
+                StockItem(bar=bar, sellitem_id=s, details_id=d, qty=INITIAL_QTY, price=self.rng.randint(20, 400) / 100.)
+                for s, d in zip(sellitems, details)
+            ], batch_size=100)
+            stockitems = dict(StockItem.objects.filter(bar=bar).values_list('pk', 'price'))
+
+            for pk, _ in accounts:
+                self.money[pk] = 0
+            self.money[default_account] = 0
+            for pk in stockitems:
+                self.qty[pk] = INITIAL_QTY
+            self.bars.append((bar, accounts, default_account, stockitems, list(stockitems)))
+
+    def make_transactions(self):
+        n = self.opts['transactions']
+        t_id = next_id(Transaction)
+        start = timezone.now() - timedelta(days=365)
+        step = timedelta(days=365) / max(n, 1)
+        types = [t for t, weight in TYPES for _ in range(weight)]
+
+        for batch in range(0, n, BATCH_SIZE):
+            self.transactions, self.aops, self.iops, self.data = [], [], [], []
+            for i in range(batch, min(batch + BATCH_SIZE, n)):
+                self.make_transaction(t_id + i, start + step * i, self.rng.choice(types), self.rng.choice(self.bars))
+            # bulk_create() overwrites the timestamps, since the field is auto_now_add
+            timestamps = dict((t.id, t.timestamp) for t in self.transactions)
+            Transaction.objects.bulk_create(self.transactions, batch_size=100)
+            set_values(Transaction, 'timestamp', timestamps)
+            AccountOperation.objects.bulk_create(self.aops, batch_size=100)
+            ItemOperation.objects.bulk_create(self.iops, batch_size=100)
+            TransactionData.objects.bulk_create(self.data, batch_size=100)
+            print("  %d/%d transactions" % (min(batch + BATCH_SIZE, n), n))
+
+    def make_transaction(self, t, timestamp, type, bar_data):
+        bar, accounts, default_account, prices, stockitems = bar_data
+        rng = self.rng
+        canceled = rng.random() < CANCELED_RATIO
+        account, author = rng.choice(accounts)
+        amount = rng.randint(1, 200) / 4.
+
+        def aop(target, delta):
+            prev_value = self.money[target]
+            delta = round(delta, 2)
+            next_value = round(prev_value + delta, 2)
+            self.aops.append(AccountOperation(transaction_id=t, target_id=target, prev_value=prev_value,
+                                              delta=delta, next_value=next_value))
+            if not canceled:
+                self.money[target] = next_value
+
+        def iop(target, delta=0, next_value=None):
+            prev_value = self.qty[target]
+            fixed = next_value is not None
+            if fixed:
+                delta = next_value - prev_value
+            else:
+                next_value = prev_value + delta
+            self.iops.append(ItemOperation(transaction_id=t, target_id=target, prev_value=prev_value,
+                                           delta=delta, next_value=next_value, fixed=fixed))
+            if not canceled:
+                self.qty[target] = next_value
+            return -delta * prices[target]
+
+        def items(k, sign):
+            return sum(iop(s, sign * rng.randint(1, 5)) for s in rng.sample(stockitems, k))
+
+        if type == "buy":
+            amount = items(1, -1)
+            aop(account, -amount)
+        elif type in ("deposit", "withdraw"):
+            sign = 1 if type == "deposit" else -1
+            aop(account, sign * amount)
+            aop(default_account, sign * amount)
+        elif type == "give":
+            aop(account, -amount)
+            aop(rng.choice(accounts)[0], amount)
+        elif type == "punish":
+            aop(account, -amount)
+            self.data.append(TransactionData(transaction_id=t, label='motive', data='Motive'))
+        elif type in ("meal", "collectivePayment"):
+            if type == "meal":
+                amount = items(rng.randint(1, 4), -1)
+                self.data.append(TransactionData(transaction_id=t, label='name', data='Meal'))
+            else:
+                self.data.append(TransactionData(transaction_id=t, label='motive', data='Payment'))
+            payers = rng.sample(accounts, rng.randint(2, 6))
+            for payer, _ in payers:
+                aop(payer, -amount / len(payers))
+        elif type == "appro":
+            amount = -items(rng.randint(1, 10), 1)
+            aop(default_account, -amount)
+        elif type == "throw":
+            amount = -items(1, -1)
+        elif type == "inventory":
+            amount = sum(iop(s, next_value=self.qty[s] + rng.randint(-3, 1)) for s in rng.sample(stockitems, 20))
+
+        self.transactions.append(Transaction(id=t, bar=bar, author_id=author, type=type, timestamp=timestamp,
+                                             canceled=canceled, moneyflow=round(abs(amount), 2)))
+
+    def finish(self):
+        set_values(Account, 'money', self.money)
+        set_values(StockItem, 'qty', self.qty)
+        build_daily_stats(AccountOperation, AccountDailyStat, 'account')
+        build_daily_stats(ItemOperation, ItemDailyStat, 'stockitem')
+
+
+def run(*args):
+    opts = parse_args(args, bars=10, users=10000, accounts=100000, items=500, transactions=1000000, seed=0, prefix='gen')
+    if Bar.objects.filter(id__startswith=opts['prefix'] + '_').exists():
+        print("There are already bars named %s_<n>, choose another prefix" % opts['prefix'])
+        return
+
+    generator = Generator(opts)
+    with transaction.atomic():
+        generator.make_bars()
+    print("%d bars, %d users, %d accounts, %d stock items" % (
+        len(generator.bars), opts['users'], len(generator.money), len(generator.qty)))
+    with transaction.atomic():
+        generator.make_transactions()
+        generator.finish()
+    print("%d transactions, %d account operations, %d item operations" % (
+        opts['transactions'], AccountOperation.objects.count(), ItemOperation.objects.count()))
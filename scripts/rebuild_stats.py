@@ -0,0 +1,15 @@
+"""Recomputes the daily stats tables from the operations.
+
+Usage: manage.py runscript rebuild_stats
+"""
+from django.db import transaction
+
+from bars_transactions.models import AccountOperation, ItemOperation
+from bars_stats.models import AccountDailyStat, ItemDailyStat, build_daily_stats
+
+
+def run():
+    with transaction.atomic():
+        build_daily_stats(AccountOperation, AccountDailyStat, 'account')
+        build_daily_stats(ItemOperation, ItemDailyStat, 'stockitem')
+    print("%d account rows, %d item rows" % (AccountDailyStat.objects.count(), ItemDailyStat.objects.count()))
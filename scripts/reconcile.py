@@ -0,0 +1,109 @@
+"""Checks that account balances and stocks match the fold of their operations, and optionally repairs them.
+
+Usage: manage.py runscript reconcile [--script-args bar=<id> repair=1 processes=4]
+
+The operations of each target are streamed in order and folded the way
+BaseOperation.propagate() does: a canceled operation leaves the value unchanged,
+a fixed one sets it. A target is wrong when one of its operations does not
+chain with the previous one, or when the fold does not end on its current value.
+Repairing a target also rebuilds its daily stats, as its deltas may have changed.
+Targets are processed by chunks, so memory does not depend on the number of
+operations. Bars are spread over a pool of processes.
+"""
+from itertools import groupby
+from multiprocessing import Pool
+from operator import itemgetter
+from django.db import connections, transaction
+
+from bars_core.models.bar import Bar
+from bars_stats.models import stat_models, build_daily_stats
+from bars_transactions.models import AccountOperation, ItemOperation
+from scripts.utils import parse_args
+
+TOLERANCE = 1e-6
+TARGET_CHUNK_SIZE = 200
+
+
+def fold(ops, clean):
+    """Returns the value a target should have after ops, and the id of the first operation that does not chain."""
+    value = None
+    broken = None
+    for _, pk, prev_value, delta, next_value, fixed, canceled in ops:
+        if value is None:
+            value = prev_value
+        expected_next = clean(next_value if fixed else value + delta)
+        expected_delta = clean(expected_next - value)
+        if broken is None and max(abs(prev_value - value), abs(next_value - expected_next), abs(delta - expected_delta)) > TOLERANCE:
+            broken = pk
+        if not canceled:
+            value = expected_next
+    return value, broken
+
+
+def reconcile(op_class, bar_id):
+    """Returns (target id, value, folded value, first broken operation id) for each wrong target of op_class in bar_id."""
+    clean = op_class._meta.get_field('delta').to_python
+    targets = op_class.op_model.objects.filter(bar=bar_id).order_by('pk').values_list('pk', op_class.op_model_field)
+
+    wrong = []
+    last = None
+    while True:
+        chunk = targets.filter(pk__gt=last) if last is not None else targets
+        values = list(chunk[:TARGET_CHUNK_SIZE])
+        if not values:
+            return wrong
+        last = values[-1][0]
+        values = dict(values)
+
+        ops = (op_class.objects
+               .filter(target__in=values.keys())
+               .order_by('target', 'transaction__timestamp', 'pk')
+               .values_list('target', 'pk', 'prev_value', 'delta', 'next_value', 'fixed', 'transaction__canceled')
+               .iterator())
+        for target_id, target_ops in groupby(ops, itemgetter(0)):
+            folded, broken = fold(target_ops, clean)
+            if broken is not None or abs(values[target_id] - folded) > TOLERANCE:
+                wrong.append((target_id, values[target_id], folded, broken))
+
+
+def repair(op_class, target_ids):
+    """Rechains the operations of each target, then rebuilds their daily stats from the repaired deltas."""
+    stat_model = stat_models[op_class.op_model]
+    with transaction.atomic():
+        for target_id in target_ids:
+            first = op_class.objects.filter(target=target_id).order_by('transaction__timestamp', 'pk').first()
+            first.save()
+            first.propagate()
+        build_daily_stats(op_class, stat_model, stat_model.target_field, targets=target_ids)
+
+
+def reconcile_bar(job):
+    bar_id, do_repair = job
+    results = []
+    for op_class in (AccountOperation, ItemOperation):
+        wrong = reconcile(op_class, bar_id)
+        if do_repair and wrong:
+            repair(op_class, [target_id for target_id, _, _, _ in wrong])
+        results.append((op_class.op_model.__name__, wrong))
+    return bar_id, results
+
+
+def run(*args):
+    opts = parse_args(args, bar='', repair=False, processes=1)
+    bar_ids = [opts['bar']] if opts['bar'] else list(Bar.objects.order_by('id').values_list('id', flat=True))
+    jobs = [(bar_id, opts['repair']) for bar_id in bar_ids]
+
+    if opts['processes'] > 1:
+        # Workers must not share the connection of the parent
+        for connection in connections.all():
+            connection.close()
+        results = Pool(opts['processes']).imap_unordered(reconcile_bar, jobs)
+    else:
+        results = (reconcile_bar(job) for job in jobs)
+
+    for bar_id, bar_results in results:
+        for model_name, wrong in bar_results:
+            print("%s: %d wrong %s%s" % (bar_id, len(wrong), model_name, " (repaired)" if wrong and opts['repair'] else ""))
+            for target_id, value, folded, broken in wrong:
+                print("    %s %d: %s, operations say %s%s" % (model_name, target_id, value, folded,
+                                                          ", broken from operation %d" % broken if broken is not None else ""))
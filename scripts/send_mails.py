@@ -0,0 +1,20 @@
+"""Sends the mails waiting in the outbox, in batches over a single connection.
+
+Usage: manage.py runscript send_mails [--script-args batch=100]
+"""
+from bars_core.models.outbox import send_queued_mails
+from scripts.utils import parse_args
+
+
+def run(*args):
+    opts = parse_args(args, batch=100)
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = send_queued_mails(batch_size=opts['batch'])
+        total_sent += sent
+        total_failed += failed
+        # Failed mails are postponed, so they are not picked again by the next batch
+        if sent + failed < opts['batch']:
+            break
+    if total_sent or total_failed:
+        print("Sent %d mails (%d failed)" % (total_sent, total_failed))
@@ -0,0 +1,43 @@
+"""Takes a balance snapshot of each account every `every` operations, for /account/<id>/balance_at/.
+
+Usage: manage.py runscript snapshot_balances [--script-args bar=<id> every=100]
+
+Only the operations after the last snapshot of each account are read, so this
+can be run as often as wanted.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from bars_core.models.account import Account
+from bars_transactions.models import AccountOperation, AccountSnapshot
+from scripts.utils import parse_args
+
+
+def take_snapshots(account_id, every):
+    last = AccountSnapshot.objects.filter(account=account_id).order_by('-timestamp', '-operation').first()
+    ops = AccountOperation.objects.filter(target=account_id)
+    if last is not None:
+        ops = ops.filter(Q(transaction__timestamp__gt=last.timestamp) | Q(transaction__timestamp=last.timestamp, pk__gt=last.operation_id))
+    ops = (ops.order_by('transaction__timestamp', 'pk')
+           .values_list('pk', 'transaction__timestamp', 'prev_value', 'next_value', 'transaction__canceled'))
+
+    snapshots = []
+    for i, (pk, timestamp, prev_value, next_value, canceled) in enumerate(ops.iterator(), 1):
+        if i % every == 0:
+            balance = prev_value if canceled else next_value
+            snapshots.append(AccountSnapshot(account_id=account_id, operation_id=pk, timestamp=timestamp, balance=balance))
+    AccountSnapshot.objects.bulk_create(snapshots, batch_size=100)
+    return len(snapshots)
+
+
+def run(*args):
+    opts = parse_args(args, bar='', every=100)
+    accounts = Account.objects.order_by('pk')
+    if opts['bar']:
+        accounts = accounts.filter(bar=opts['bar'])
+
+    count = 0
+    for account_id in accounts.values_list('pk', flat=True):
+        with transaction.atomic():
+            count += take_snapshots(account_id, opts['every'])
+    print("Took %d snapshots" % count)
@@ -0,0 +1,12 @@
+def parse_args(args, **defaults):
+    """Parses runscript arguments of the form key=value, using the types of the defaults."""
+    opts = dict(defaults)
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key not in defaults:
+            raise ValueError("Unknown option: %s" % key)
+        if isinstance(defaults[key], bool):
+            opts[key] = value.lower() in ('1', 'true', 'yes')
+        else:
+            opts[key] = type(defaults[key])(value)
+    return opts